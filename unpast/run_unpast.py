@@ -29,11 +29,24 @@ def run(exprs_file: pd.DataFrame,
         verbose: bool = True,
         plot_all: bool = False,
         e_dist_size: int = 10000,
-        standradize: bool = True):
+        standradize: bool = True,
+        n_jobs: int = 1,
+        warm_start: bool = False,
+        null_distribution: pd.DataFrame = None,
+        checkpoint_dir: str = None,
+        chunksize: int = None,
+        exprs_format: str = None,
+        dtype: str = "float64",
+        memory_budget: float = None,
+        sorted_rows: np.ndarray = None,
+        prescreen: bool = False):
     
     import sys
     from time import time
     from unpast.utils.method import prepare_input_matrix
+    from unpast.utils.checkpoint import hash_data, load_checkpoint, save_checkpoint
+    from unpast.utils.io import get_input_format, read_exprs
+    from unpast.utils.sparse_exprs import SparseExprs
     
     start_time = time()
     
@@ -48,9 +61,37 @@ def run(exprs_file: pd.DataFrame,
         print("set output basename to", basename, file = sys.stdout)
         
     # read inputs
-    exprs = pd.read_csv(exprs_file, sep="\t",index_col=0)
+    prepared = False
+    # a matrix read here is not shared and can be standardized in place
+    inplace = not isinstance(exprs_file, (pd.DataFrame, SparseExprs))
+    if isinstance(exprs_file, (pd.DataFrame, SparseExprs)):
+        exprs = exprs_file
+    elif (chunksize or memory_budget) and get_input_format(exprs_file, exprs_format) == "tsv":
+        # streamed by chunks of rows, standardized and stored as a float32 memory-mapped array
+        from unpast.utils.io import read_exprs_chunked
+        if memory_budget and not chunksize:
+            from unpast.utils.disk_exprs import get_budget_chunksize
+            n_samples = pd.read_csv(exprs_file, sep="\t", index_col=0, nrows=0).shape[1]
+            chunksize = get_budget_chunksize(n_samples, memory_budget)
+        # with memory_budget, the matrix stays on disk and is read by chunks of rows
+        exprs = read_exprs_chunked(exprs_file,
+                                   min_n_samples=min_n_samples,
+                                   standradize=standradize,
+                                   ceiling=ceiling,
+                                   chunksize=chunksize,
+                                   out_of_core=bool(memory_budget),
+                                   verbose = verbose)
+        prepared = True
+        if verbose:
+            print("Read input from ",exprs_file, file=sys.stdout)
+    else:
+        if memory_budget:
+            print("memory_budget requires a tab-separated input, the input is read into memory",
+                  file=sys.stderr)
+        exprs = read_exprs(exprs_file, fmt = exprs_format, verbose = verbose)
+        if verbose:
+            print("Read input from ",exprs_file, file=sys.stdout)
     if verbose:
-        print("Read input from ",exprs_file, file=sys.stdout)
         print("\t{} features x {} samples".format(exprs.shape[0],exprs.shape[1]), file=sys.stdout)
     if exprs.shape[1]<5:
         print("Input matrix must contain at least 5 samples (columns), but only %s columns are found."%
@@ -81,25 +122,135 @@ def run(exprs_file: pd.DataFrame,
     if verbose:
         print("The size of empirical SNR distribution: %s"%e_dist_size, file=sys.stdout)
 
+    # with checkpoint_dir, the result of each stage is saved under a hash of
+    # the input and of parameters of this and upstream stages;
+    # a rerun loads valid checkpoints and computes only the missing stages
+    if checkpoint_dir:
+        keys = {}
+        keys["standardize"] = hash_data(exprs, min_n_samples, standradize, ceiling, dtype)
+        keys["null"] = hash_data(keys["standardize"], e_dist_size, seed, null_distribution)
+        keys["binarization"] = hash_data(keys["null"], bin_method, pval, *(["prescreen"] if prescreen else []))
+        keys["similarity"] = hash_data(keys["binarization"], directions)
+        keys["modules"] = hash_data(keys["similarity"], clust_method, modularity, similarity_cutoffs,
+                                    ds, dch, max_power, precluster)
+        keys["biclusters"] = hash_data(keys["modules"], merge, warm_start)
+
+    def stage(name, compute):
+        if not checkpoint_dir:
+            return compute()
+        result = load_checkpoint(checkpoint_dir, name, keys[name], verbose = verbose)
+        if result is None:
+            result = compute()
+            save_checkpoint(checkpoint_dir, name, keys[name], result, verbose = verbose)
+        return result
+
     # check if input is standardized (between-sample)
     # if necessary, standardize and limit values to [-ceiling,ceiling]
-    exprs = prepare_input_matrix(exprs,
-                                 min_n_samples=min_n_samples,
-                                 standradize=standradize,
-                                 ceiling=ceiling,
-                                 verbose = verbose
-                                )
+    if not prepared:
+        exprs = stage("standardize", lambda: prepare_input_matrix(exprs,
+                                                                  min_n_samples=min_n_samples,
+                                                                  standradize=standradize,
+                                                                  ceiling=ceiling,
+                                                                  verbose = verbose,
+                                                                  dtype = dtype,
+                                                                  inplace = inplace
+                                                                 ))
         
     ######### binarization #########
-    from unpast.utils.method import binarize
+    from unpast.utils.method import binarize, generate_null_dist, get_null_sizes
     
-    binarized_features, stats, null_distribution  = binarize(out_dir+basename, exprs=exprs,
+    if checkpoint_dir and null_distribution is None:
+        # background distribution for the grid of bicluster sizes used by binarize();
+        # binarize() adds sizes of binarized features
+        N = exprs.shape[1]
+        null_distribution = stage("null", lambda: generate_null_dist(N, get_null_sizes(N, min_n_samples),
+                                                                     n_permutations=e_dist_size, pval=pval,
+                                                                     seed=seed, verbose=verbose, dtype=dtype))
+    binarized_features, stats, null_distribution  = stage("binarization", lambda: binarize(out_dir+basename, exprs=exprs,
                                  method=bin_method, save = save, load=load,
                                  min_n_samples = min_n_samples,pval=pval,
                                  plot_all = plot_all,show_fits = show_fits,
                                  verbose= verbose,seed=seed,
-                                 prob_cutoff=0.5, n_permutations=e_dist_size)
+                                 prob_cutoff=0.5, n_permutations=e_dist_size,
+                                 null_distribution=null_distribution,
+                                 sorted_rows=sorted_rows, prescreen=prescreen, packed=True))
+    
+    bin_data_dict = filter_binarized_features(binarized_features, stats, pval, directions)
+        
+    ######### gene clustering #########
+    if verbose:
+        print("Clustering features ...\n",file=sys.stdout)
+    similarities = None
+    if checkpoint_dir and clust_method == "Louvain":
+        similarities = stage("similarity", lambda: calc_feature_similarities(bin_data_dict, directions,
+                                                                            verbose = verbose,
+                                                                            dtype = dtype))
+    # WGCNA tmp file prefix
+    tmp_prefix = out_dir+basename+ "."+bin_method+".pval="+str(pval)+".seed="+str(seed)
+    feature_clusters, not_clustered, used_similarity_cutoffs = stage("modules", lambda: cluster_features(bin_data_dict,
+                                                                                directions = directions,
+                                                                                clust_method = clust_method,
+                                                                                modularity = modularity,
+                                                                                similarity_cutoffs = similarity_cutoffs,
+                                                                                ds = ds, dch = dch,
+                                                                                max_power = max_power,
+                                                                                precluster = precluster,
+                                                                                rpath = rpath,
+                                                                                tmp_prefix = tmp_prefix,
+                                                                                similarities = similarities,
+                                                                                dtype = dtype,
+                                                                                verbose = verbose))
+    
+    ######### making biclusters #########
+    if len(feature_clusters)==0:
+        if verbose:
+            print("No biclusters found",file = sys.stderr)
+        return pd.DataFrame()
+        
+    from unpast.utils.method import make_biclusters
+    biclusters = stage("biclusters", lambda: make_biclusters(feature_clusters,
+                                 binarized_features,
+                                 exprs,
+                                 null_distribution,
+                                 method = bin_method,
+                                 merge = merge,
+                                 min_n_samples=min_n_samples,
+                                 min_n_genes=2,
+                                 seed = seed,
+                                 cluster_binary=False,
+                                 verbose = verbose,
+                                 n_jobs = n_jobs,
+                                 warm_start = warm_start))
+
     
+    from unpast.utils.method import write_bic_table
+    suffix  = ".seed="+str(seed)+".bin="+bin_method+",pval="+str(pval)+",clust="+clust_method+",direction="+"-".join(directions)
+    if "WGCNA" in clust_method:
+        suffix2 = ",ds="+str(ds)+",dch="+str(dch)+",max_power="+str(max_power)+",precluster="+str(precluster)
+        modularity, similarity_cutoff = None, None
+    elif clust_method == "Louvain":
+        suffix2 = ",m="+str(round(modularity,2))
+        ds, dhs = None, None
+    write_bic_table(biclusters, out_dir+basename+suffix+suffix2+".biclusters.tsv",to_str=True,
+                    add_metadata=True, seed = seed, min_n_samples = min_n_samples, pval = pval,
+                    bin_method = bin_method, clust_method = clust_method, directions = directions,
+                    #alpha=alpha, beta_K = beta_K, 
+                    similarity_cutoff = used_similarity_cutoffs,
+                    m=modularity, ds = ds, dch = dch, 
+                    max_power=max_power, precluster=precluster,
+                    merge = merge)
+
+    if verbose:
+        print(out_dir+basename+suffix+suffix2+".biclusters.tsv", file = sys.stdout)
+        print("Total runtime: {:.2f} s".format(time()-start_time ), file = sys.stdout)
+    
+    return biclusters    
+
+
+def filter_binarized_features(binarized_features, stats, pval, directions):
+    """Keeps binarized features with SNR p-values not greater than pval
+    and splits them by direction; returns a dict direction -> features."""
+    from unpast.utils.binarized import BinarizedMatrix
     bin_data_dict = {}
     stats = stats.loc[stats["pval"]<=pval,:]
     features_up = set(stats.loc[stats["direction"]=="UP",:].index.values)
@@ -107,6 +258,15 @@ def run(exprs_file: pd.DataFrame,
     features_down = stats.loc[stats["direction"]=="DOWN",:].index.values
     features_down = sorted(set(binarized_features.columns.values).intersection(set(features_down)))
 
+    if isinstance(binarized_features, BinarizedMatrix):
+        # bit-packed features are subset without unpacking
+        if directions[0] == "BOTH":
+            bin_data_dict["BOTH"] = binarized_features.select(features_up+features_down)
+        else:
+            bin_data_dict["UP"] = binarized_features.select(features_up)
+            bin_data_dict["DOWN"] = binarized_features.select(features_down)
+        return bin_data_dict
+
     df_up = binarized_features.loc[:,features_up]
     df_down = binarized_features.loc[:,features_down]
     if directions[0] == "BOTH":
@@ -114,21 +274,55 @@ def run(exprs_file: pd.DataFrame,
     else:
         bin_data_dict["UP"]  = df_up
         bin_data_dict["DOWN"]  = df_down 
-        
-    ######### gene clustering #########
-    if verbose:
-        print("Clustering features ...\n",file=sys.stdout)
+    return bin_data_dict
+
+
+def calc_feature_similarities(bin_data_dict, directions, verbose = True, dtype = "float64"):
+    """Jaccard similarities of binarized features used by Louvain clustering."""
+    from unpast.utils.method import get_similarity_jaccard
+    similarities = {}
+    for d in directions:
+        df = bin_data_dict[d]
+        if df.shape[0]>1:
+            similarities[d] = get_similarity_jaccard(df,verbose = verbose, dtype = dtype)
+            #similarities[d] = get_similarity_corr(df,verbose = verbose, dtype = dtype)
+    return similarities
+
+
+def cluster_features(bin_data_dict,
+                     directions: list = ["DOWN","UP"],
+                     clust_method: str = "WGCNA",
+                     modularity: float = 1/3,
+                     similarity_cutoffs = -1, # for Louvain
+                     ds: int = 3,
+                     dch: float = 0.995,
+                     max_power: int = 10,
+                     precluster: bool = True,
+                     rpath: str = "", # for WGCNA
+                     tmp_prefix: str = "",
+                     similarities: dict = None,
+                     dtype: str = "float64",
+                     verbose: bool = True):
+    """Clusters binarized features of each direction with Louvain or (i)WGCNA.
+
+    similarities are optional precomputed feature similarities for Louvain
+    (see calc_feature_similarities()); WGCNA tmp files are named by tmp_prefix.
+    Returns feature clusters, not clustered features and used similarity cutoffs.
+    """
+    import sys
+    from unpast.utils.binarized import BinarizedMatrix
     feature_clusters, not_clustered, used_similarity_cutoffs = [], [], []
     if clust_method == "Louvain":
         from unpast.utils.method import run_Louvain
-        from unpast.utils.method import get_similarity_jaccard
         
+        if similarities is None:
+            similarities = calc_feature_similarities(bin_data_dict, directions, verbose = verbose,
+                                                     dtype = dtype)
         for d in directions:
             df = bin_data_dict[d]
             if df.shape[0]>1:
 
-                similarity = get_similarity_jaccard(df,verbose = verbose)
-                #similarity = get_similarity_corr(df,verbose = verbose)
+                similarity = similarities[d]
 
                 if similarity_cutoffs  == -1: # guess from the data
                     similarity_cutoffs = np.arange(0.3,0.9,0.01)
@@ -161,11 +355,11 @@ def run(exprs_file: pd.DataFrame,
             WGCNA_func = run_WGCNA
 
         for d in directions:
-            # WGCNA tmp file prefix
-            tmp_prefix = out_dir+basename+ "."+bin_method+".pval="+str(pval)+".seed="+str(seed)+"."+d
             df = bin_data_dict[d] 
+            if isinstance(df, BinarizedMatrix):
+                df = df.to_dense()
             if df.shape[0]>1:
-                modules, single_features = WGCNA_func(df,tmp_prefix=tmp_prefix, 
+                modules, single_features = WGCNA_func(df,tmp_prefix=tmp_prefix+"."+d, 
                                                       deepSplit=ds,detectCutHeight=dch,nt = "signed_hybrid",
                                                       max_power = max_power, precluster=precluster,
                                                      verbose = verbose,rpath = rpath)  
@@ -175,54 +369,393 @@ def run(exprs_file: pd.DataFrame,
     else:
         print("'clust_method' must be 'WGCNA', 'iWGCNA', or 'Louvain'.",file=sys.stderr)
     
-    ######### making biclusters #########
-    if len(feature_clusters)==0:
+    return feature_clusters, not_clustered, used_similarity_cutoffs
+
+
+# the input matrix and the null distribution shared by ensemble workers
+_ensemble_data = None
+
+
+def _init_ensemble_worker(exprs, null_distribution, sorted_rows):
+    global _ensemble_data
+    _ensemble_data = (exprs, null_distribution, sorted_rows)
+
+
+def _run_seed(args):
+    seed, kwargs = args
+    exprs, null_distribution, sorted_rows = _ensemble_data
+    return run(exprs, seed = seed, null_distribution = null_distribution,
+               sorted_rows = sorted_rows, **kwargs)
+
+
+def run_ensemble(exprs_file,
+                 seeds: list = None,
+                 n_jobs: int = 1,
+                 basename: str = '',
+                 out_dir: str = "./",
+                 ceiling: float = 3,
+                 min_n_samples: int = 5,
+                 pval: float = 0.01,
+                 e_dist_size: int = 10000,
+                 standradize: bool = True,
+                 verbose: bool = True,
+                 **kwargs):
+    """Runs UnPaSt with several seeds and makes consensus biclusters.
+
+    The input is read and standardized once and the background SNR distribution
+    for the grid of bicluster sizes used by binarize() is generated once
+    (with the first seed) and shared by all runs, as well as sorted rows used
+    by 'ward' and large-cohort 'kmeans' binarization. seeds default to 42-46.
+    Runs with different seeds are distributed over n_jobs worker processes.
+    Other keyword arguments are passed to run().
+    Writes per-seed bicluster tables and one table with consensus biclusters;
+    returns consensus biclusters and the list of per-seed biclusters.
+    """
+    import sys
+    from time import time
+    from unpast.utils.method import prepare_input_matrix, generate_null_dist, get_null_sizes
+    from unpast.utils.method import get_n_workers, make_consensus_biclusters
+    from unpast.utils.method import write_bic_table, needs_sorted_rows, sort_rows
+    from unpast.utils.io import read_exprs
+    from unpast.utils.sparse_exprs import SparseExprs
+
+    start_time = time()
+    if seeds is None:
+        seeds = [42, 43, 44, 45, 46]
+    if out_dir[-1] != '/':
+        out_dir += '/'
+    if not basename:
+        from datetime import datetime
+        now = datetime.now()
+        basename = "unpast_" + now.strftime("%y.%m.%d_%H:%M:%S")
+        print("set output basename to", basename, file = sys.stdout)
+
+    # read and standardize inputs once
+    if isinstance(exprs_file, (pd.DataFrame, SparseExprs)):
+        exprs = exprs_file
+    else:
+        exprs = read_exprs(exprs_file, fmt = kwargs.get("exprs_format"), verbose = verbose)
         if verbose:
-            print("No biclusters found",file = sys.stderr)
-        return pd.DataFrame()
-        
-    from unpast.utils.method import make_biclusters
-    biclusters = make_biclusters(feature_clusters,
-                                 binarized_features,
-                                 exprs,
-                                 null_distribution,
-                                 method = bin_method,
-                                 merge = merge,
+            print("Read input from ",exprs_file, file=sys.stdout)
+    dtype = kwargs.get("dtype", "float64")
+    exprs = prepare_input_matrix(exprs,
                                  min_n_samples=min_n_samples,
-                                 min_n_genes=2,
-                                 seed = seed,
-                                 cluster_binary=False,
-                                 verbose = verbose)
+                                 standradize=standradize,
+                                 ceiling=ceiling,
+                                 verbose = verbose,
+                                 dtype = dtype,
+                                 inplace = not isinstance(exprs_file, (pd.DataFrame, SparseExprs))
+                                )
 
-    
-    from unpast.utils.method import write_bic_table
-    suffix  = ".seed="+str(seed)+".bin="+bin_method+",pval="+str(pval)+",clust="+clust_method+",direction="+"-".join(directions)
-    if "WGCNA" in clust_method:
-        suffix2 = ",ds="+str(ds)+",dch="+str(dch)+",max_power="+str(max_power)+",precluster="+str(precluster)
-        modularity, similarity_cutoff = None, None
-    elif clust_method == "Louvain":
-        suffix2 = ",m="+str(round(modularity,2))
-        ds, dhs = None, None
-    write_bic_table(biclusters, out_dir+basename+suffix+suffix2+".biclusters.tsv",to_str=True,
-                    add_metadata=True, seed = seed, min_n_samples = min_n_samples, pval = pval,
-                    bin_method = bin_method, clust_method = clust_method, directions = directions,
-                    #alpha=alpha, beta_K = beta_K, 
-                    similarity_cutoff = used_similarity_cutoffs,
-                    m=modularity, ds = ds, dch = dch, 
-                    max_power=max_power, precluster=precluster,
-                    merge = merge)
+    # background SNR distribution for the grid of bicluster sizes used by binarize();
+    # each run adds sizes of its binarized features
+    N = exprs.shape[1]
+    e_dist_size = max(e_dist_size,int(1.0/pval*10))
+    null_distribution = generate_null_dist(N, get_null_sizes(N, min_n_samples),
+                                           n_permutations=e_dist_size, pval=pval,
+                                           seed=seeds[0], verbose=verbose, dtype=dtype)
+    sorted_rows = None
+    if needs_sorted_rows(kwargs.get("bin_method", "kmeans"), N):
+        sorted_rows = sort_rows(exprs)
+
+    # input is already standardized; n_jobs are used for runs with different seeds
+    run_kwargs = dict(kwargs, basename = basename, out_dir = out_dir,
+                      ceiling = ceiling, min_n_samples = min_n_samples, pval = pval,
+                      e_dist_size = e_dist_size, standradize = False,
+                      verbose = verbose, n_jobs = 1)
+    tasks = [(seed, run_kwargs) for seed in seeds]
+    n_workers = min(get_n_workers(n_jobs), len(tasks))
+    if n_workers <= 1:
+        _init_ensemble_worker(exprs, null_distribution, sorted_rows)
+        results = [_run_seed(task) for task in tasks]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_ensemble_worker,
+                                 initargs=(exprs, null_distribution, sorted_rows)) as executor:
+            results = list(executor.map(_run_seed, tasks))
+
+    # consensus of all runs; bicluster ids are prefixed with seeds
+    biclusters_list = []
+    for seed, biclusters in zip(seeds, results):
+        if biclusters.shape[0] > 0:
+            biclusters = biclusters.copy()
+            biclusters.index = ["%s_%s"%(seed,i) for i in biclusters.index.values]
+            biclusters_list.append(biclusters)
+    consensus = make_consensus_biclusters(biclusters_list, exprs,
+                                          method = kwargs.get("bin_method", "kmeans"),
+                                          min_n_samples = min_n_samples,
+                                          seed = seeds[0], verbose = verbose,
+                                          n_jobs = n_jobs)
+    if consensus is None:
+        consensus = pd.DataFrame()
+    result_file = out_dir+basename+".consensus.n_runs="+str(len(seeds))+".biclusters.tsv"
+    write_bic_table(consensus, result_file, to_str=True)
 
     if verbose:
-        print(out_dir+basename+suffix+suffix2+".biclusters.tsv", file = sys.stdout)
+        print(result_file, file = sys.stdout)
         print("Total runtime: {:.2f} s".format(time()-start_time ), file = sys.stdout)
-    
-    return biclusters    
+
+    return consensus, results
+
+
+# stages of the pipeline with parameters of run() they depend on;
+# each stage also depends on all upstream stages
+_sweep_stages = [("standardize", ["ceiling", "min_n_samples", "standradize", "dtype"]),
+                 ("binarize", ["bin_method", "seed", "plot_all", "show_fits"]),
+                 ("filter", ["pval", "e_dist_size"]),
+                 ("similarity", ["directions"]),
+                 ("clustering", ["clust_method", "modularity", "similarity_cutoffs",
+                                 "ds", "dch", "max_power", "precluster", "rpath"]),
+                 ("biclusters", ["merge", "warm_start"])]
+# clustering parameters not used by Louvain and WGCNA, respectively
+_sweep_ignored = {"Louvain": ["ds", "dch", "max_power", "precluster", "rpath"],
+                  "WGCNA": ["modularity", "similarity_cutoffs"]}
+
+# results of upstream stages shared by sweep workers
+_sweep_data = None
+
+
+def _hashable(value):
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return tuple(value)
+    return value
+
+
+def _sweep_stage_keys(params):
+    # key of a stage is the key of the upstream stage + values of its own parameters
+    keys, key = {}, ()
+    ignored = _sweep_ignored["Louvain" if params["clust_method"] == "Louvain" else "WGCNA"]
+    for stage, names in _sweep_stages:
+        key = key + tuple(_hashable(params[name]) for name in names if name not in ignored)
+        keys[stage] = key
+    return keys
+
+
+def _init_sweep_worker(data):
+    global _sweep_data
+    _sweep_data = data
+
+
+def _cluster_sweep_features(args):
+    similarity_key, kwargs = args
+    bin_data_dict = _sweep_data["bin_data"][similarity_key]
+    similarities = _sweep_data["similarities"].get(similarity_key)
+    return cluster_features(bin_data_dict, similarities = similarities, **kwargs)
+
+
+def _make_sweep_biclusters(args):
+    standardize_key, filter_key, feature_clusters, kwargs = args
+    from unpast.utils.method import make_biclusters
+    if len(feature_clusters)==0:
+        return pd.DataFrame()
+    exprs = _sweep_data["exprs"][standardize_key]
+    binarized_features, stats, null_distribution = _sweep_data["binarized"][filter_key]
+    return make_biclusters(feature_clusters, binarized_features, exprs, null_distribution,
+                           min_n_genes=2, cluster_binary=False, n_jobs = 1, **kwargs)
+
+
+def run_sweep(exprs_file,
+              param_grid: dict,
+              n_jobs: int = 1,
+              basename: str = '',
+              out_dir: str = "./",
+              verbose: bool = True,
+              **kwargs):
+    """Runs UnPaSt for all combinations of parameter values.
+
+    param_grid maps parameters of run() to lists of their values; other
+    keyword arguments set parameters fixed for all runs.
+    The pipeline is split into stages (standardization, binarization,
+    p-value filtering, feature similarities, feature clustering, making
+    biclusters) and each stage is computed once for every distinct
+    combination of its own and upstream parameters, e.g. features binarized
+    with one seed are reused for all pval, modularity and merge values.
+    Feature clustering and making biclusters are distributed over n_jobs
+    worker processes.
+    Returns a tidy table of biclusters found with all parameter sets, with
+    'param_set' and swept parameters columns; it is also written to
+    <basename>.sweep.biclusters.tsv.
+    """
+    import sys
+    import inspect
+    import itertools
+    from time import time
+    from unpast.utils.method import prepare_input_matrix, sklearn_binarization
+    from unpast.utils.method import binarize, generate_null_dist, get_null_sizes
+    from unpast.utils.method import needs_sorted_rows, sort_rows
+    from unpast.utils.method import get_n_workers, write_bic_table
+    from unpast.utils.io import read_exprs
+    from unpast.utils.sparse_exprs import SparseExprs
+
+    start_time = time()
+    if out_dir[-1] != '/':
+        out_dir += '/'
+    if not basename:
+        from datetime import datetime
+        now = datetime.now()
+        basename = "unpast_" + now.strftime("%y.%m.%d_%H:%M:%S")
+        print("set output basename to", basename, file = sys.stdout)
+
+    if kwargs.get("prescreen"):
+        # binarizations are shared by runs with different pval
+        print("prescreen is not used by run_sweep()", file=sys.stderr)
+    swept = list(param_grid.keys())
+    stage_params = [name for stage, names in _sweep_stages for name in names]
+    for name in swept:
+        if name not in stage_params:
+            raise ValueError("parameter '%s' can not be swept; use one of %s"%(name, stage_params))
+    defaults = {name: p.default for name, p in inspect.signature(run).parameters.items()}
+    defaults.update(kwargs)
+    param_sets = [dict(defaults, **dict(zip(swept, values)))
+                  for values in itertools.product(*[param_grid[name] for name in swept])]
+    stage_keys = [_sweep_stage_keys(params) for params in param_sets]
+
+    if isinstance(exprs_file, (pd.DataFrame, SparseExprs)):
+        exprs = exprs_file
+    else:
+        exprs = read_exprs(exprs_file, fmt = kwargs.get("exprs_format"), verbose = verbose)
+        if verbose:
+            print("Read input from ",exprs_file, file=sys.stdout)
+
+    # upstream stages are computed once for each distinct key
+    data = {"exprs": {}, "binarized": {}, "bin_data": {}, "similarities": {}}
+    binarization_results, null_distributions = {}, {}
+    # argsorts of rows, shared by binarizations of the same standardized matrix
+    sorted_rows = {}
+    clustering_tasks, biclusters_tasks = {}, {}
+    for params, keys in zip(param_sets, stage_keys):
+        if keys["standardize"] not in data["exprs"]:
+            data["exprs"][keys["standardize"]] = prepare_input_matrix(exprs,
+                                                                      min_n_samples=params["min_n_samples"],
+                                                                      standradize=params["standradize"],
+                                                                      ceiling=params["ceiling"],
+                                                                      verbose = verbose,
+                                                                      dtype = params["dtype"])
+        stage_exprs = data["exprs"][keys["standardize"]]
+        if (needs_sorted_rows(params["bin_method"], stage_exprs.shape[1])
+                and keys["standardize"] not in sorted_rows):
+            sorted_rows[keys["standardize"]] = sort_rows(stage_exprs)
+
+        if keys["binarize"] not in binarization_results:
+            binarization_results[keys["binarize"]] = sklearn_binarization(stage_exprs,
+                                                                          params["min_n_samples"],
+                                                                          plot=params["plot_all"],
+                                                                          plot_SNR_thr=np.inf,
+                                                                          prob_cutoff=0.5,
+                                                                          show_fits=params["show_fits"],
+                                                                          verbose=verbose,
+                                                                          seed=params["seed"],
+                                                                          method=params["bin_method"],
+                                                                          sorted_rows=sorted_rows.get(keys["standardize"]),
+                                                                          packed=True)
+
+        if keys["filter"] not in data["binarized"]:
+            # background SNR distribution for the grid of bicluster sizes used by binarize()
+            N = stage_exprs.shape[1]
+            e_dist_size = max(params["e_dist_size"],int(1.0/params["pval"]*10))
+            null_key = (params["min_n_samples"], N, params["seed"], e_dist_size, params["dtype"])
+            if null_key not in null_distributions:
+                null_distributions[null_key] = generate_null_dist(N,
+                                                                  get_null_sizes(N, params["min_n_samples"]),
+                                                                  n_permutations=e_dist_size,
+                                                                  pval=params["pval"],
+                                                                  seed=params["seed"],
+                                                                  verbose=verbose,
+                                                                  dtype=params["dtype"])
+            data["binarized"][keys["filter"]] = binarize(out_dir+basename, exprs=stage_exprs,
+                                                         method=params["bin_method"], save = False, load=False,
+                                                         min_n_samples = params["min_n_samples"],
+                                                         pval=params["pval"],
+                                                         plot_all = params["plot_all"],
+                                                         show_fits = params["show_fits"],
+                                                         verbose= verbose, seed=params["seed"],
+                                                         prob_cutoff=0.5, n_permutations=e_dist_size,
+                                                         null_distribution=null_distributions[null_key],
+                                                         binarization=binarization_results[keys["binarize"]],
+                                                         packed=True)
+            # keep sizes added by binarize() for other parameter sets with the same seed
+            null_distributions[null_key] = data["binarized"][keys["filter"]][2]
+
+        if keys["similarity"] not in data["bin_data"]:
+            binarized_features, stats, null_distribution = data["binarized"][keys["filter"]]
+            data["bin_data"][keys["similarity"]] = filter_binarized_features(binarized_features, stats,
+                                                                             params["pval"],
+                                                                             params["directions"])
+        if params["clust_method"] == "Louvain" and keys["similarity"] not in data["similarities"]:
+            data["similarities"][keys["similarity"]] = calc_feature_similarities(data["bin_data"][keys["similarity"]],
+                                                                                 params["directions"],
+                                                                                 verbose = verbose,
+                                                                                 dtype = params["dtype"])
+
+        # leaves of the stage tree
+        if keys["clustering"] not in clustering_tasks:
+            tmp_prefix = out_dir+basename+".sweep_"+str(len(clustering_tasks))
+            clustering_tasks[keys["clustering"]] = (keys["similarity"],
+                                                    dict(directions = params["directions"],
+                                                         clust_method = params["clust_method"],
+                                                         modularity = params["modularity"],
+                                                         similarity_cutoffs = params["similarity_cutoffs"],
+                                                         ds = params["ds"], dch = params["dch"],
+                                                         max_power = params["max_power"],
+                                                         precluster = params["precluster"],
+                                                         rpath = params["rpath"],
+                                                         tmp_prefix = tmp_prefix,
+                                                         dtype = params["dtype"],
+                                                         verbose = verbose))
+        if keys["biclusters"] not in biclusters_tasks:
+            biclusters_tasks[keys["biclusters"]] = (keys["standardize"], keys["filter"], keys["clustering"],
+                                                    dict(method = params["bin_method"],
+                                                         merge = params["merge"],
+                                                         min_n_samples = params["min_n_samples"],
+                                                         seed = params["seed"],
+                                                         verbose = verbose,
+                                                         warm_start = params["warm_start"]))
+
+    def run_leaves(map_func):
+        feature_clusters = dict(zip(clustering_tasks.keys(),
+                                    map_func(_cluster_sweep_features, clustering_tasks.values())))
+        tasks = [(standardize_key, filter_key, feature_clusters[clustering_key][0], task_kwargs)
+                 for standardize_key, filter_key, clustering_key, task_kwargs in biclusters_tasks.values()]
+        return dict(zip(biclusters_tasks.keys(), map_func(_make_sweep_biclusters, tasks)))
+
+    n_workers = min(get_n_workers(n_jobs), len(clustering_tasks)+len(biclusters_tasks))
+    if n_workers <= 1:
+        _init_sweep_worker(data)
+        results = run_leaves(lambda func, tasks: [func(task) for task in tasks])
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_sweep_worker,
+                                 initargs=(data,)) as executor:
+            results = run_leaves(lambda func, tasks: list(executor.map(func, tasks)))
+
+    # one row per bicluster, ids are prefixed with parameter set numbers
+    tables = []
+    for i, (params, keys) in enumerate(zip(param_sets, stage_keys)):
+        biclusters = results[keys["biclusters"]].copy()
+        biclusters.index = ["%s_%s"%(i,j) for j in biclusters.index.values]
+        for name in swept[::-1]:
+            biclusters.insert(0, name, pd.Series([_hashable(params[name])]*len(biclusters),
+                                                 index=biclusters.index, dtype=object))
+        biclusters.insert(0, "param_set", i)
+        tables.append(biclusters)
+    table = pd.concat(tables, axis=0)
+    result_file = out_dir+basename+".sweep.biclusters.tsv"
+    write_bic_table(table, result_file, to_str=True)
+
+    if verbose:
+        print(result_file, file = sys.stdout)
+        print("Total runtime: {:.2f} s".format(time()-start_time ), file = sys.stdout)
+
+    return table
+
 
 def parse_args():
     parser = argparse.ArgumentParser("UnPaSt identifies differentially expressed biclusters in a 2-dimensional matrix.")
     parser.add_argument('--seed',metavar=42, default=42, type=int, help="random seed")
     parser.add_argument('--exprs', metavar="exprs.z.tsv", required=True, 
                         help=".tsv file with between-sample normalized input data matrix. The first column and row must contain unique feature and sample ids, respectively. At least 5 samples (columns) and at least 2 features (rows) are required.")
+    parser.add_argument('--exprs_format', default=None, type=str, choices=["tsv", "parquet", "feather", "hdf5", "npy", "npz"],
+                        help="format of --exprs; by default guessed from the file extension (.parquet, .pq, .feather, .arrow, .ipc, .h5, .hdf5, .hdf, .npy, .npz), otherwise tab-separated. For .npy and sparse .npz (scipy.sparse.save_npz) inputs, feature and sample names are read from <name>.rows.txt and <name>.columns.txt.")
     parser.add_argument('--out_dir', metavar="./", default="./", help  = 'output folder')
     parser.add_argument('--basename', metavar="biclusters.tsv", default = False, type=str, help  = 'output files prefix. If not specified, will be set to "results_"yy.mm.dd_HH:MM:SS""')
     parser.add_argument('--ceiling', default=3, metavar="3",  type=float, required=False, 
@@ -244,6 +777,14 @@ def parse_args():
     parser.add_argument('--merge', default=1, metavar="1", type=float,help = "Whether to merge biclustres similar in samples with Jaccard index not less then the specified.")
     parser.add_argument('--load_binary', action='store_true', help = "loads binarized features from <basename>.<bin_method>.seed=42.binarized.tsv, statistics from *.binarization_stats.tsv and the background SNR distribution from <basename>.<bin_method>.n=<e_dist_size>.seed=42.background.tsv")
     parser.add_argument('--save_binary', action='store_true', help = "saves binarized features to a file named as <basename>.<bin_method>.seed=42.binarized.tsv. When feature clustering method is WGCNA, binarized features will be always saved. Also, files *.binarization_stats.tsv and *.background.tsv with binarization statistincs and background SNR distributions respectively will be created")
+    parser.add_argument('-j','--n_jobs', default=1, metavar="1", type=int, help = "Number of worker processes used for sample clustering, or for runs with different --seeds; -1 uses all CPUs.")
+    parser.add_argument('--warm_start', action='store_true', help = "Warm-start 2-means sample clustering from the majority vote of binarized module features; the multi-start KMeans is used only if the results disagree strongly.")
+    parser.add_argument('--seeds', default=[], nargs="+", metavar="42", type=int, help = "Run with each of these random seeds and make consensus biclusters; input standardization and the background SNR distribution are shared by all runs, and --n_jobs runs are executed in parallel.")
+    parser.add_argument('--checkpoint_dir', default=None, metavar="", type=str, help = "Folder for checkpoints of pipeline stages. Reruns with the same input and parameters resume from the last saved stage; checkpoints made with other inputs or parameters are not used.")
+    parser.add_argument('--memory_budget', default=None, metavar="", type=float, help = "Out-of-core mode: memory budget in MB for chunks of the input matrix. The standardized matrix is kept on disk as a float32 memory-mapped array, binarization reads it by chunks of rows fitting the budget, and only rows of features in modules are gathered into memory for sample clustering (the budget does not limit this submatrix). Requires a tab-separated input.")
+    parser.add_argument('--chunksize', default=None, metavar="", type=int, help = "Read the input by chunks of this many rows, standardize them on the fly and keep the matrix as a float32 memory-mapped array; reduces memory usage for large inputs.")
+    parser.add_argument('--prescreen', action='store_true', help = "With kmeans binarization, skip features which can not pass the SNR threshold; binarized features are the same as without it. Skipped features are marked in the 'prescreened' column of binarization statistics.")
+    parser.add_argument('--dtype', default="float64", type=str, choices=["float64", "float32"], help = "Floating point type of the standardized matrix, background SNR distributions and feature similarities; float32 halves memory usage.")
     parser.add_argument('-v','--verbose', action='store_true')
     #parser.add_argument('--plot', action='store_true', help = "show plots")
     
@@ -258,19 +799,47 @@ if __name__ == "__main__":
     if args.bidirectional:
         directions = ["BOTH"]
     
-    biclusters = run(args.exprs, args.basename, out_dir=args.out_dir,  
-                save = args.save_binary, load = args.load_binary,
-                ceiling = args.ceiling,
-                bin_method = args.binarization, 
-                clust_method = args.clustering,
-                pval = args.pval,
-                directions = directions,
-                min_n_samples = args.min_n_samples, 
-                show_fits = [],
-                modularity = args.modularity, similarity_cutoffs = args.similarity_cutoffs, # for Louvain
-                ds = args.ds, dch = args.dch, rpath=args.rpath, precluster=True, # for WGCNA
-                cluster_binary = False, 
-                merge = args.merge,
-                seed = args.seed,
-                #plot_all = args.plot,
-                verbose = args.verbose)
+    if args.seeds:
+        run_ensemble(args.exprs, seeds = args.seeds, n_jobs = args.n_jobs,
+                     basename = args.basename, out_dir = args.out_dir,
+                     save = args.save_binary, load = args.load_binary,
+                     ceiling = args.ceiling,
+                     bin_method = args.binarization,
+                     clust_method = args.clustering,
+                     pval = args.pval,
+                     directions = directions,
+                     min_n_samples = args.min_n_samples,
+                     modularity = args.modularity, similarity_cutoffs = args.similarity_cutoffs, # for Louvain
+                     ds = args.ds, dch = args.dch, rpath=args.rpath, precluster=True, # for WGCNA
+                     merge = args.merge,
+                     warm_start = args.warm_start,
+                     checkpoint_dir = args.checkpoint_dir,
+                     prescreen = args.prescreen,
+                     exprs_format = args.exprs_format,
+                     dtype = args.dtype,
+                     verbose = args.verbose)
+    else:
+        biclusters = run(args.exprs, args.basename, out_dir=args.out_dir,  
+                    save = args.save_binary, load = args.load_binary,
+                    ceiling = args.ceiling,
+                    bin_method = args.binarization, 
+                    clust_method = args.clustering,
+                    pval = args.pval,
+                    directions = directions,
+                    min_n_samples = args.min_n_samples, 
+                    show_fits = [],
+                    modularity = args.modularity, similarity_cutoffs = args.similarity_cutoffs, # for Louvain
+                    ds = args.ds, dch = args.dch, rpath=args.rpath, precluster=True, # for WGCNA
+                    cluster_binary = False, 
+                    merge = args.merge,
+                    seed = args.seed,
+                    n_jobs = args.n_jobs,
+                    warm_start = args.warm_start,
+                    checkpoint_dir = args.checkpoint_dir,
+                    chunksize = args.chunksize,
+                    memory_budget = args.memory_budget,
+                    prescreen = args.prescreen,
+                    exprs_format = args.exprs_format,
+                    dtype = args.dtype,
+                    #plot_all = args.plot,
+                    verbose = args.verbose)
@@ -11,7 +11,7 @@ if not os.access(RESULTS_DIR, os.W_OK):
     RESULTS_DIR = "/tmp/unpast/results"
 REFERENCE_OUTPUT_DIR = os.path.join(TEST_DIR, "test_reference_output")
 
-from unpast.run_unpast import run
+from unpast.run_unpast import run, run_ensemble, run_sweep
 
 
 ### Helper functions ###
@@ -103,3 +103,89 @@ def test_reproducible():
         basename="test_reproducible",
     )
     assert res.equals(reference), "The results are not reproducible"
+
+
+@pytest.mark.slow
+def test_ensemble():
+    """Check that runs with several seeds agree on clear biclusters."""
+    consensus, results = run_ensemble(
+        os.path.join(TEST_DIR, "test_input/synthetic_clear_biclusters.tsv"),
+        seeds=[1, 2, 3],
+        n_jobs=2,
+        out_dir=RESULTS_DIR,
+        basename="test_ensemble",
+        clust_method="Louvain",
+        verbose=False,
+    )
+    assert len(results) == 3
+    res = parse_answer(RESULTS_DIR, "test_ensemble.consensus")
+    assert len(res) == len(consensus) == 1
+    assert res.iloc[0]["detected_n_times"] == 3
+    features, samples = parse_to_features_samples_ids(res.iloc[0])
+    assert features == set(range(1, 22, 2)) and samples == set(range(1, 22, 2))
+
+
+@pytest.mark.slow
+def test_sweep():
+    """Check that a sweep finds the same biclusters as separate runs."""
+    table = run_sweep(
+        os.path.join(TEST_DIR, "test_input/synthetic_clear_biclusters.tsv"),
+        param_grid={"seed": [1, 3], "pval": [0.01, 0.005], "merge": [1, 0.9]},
+        n_jobs=2,
+        out_dir=RESULTS_DIR,
+        basename="test_sweep",
+        clust_method="Louvain",
+        verbose=False,
+    )
+    res = parse_answer(RESULTS_DIR, "test_sweep.sweep")
+    assert len(res) == len(table)
+    assert sorted(set(res["param_set"])) == list(range(8))
+    reference = run_unpast_on_file(
+        filename="test_input/synthetic_clear_biclusters.tsv",
+        basename="test_sweep_reference",
+        seed=3,
+        pval=0.005,
+        merge=0.9,
+        clust_method="Louvain",
+        verbose=False,
+    )
+    res = res.loc[res["param_set"] == 7, :]
+    assert len(res) == len(reference)
+    for (_, row), (_, ref_row) in zip(res.iterrows(), reference.iterrows()):
+        assert parse_to_features_samples_ids(row) == parse_to_features_samples_ids(
+            ref_row
+        )
+
+
+@pytest.mark.slow
+def test_memory_budget():
+    """Check that the out-of-core mode finds the same biclusters as the chunked reader."""
+    kwargs = dict(
+        filename="test_input/synthetic_clear_biclusters.tsv", clust_method="Louvain"
+    )
+    res = run_unpast_on_file(basename="test_chunksize", chunksize=100, **kwargs)
+    assert res.shape[0] > 0
+    res_budget = run_unpast_on_file(
+        basename="test_memory_budget", memory_budget=1, **kwargs
+    )
+    assert res_budget.equals(res)
+
+
+@pytest.mark.slow
+def test_checkpoints(tmp_path):
+    """Check that a rerun resumes from checkpoints with the same results."""
+    kwargs = dict(
+        filename="test_input/synthetic_clear_biclusters.tsv",
+        basename="test_checkpoints",
+        clust_method="Louvain",
+        checkpoint_dir=str(tmp_path),
+    )
+    res = run_unpast_on_file(**kwargs)
+    n_checkpoints = len(os.listdir(tmp_path))
+    # checkpoints do not change the results
+    assert run_unpast_on_file(**dict(kwargs, checkpoint_dir=None)).equals(res)
+    assert run_unpast_on_file(**kwargs).equals(res)
+    assert len(os.listdir(tmp_path)) == n_checkpoints
+    # only biclusters are recomputed when merge changes
+    run_unpast_on_file(merge=0.9, **kwargs)
+    assert len(os.listdir(tmp_path)) == n_checkpoints + 1
@@ -0,0 +1,44 @@
+import numpy as np
+import pandas as pd
+from unpast.utils.bicluster_set import BiclusterSet
+
+
+def _make_biclusters():
+    genes = np.array(["g%s" % i for i in range(6)])
+    samples = np.array(["s%s" % i for i in range(8)])
+    bics = {}
+    for i, (g, s) in enumerate([([0, 1, 2], [0, 1, 2, 3]), ([2, 3], [2, 3, 4])]):
+        bics[i] = {
+            "SNR": 2.0 + i,
+            "n_genes": len(g),
+            "n_samples": len(s),
+            "genes": set(genes[g]),
+            "genes_up": set(genes[g[:1]]),
+            "genes_down": set(genes[g[1:]]),
+            "samples": set(samples[s]),
+            "gene_indexes": set(g),
+            "sample_indexes": set(s),
+        }
+    return pd.DataFrame.from_dict(bics).T, genes, samples
+
+
+def test_bicluster_set_roundtrip():
+    df, genes, samples = _make_biclusters()
+    bics = BiclusterSet.from_dataframe(df, genes, samples)
+    assert len(bics) == 2
+    assert list(bics.n_genes) == [3, 2]
+    back = bics.to_dataframe()
+    assert list(back.columns) == list(df.columns)
+    for col in df.columns:
+        assert list(back[col]) == list(df[col])
+    # subsets keep ids and metadata
+    second = bics[np.array([False, True])].to_dataframe()
+    assert list(second.index) == [1]
+    assert second.loc[1, "samples"] == {"s2", "s3", "s4"}
+
+
+def test_bicluster_set_jaccard():
+    df, genes, samples = _make_biclusters()
+    bics = BiclusterSet.from_dataframe(df, genes, samples)
+    assert np.allclose(bics.jaccard(by="samples"), [[1, 2 / 5], [2 / 5, 1]])
+    assert bics.overlaps(by="genes").toarray()[0, 1] == 1
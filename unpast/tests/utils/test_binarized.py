@@ -0,0 +1,45 @@
+import numpy as np
+import pandas as pd
+from unpast.utils.binarized import BinarizedMatrix, pack_binarized, load_binarized_matrix
+
+
+def _make_binarized(n_samples=13, n_features=5, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame(
+        (rng.random((n_samples, n_features)) < 0.3).astype(int),
+        index=["s%s" % i for i in range(n_samples)],
+        columns=["g%s" % i for i in range(n_features)],
+    )
+
+
+def test_pack_binarized():
+    df = _make_binarized()
+    packed = pack_binarized(df, directions=["UP", "DOWN", "UP", "UP", "DOWN"])
+    assert packed.shape == df.shape
+    assert packed.masks.shape == (5, 2)  # 13 samples in 2 bytes
+    assert packed.to_dense().equals(df)
+    assert (packed.values == df.values).all()
+    assert (packed.to_bool(["g3", "g1"]) == df[["g3", "g1"]].values.T.astype(bool)).all()
+
+    selected = packed.select(["g4", "g0"])
+    assert selected.to_dense().equals(df[["g4", "g0"]])
+    assert list(selected.directions) == ["DOWN", "UP"]
+    try:
+        packed.select(["g0", "x"])
+        assert False, "KeyError expected"
+    except KeyError:
+        pass
+
+
+def test_save_load_binarized(tmp_path):
+    df = _make_binarized(n_samples=16)
+    packed = pack_binarized(df, directions=["UP"] * 5)
+    fname = str(tmp_path / "test.binarized.npz")
+    packed.save(fname)
+    loaded = load_binarized_matrix(fname)
+    assert isinstance(loaded, BinarizedMatrix)
+    assert loaded.to_dense().equals(df)
+    assert list(loaded.directions) == ["UP"] * 5
+    # no directions saved
+    pack_binarized(df).save(fname)
+    assert load_binarized_matrix(fname).directions is None
@@ -0,0 +1,32 @@
+import numpy as np
+import pandas as pd
+from unpast.utils.checkpoint import (
+    get_checkpoint_fname,
+    hash_data,
+    load_checkpoint,
+    save_checkpoint,
+)
+
+
+def test_hash_data():
+    df = pd.DataFrame(np.arange(6.0).reshape(2, 3), index=["a", "b"])
+    key = hash_data(df, "kmeans", 0.01)
+    assert key == hash_data(df.copy(), "kmeans", 0.01)
+    assert key != hash_data(df, "kmeans", 0.05)
+    changed = df.copy()
+    changed.iloc[0, 0] = 0.5
+    assert key != hash_data(changed, "kmeans", 0.01)
+    assert key != hash_data(df.astype(np.float32), "kmeans", 0.01)
+
+
+def test_checkpoint_roundtrip(tmp_path):
+    df = pd.DataFrame({"x": [1.0, 2.0]})
+    save_checkpoint(str(tmp_path), "stage", "abc", (df, [1, 2]), verbose=False)
+    loaded, values = load_checkpoint(str(tmp_path), "stage", "abc", verbose=False)
+    assert loaded.equals(df) and values == [1, 2]
+    assert load_checkpoint(str(tmp_path), "stage", "other", verbose=False) is None
+
+    # an incomplete file is recomputed rather than loaded
+    with open(get_checkpoint_fname(str(tmp_path), "stage", "abc"), "wb") as f:
+        f.write(b"\x80")
+    assert load_checkpoint(str(tmp_path), "stage", "abc", verbose=False) is None
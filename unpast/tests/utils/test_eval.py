@@ -0,0 +1,57 @@
+import numpy as np
+import pandas as pd
+from scipy.stats import chi2_contingency
+from fisher import pvalue
+from unpast.utils.eval import calc_chi2_pvals, calc_fisher_pvals
+from unpast.utils.eval import find_best_matching_biclusters
+
+
+def test_calc_chi2_pvals():
+    tables = np.array([[30, 10, 12, 5000], [3, 40, 50, 6000], [0, 10, 10, 7000]])
+    expected = [chi2_contingency(t.reshape(2, 2))[1] for t in tables]
+    assert np.allclose(calc_chi2_pvals(tables), expected, rtol=1e-12)
+
+
+def test_calc_fisher_pvals():
+    tables = np.array([[3, 3, 3, 3], [100, 0, 0, 100], [5, 40, 60, 20000], [0, 0, 0, 7]])
+    left, right, two_tail = calc_fisher_pvals(*tables.T)
+    for k, t in enumerate(tables.tolist()):
+        p = pvalue(*t)
+        assert np.allclose(
+            [left[k], right[k], two_tail[k]],
+            [p.left_tail, p.right_tail, p.two_tail],
+            rtol=1e-9,
+            atol=0,
+        )
+    # chunks of tables give the same p-values
+    assert np.array_equal(calc_fisher_pvals(*tables.T, max_chunk_size=10)[1], right)
+
+
+def test_find_best_matching_biclusters():
+    def bic(genes, samples):
+        genes = set("g%s" % i for i in genes)
+        samples = set("s%s" % i for i in samples)
+        return {
+            "genes": genes,
+            "samples": samples,
+            "n_genes": len(genes),
+            "n_samples": len(samples),
+        }
+
+    bics1 = pd.DataFrame.from_dict(
+        {0: bic(range(10), range(10)), 1: bic(range(20, 30), range(40, 60))}
+    ).T
+    bics2 = pd.DataFrame.from_dict(
+        {
+            5: bic(range(25, 35), range(60, 70)),
+            6: bic(range(2, 10), range(2, 12)),
+            7: bic(range(20, 30), list(range(30)) + list(range(60, 100))),
+        }
+    ).T
+    bm = find_best_matching_biclusters(bics1, bics2, (100, 100), by="genes")
+    assert list(bm["bm_id"]) == [6, 7]
+    assert bm.loc[0, "J"] == 0.8
+    # bicluster 1 matches the complement of the large bicluster 7 by samples
+    bm = find_best_matching_biclusters(bics1, bics2, (100, 100), by="samples")
+    assert list(bm["bm_id"]) == [6, 7]
+    assert bm.loc[1, "J"] == 20 / 30
@@ -0,0 +1,97 @@
+import numpy as np
+import pandas as pd
+import pytest
+from unpast.utils.io import read_exprs_chunked, read_exprs, get_input_format
+from unpast.utils.method import prepare_input_matrix
+from unpast.utils.sparse_exprs import SparseExprs
+from unpast.utils.disk_exprs import DiskExprs
+from unpast.utils.checkpoint import hash_data
+
+
+def _write_exprs(path, n_genes=50, n_samples=20):
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame(
+        rng.normal(2, 3, size=(n_genes, n_samples)),
+        index=["g%s" % i for i in range(n_genes)],
+        columns=["s%s" % i for i in range(n_samples)],
+    )
+    df.iloc[3] = 1.0  # constant
+    df.iloc[5, :3] = np.nan
+    df.iloc[7, :18] = np.nan  # too few values
+    df.to_csv(path, sep="\t")
+    return df
+
+
+def test_read_exprs_chunked(tmp_path):
+    fname = str(tmp_path / "exprs.tsv")
+    df = _write_exprs(fname)
+    for kwargs in [dict(ceiling=3), dict(ceiling=0), dict(standradize=False)]:
+        expected = prepare_input_matrix(df, **kwargs)
+        result = read_exprs_chunked(fname, chunksize=7, **kwargs)
+        assert result.values.dtype == np.float32
+        assert list(result.index) == list(expected.index)
+        assert list(result.columns) == list(expected.columns)
+        assert np.allclose(result.values, expected.values, atol=1e-5, equal_nan=True)
+
+
+def test_read_exprs_out_of_core(tmp_path):
+    fname = str(tmp_path / "exprs.tsv")
+    _write_exprs(fname)
+    expected = read_exprs_chunked(fname, chunksize=7, ceiling=3)
+    exprs = read_exprs_chunked(fname, chunksize=7, ceiling=3, out_of_core=True)
+    assert isinstance(exprs, DiskExprs)
+    assert exprs.shape == expected.shape and list(exprs.index) == list(expected.index)
+    assert exprs.to_dense().equals(expected)
+    rows = list(exprs.iterrows())
+    assert len(rows) == expected.shape[0]
+    assert rows[10][0] == expected.index[10]
+    assert np.array_equal(rows[10][1].values, expected.iloc[10].values)
+    assert exprs.to_dense(["g9", "g2"]).equals(expected.loc[["g9", "g2"], :])
+    assert hash_data(exprs) == hash_data(read_exprs_chunked(fname, chunksize=5, ceiling=3, out_of_core=True))
+
+
+def test_get_input_format():
+    assert get_input_format("data.tsv") == "tsv"
+    assert get_input_format("data.exprs.tsv.gz") == "tsv"
+    assert get_input_format("data.Parquet") == "parquet"
+    assert get_input_format("data.arrow") == "feather"
+    assert get_input_format("data.h5") == "hdf5"
+    assert get_input_format("data.npy") == "npy"
+    assert get_input_format("data.npz") == "npz"
+    assert get_input_format("data.txt", fmt="npy") == "npy"
+
+
+def test_read_exprs_npy(tmp_path):
+    values = np.arange(12.0).reshape(3, 4)
+    np.save(tmp_path / "exprs.npy", values)
+    exprs = read_exprs(str(tmp_path / "exprs.npy"))
+    assert list(exprs.index) == [0, 1, 2] and exprs.shape == (3, 4)
+
+    (tmp_path / "exprs.rows.txt").write_text("g1\ng2\ng3\n")
+    (tmp_path / "exprs.columns.txt").write_text("s1\ns2\ns3\ns4\n")
+    exprs = read_exprs(str(tmp_path / "exprs.npy"))
+    assert list(exprs.index) == ["g1", "g2", "g3"]
+    assert list(exprs.columns) == ["s1", "s2", "s3", "s4"]
+    assert np.array_equal(exprs.values, values)
+
+
+def test_read_exprs_npz(tmp_path):
+    from scipy.sparse import csr_matrix, save_npz
+
+    values = np.array([[0, 1.5, 0, 0], [2, 0, 0, 3]])
+    save_npz(tmp_path / "exprs.npz", csr_matrix(values))
+    (tmp_path / "exprs.rows.txt").write_text("g1\ng2\n")
+    exprs = read_exprs(str(tmp_path / "exprs.npz"))
+    assert isinstance(exprs, SparseExprs)
+    assert list(exprs.index) == ["g1", "g2"] and list(exprs.columns) == [0, 1, 2, 3]
+    assert np.array_equal(exprs.to_dense().values, values)
+
+
+def test_read_exprs_parquet(tmp_path):
+    pytest.importorskip("pyarrow")
+    df = pd.DataFrame({"s1": [1.0, 2.0], "s2": [3.0, 4.0]}, index=["g1", "g2"])
+    df.to_parquet(tmp_path / "exprs.parquet")
+    assert read_exprs(str(tmp_path / "exprs.parquet")).equals(df)
+    # a table without index has feature names in the first column
+    df.reset_index().to_feather(tmp_path / "exprs.feather")
+    assert read_exprs(str(tmp_path / "exprs.feather")).equals(df)
@@ -1,6 +1,20 @@
 import pandas as pd
 import numpy as np
+import pytest
 from unpast.utils.method import zscore, prepare_input_matrix, get_trend
+from unpast.utils.method import modules2biclusters, cluster_samples
+from unpast.utils.method import update_bicluster_data, update_biclusters_data
+from unpast.utils.method import merge_biclusters, calc_bicluster_similarities
+from unpast.utils.method import match_run_pairs, binarize, make_biclusters
+from unpast.utils.method import make_consensus_biclusters
+from unpast.utils.method import histogram_2means, minibatch_2means, select_pos_neg
+from unpast.utils.method import sort_rows, ward_split_sorted, sklearn_binarization
+from unpast.utils.method import calc_kmeans_split_snr, calc_SNR, get_similarity_jaccard
+from unpast.utils.method import calc_2means_sizes
+from unpast.utils.method import get_null_sizes
+from unpast.utils.binarized import BinarizedMatrix
+from unpast.utils import method, checkpoint
+from sklearn.cluster import KMeans, AgglomerativeClustering
 
 
 def test_get_trend_single_point():
@@ -96,3 +110,483 @@ def test_get_trend_noisy():
 #     result_non_std = prepare_input_matrix(df_non_std)
 #     assert np.allclose(result_non_std.mean(), 0, atol=1e-7)
 #     assert np.allclose(result_non_std.std(), 1, atol=1e-7)
+
+
+def test_prepare_input_matrix_by_chunks():
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame(
+        rng.normal(2, 3, size=(50, 20)),
+        index=["g%s" % i for i in range(50)],
+        columns=["s%s" % i for i in range(20)],
+    )
+    df.iloc[3, :] = 1.0  # constant
+    df.iloc[5, :4] = np.nan
+    df.iloc[7, :17] = np.nan  # too few values
+    passed = df.drop(index=["g3", "g7"])
+    expected = zscore(passed).clip(-3, 3).fillna(-3)
+
+    for chunksize in [7, 10000]:
+        result = prepare_input_matrix(df, ceiling=3, chunksize=chunksize)
+        assert list(result.index) == list(expected.index)
+        assert np.allclose(result.values, expected.values, atol=1e-12)
+    assert np.isnan(df.iloc[5, 0])  # input is not changed
+
+    # a column-major float matrix without dropped rows is overwritten
+    df = pd.DataFrame(np.asfortranarray(rng.normal(2, 3, size=(50, 20))))
+    expected = zscore(df)
+    result = prepare_input_matrix(df, inplace=True, chunksize=7)
+    assert np.allclose(result.values, expected.values, atol=1e-12)
+    assert np.shares_memory(result.values, df.values)
+    assert np.allclose(df.values, expected.values, atol=1e-12)
+
+
+def _make_modules_data(n_genes=40, n_samples=60, seed=0):
+    rng = np.random.default_rng(seed)
+    data = pd.DataFrame(
+        rng.normal(size=(n_genes, n_samples)),
+        index=["g%s" % i for i in range(n_genes)],
+        columns=["s%s" % i for i in range(n_samples)],
+    )
+    # implant four biclusters of 10 genes
+    for k in range(4):
+        data.iloc[k * 10 : (k + 1) * 10, k * 5 : k * 5 + 10 + k] += 3
+    modules = [list(data.index.values[k * 10 : (k + 1) * 10]) for k in range(4)]
+    return data, modules
+
+
+@pytest.fixture
+def binarize_inputs():
+    """Standardized _make_modules_data() and common binarize() arguments."""
+    data, modules = _make_modules_data()
+    exprs = prepare_input_matrix(data, ceiling=3)
+    kwargs = dict(
+        min_n_samples=5,
+        plot_all=False,
+        verbose=False,
+        seed=1,
+        n_permutations=1000,
+    )
+    return exprs, kwargs
+
+
+def test_modules2biclusters_parallel_matches_serial():
+    data, modules = _make_modules_data()
+    serial = modules2biclusters(modules, data, min_n_samples=5, seed=1, verbose=False)
+    parallel = modules2biclusters(
+        modules, data, min_n_samples=5, seed=1, verbose=False, n_jobs=2
+    )
+    assert serial == parallel
+    assert len(serial) == 4
+
+
+def test_cluster_samples_warm_start():
+    data, modules = _make_modules_data()
+    subspace = data.loc[modules[1], :].T
+    full = cluster_samples(subspace, min_n_samples=5, seed=1)
+    # a noisy majority vote still converges to the same split
+    init_mask = np.zeros(data.shape[1], dtype=bool)
+    init_mask[5:13] = True
+    init_mask[30] = True
+    warm = cluster_samples(subspace, min_n_samples=5, seed=1, init_mask=init_mask)
+    assert warm == full
+    assert warm["sample_indexes"] == set(range(5, 16))
+    # float32 subspaces are clustered without conversion to float64
+    warm32 = cluster_samples(
+        subspace.astype(np.float32), min_n_samples=5, seed=1, init_mask=init_mask
+    )
+    assert warm32["sample_indexes"] == warm["sample_indexes"]
+    # an empty warm start falls back to the multi-start KMeans
+    empty = np.zeros(data.shape[1], dtype=bool)
+    assert cluster_samples(subspace, min_n_samples=5, seed=1, init_mask=empty) == full
+
+
+def test_update_biclusters_data():
+    data, modules = _make_modules_data()
+    # down-regulate a part of the first bicluster
+    data.iloc[:3, :] *= -1
+    biclusters = {
+        k: {
+            "genes": set(genes),
+            "n_genes": len(genes),
+            "sample_indexes": set(range(k * 5, k * 5 + 10 + k)),
+        }
+        for k, genes in enumerate(modules)
+    }
+    single = {k: update_bicluster_data(dict(bic), data) for k, bic in biclusters.items()}
+    batch = update_biclusters_data({k: dict(b) for k, b in biclusters.items()}, data)
+    approx = update_biclusters_data(
+        {k: dict(b) for k, b in biclusters.items()}, data, exact=False, max_chunk_size=1
+    )
+    assert batch == single
+    assert single[0]["genes_down"] == {"g0", "g1", "g2"}
+    assert single[1]["samples"] == set(data.columns[5:16])
+    for k in biclusters:
+        assert approx[k]["genes_up"] == single[k]["genes_up"]
+        assert np.isclose(approx[k]["SNR"], single[k]["SNR"])
+    # float32 rows are upcast per bicluster as the whole matrix was before
+    data32 = data.astype(np.float32)
+    batch32 = update_biclusters_data({k: dict(b) for k, b in biclusters.items()}, data32)
+    upcast = update_biclusters_data(
+        {k: dict(b) for k, b in biclusters.items()}, data32.astype(np.float64)
+    )
+    assert batch32 == upcast
+
+
+def test_merge_biclusters():
+    data, modules = _make_modules_data()
+    # parts of the same module find the same sample sets
+    parts = [modules[0][:5], modules[0][5:], modules[1][:4], modules[1][4:7]]
+    parts += [modules[1][7:], modules[2], modules[3]]
+    biclusters = modules2biclusters(parts, data, min_n_samples=5, seed=1, verbose=False)
+    merged = merge_biclusters(
+        {k: dict(b) for k, b in biclusters.items()}, data, J=0.8, seed=1, verbose=False
+    )
+    assert sorted(merged.keys()) == [0, 2, 5, 6]
+    assert merged[0]["genes"] == set(modules[0])
+    assert merged[2]["genes"] == set(modules[1])
+    assert merged[2]["sample_indexes"] == set(range(5, 16))
+    parallel = merge_biclusters(
+        {k: dict(b) for k, b in biclusters.items()},
+        data,
+        J=0.8,
+        seed=1,
+        verbose=False,
+        n_jobs=2,
+    )
+    assert parallel == merged
+
+
+def test_calc_bicluster_similarities():
+    data, modules = _make_modules_data(n_genes=200, n_samples=100)
+    genes = data.index.values
+    samples = data.columns.values
+    biclusters = pd.DataFrame.from_dict(
+        {
+            "a": {"genes": set(genes[:20]), "samples": set(samples[:30])},
+            "b": {"genes": set(genes[5:25]), "samples": set(samples[80:85])},
+            "c": {"genes": set(genes[100:110]), "samples": set(samples[:25])},
+        }
+    ).T
+    J = calc_bicluster_similarities(biclusters, data, similarity="genes", plot=False)
+    assert list(J.index) == ["a", "b", "c"]
+    assert np.allclose(J.values, [[1, 15 / 25, 0], [15 / 25, 1, 0], [0, 0, 1]])
+    J = calc_bicluster_similarities(biclusters, data, similarity="samples", plot=False)
+    assert J.loc["c", "a"] == J.loc["a", "c"] == 25 / 30
+    # "both" requires shared genes and samples
+    J = calc_bicluster_similarities(biclusters, data, similarity="both", plot=False)
+    assert np.array_equal(J.values, np.identity(3))
+
+
+def test_match_run_pairs_parallel_matches_serial():
+    data, modules = _make_modules_data()
+    runs = []
+    for run, seed in enumerate([1, 2, 3]):
+        biclusters = modules2biclusters(
+            modules[run:], data, min_n_samples=5, seed=seed, verbose=False
+        )
+        biclusters = update_biclusters_data(biclusters, data)
+        biclusters = pd.DataFrame.from_dict(biclusters).T
+        biclusters.index = ["r%s_%s" % (run, i) for i in biclusters.index]
+        biclusters["run"] = run
+        runs.append(biclusters)
+    biclusters = pd.concat(runs)
+    pairs = [(0, 1), (1, 0), (2, 0)]
+    serial = match_run_pairs(biclusters, pairs, data.shape, "samples", 2, 0.05)
+    parallel = match_run_pairs(
+        biclusters, pairs, data.shape, "samples", 2, 0.05, n_jobs=2
+    )
+    assert len(serial) == len(parallel) == 3
+    for bm1, bm2 in zip(serial, parallel):
+        pd.testing.assert_frame_equal(bm1, bm2)
+    # module 1 is found in runs 0 and 1
+    assert serial[0].loc["r0_1", "bm_id"] == "r1_0"
+
+
+def test_make_consensus_biclusters():
+    clustering = pytest.importorskip("sknetwork.clustering")
+    if not hasattr(clustering, "modularity"):
+        pytest.skip("run_Louvain() requires sknetwork.clustering.modularity")
+    data, modules = _make_modules_data()
+    runs = []
+    for run in range(3):
+        # each run misses one gene of every module
+        run_modules = [m[:run] + m[run + 1 :] for m in modules]
+        biclusters = modules2biclusters(
+            run_modules, data, min_n_samples=5, seed=1, verbose=False
+        )
+        biclusters = update_biclusters_data(biclusters, data)
+        # bicluster ids 0-3 are the same in all runs
+        runs.append(pd.DataFrame.from_dict(biclusters).T)
+    consensus = make_consensus_biclusters(
+        runs, data, frac_runs=1, seed=1, verbose=False
+    )
+    assert consensus.shape[0] == 4
+    for k, module in enumerate(modules):
+        # genes found in all three runs
+        bic = consensus.loc[consensus["genes"] == set(module[3:]), :]
+        assert bic.shape[0] == 1
+        assert bic["samples"].values[0] == set(data.columns[k * 5 : k * 5 + 10 + k])
+        assert bic["detected_n_times"].values[0] == 3
+        assert bic["ids"].values[0] == {k}
+
+
+def test_get_null_sizes():
+    assert list(get_null_sizes(20, 5)) == list(range(5, 11))
+    sizes = get_null_sizes(10000, 5)
+    assert sizes[0] == 5 and sizes[-1] <= 5000
+    assert len(sizes) <= 102 and (np.diff(sizes) == 49).all()
+
+
+def test_binarize_cache(tmp_path, binarize_inputs):
+    exprs, kwargs = binarize_inputs
+    kwargs.update(method="kmeans", pval=0.05)
+    prefix = str(tmp_path / "test")
+    binarized, stats, _ = binarize(prefix, exprs=exprs, save=True, **kwargs)
+    cached = list(tmp_path.glob("test.binarization.*.npz"))
+    assert len(cached) == 1
+    assert list(tmp_path.glob("*.binarized.tsv"))
+
+    loaded, loaded_stats, _ = binarize(prefix, exprs=exprs, load=True, save=False, **kwargs)
+    assert loaded.equals(binarized)
+    assert loaded_stats[["SNR", "size", "direction"]].equals(
+        stats[["SNR", "size", "direction"]]
+    )
+
+    # changed input does not match the cache
+    changed = exprs.copy()
+    changed.iloc[:10, :20] = -changed.iloc[:10, :20]
+    binarize(prefix, exprs=changed, save=True, **kwargs)
+    assert len(list(tmp_path.glob("test.binarization.*.npz"))) == 2
+
+
+def test_binarize_sorted_rows_cache(tmp_path, monkeypatch, binarize_inputs):
+    exprs, kwargs = binarize_inputs
+    kwargs.update(method="ward", pval=0.05)
+    del kwargs["seed"]
+    prefix = str(tmp_path / "test")
+    binarized, _, _ = binarize(prefix, exprs=exprs, save=True, seed=1, **kwargs)
+    assert len(list(tmp_path.glob("test.sorted_rows.*.npy"))) == 1
+    # binarization with another seed does not sort rows again
+    monkeypatch.setattr(method, "sort_rows", lambda *args: pytest.fail("rows sorted again"))
+    binarized2, _, _ = binarize(prefix, exprs=exprs, load=True, save=False, seed=2, **kwargs)
+    assert binarized2.equals(binarized)
+
+
+def test_binarize_methods(tmp_path, monkeypatch, binarize_inputs):
+    exprs, kwargs = binarize_inputs
+    kwargs.update(pval=0.05)
+    methods = ["kmeans", "ward", "GMM"]
+    prefix = str(tmp_path / "test")
+    # the input matrix is hashed once for all cache names
+    hashed = []
+    hash_data = checkpoint.hash_data
+    monkeypatch.setattr(
+        checkpoint, "hash_data", lambda *parts: hashed.append(parts) or hash_data(*parts)
+    )
+    results = binarize(prefix, exprs=exprs, method=methods, save=True, **kwargs)
+    assert sum(part is exprs for parts in hashed for part in parts) == 1
+    assert list(results.keys()) == methods
+    for method_name in methods:
+        binarized, stats, null = binarize("", exprs=exprs, method=method_name, save=False, **kwargs)
+        assert results[method_name][0].equals(binarized)
+        assert results[method_name][1].equals(stats)
+        assert results[method_name][2].loc[null.index].equals(null)
+    # each method is cached separately
+    assert len(list(tmp_path.glob("test.binarization.*.npz"))) == 3
+    loaded = binarize(prefix, exprs=exprs, method=["ward"], load=True, save=False, **kwargs)
+    assert loaded["ward"][0].equals(results["ward"][0])
+
+
+def test_calc_kmeans_split_snr():
+    rng = np.random.default_rng(0)
+    N = 100
+    rows = np.vstack([rng.normal(size=(20, N)), np.round(rng.normal(size=(20, N)))])
+    rows[:10, :15] += 3
+    split_sizes, split_snr = calc_kmeans_split_snr(np.sort(rows, axis=1))
+    for row, sizes, snr in zip(rows, split_sizes, split_snr):
+        for seed in range(3):
+            row_snr, size = select_pos_neg(row, 3, seed=seed, method="kmeans")[2:4]
+            if not np.isnan(size):
+                # the split found by 'kmeans' is one of the splits
+                assert np.isclose(snr[sizes == size], row_snr, rtol=1e-6).any()
+
+
+def test_calc_2means_sizes():
+    rng = np.random.default_rng(0)
+    rows = rng.normal(size=(10, 100))
+    rows[:5, :15] += 4
+    rows[5:, :20] -= 4
+    rows = np.sort(np.vstack([rows, np.zeros((1, 100))]), axis=1)
+    sizes = calc_2means_sizes(rows, 5)
+    for row, size in zip(rows[:10], sizes):
+        # the split with minimal SSE, the smaller group, values of its median sign
+        splits = [np.arange(100) < j for j in range(1, 100)]
+        lower = min(splits, key=lambda labels: method.calc_split_sse(row, labels))
+        group = row[lower] if lower.sum() <= 50 else row[~lower]
+        expected = (group >= 0).sum() if np.median(group) >= 0 else (group <= 0).sum()
+        assert size == expected
+    assert sizes[-1] == 0  # constant rows are not split
+
+
+def test_binarize_prescreen():
+    data, _ = _make_modules_data(n_genes=200, n_samples=500)
+    exprs = prepare_input_matrix(data, ceiling=3)
+    kwargs = dict(
+        method="kmeans",
+        min_n_samples=5,
+        pval=0.01,
+        n_permutations=1000,
+        seed=1,
+        save=False,
+        plot_all=False,
+        verbose=False,
+    )
+    binarized, stats, _ = binarize("", exprs=exprs, **kwargs)
+    binarized2, stats2, _ = binarize("", exprs=exprs, prescreen=True, **kwargs)
+    skipped = stats2["prescreened"].astype(bool)
+    assert skipped.sum() > 0
+    # the same features pass with and without the pre-screen
+    assert binarized2.equals(binarized)
+    # skipped features would not pass the SNR threshold
+    skipped, passed = skipped.index[skipped], skipped.index[~skipped]
+    assert (stats.loc[skipped, "SNR"] <= stats.loc[skipped, "SNR_threshold"]).all()
+    assert (stats2.loc[skipped, "pval"] == 1).all()
+    cols = ["SNR", "size", "direction", "pval", "SNR_threshold"]
+    assert stats2.loc[passed, cols].equals(stats.loc[passed, cols])
+
+
+def test_binarize_packed(tmp_path, binarize_inputs):
+    exprs, kwargs = binarize_inputs
+    kwargs.update(method="kmeans", pval=0.01)
+    binarized, stats, _ = binarize("", exprs=exprs, save=False, **kwargs)
+    prefix = str(tmp_path / "packed")
+    packed, stats2, _ = binarize(prefix, exprs=exprs, save=True, packed=True, **kwargs)
+    assert isinstance(packed, BinarizedMatrix)
+    assert stats2.equals(stats)
+    assert packed.to_dense().equals(binarized)
+    assert list(packed.directions) == list(stats.loc[packed.columns, "direction"])
+    # packed binarized features are loaded from the .npz file
+    loaded, _, _ = binarize(prefix, exprs=exprs, load=True, packed=True, **kwargs)
+    assert (loaded.masks == packed.masks).all()
+    assert list(loaded.columns) == list(packed.columns)
+    assert np.allclose(
+        get_similarity_jaccard(packed, verbose=False),
+        get_similarity_jaccard(binarized, verbose=False),
+    )
+
+
+def test_float32_matches_float64():
+    """float32 mode changes statistics by less than 1e-4 and keeps biclusters."""
+    data, modules = _make_modules_data()
+    results = {}
+    for dtype in [np.float64, np.float32]:
+        exprs = prepare_input_matrix(data, ceiling=3, dtype=dtype)
+        binarized, stats, null = binarize(
+            "",
+            exprs=exprs,
+            method="kmeans",
+            save=False,
+            min_n_samples=5,
+            pval=0.05,
+            plot_all=False,
+            verbose=False,
+            seed=1,
+            n_permutations=1000,
+        )
+        assert exprs.values.dtype == dtype and null.values.dtype == dtype
+        passed = [[g for g in m if g in binarized.columns] for m in modules]
+        biclusters = make_biclusters(
+            [m for m in passed if len(m) > 1],
+            binarized,
+            exprs,
+            null,
+            min_n_samples=5,
+            seed=1,
+            verbose=False,
+        )
+        results[dtype] = stats, null, biclusters
+
+    stats64, null64, bics64 = results[np.float64]
+    stats32, null32, bics32 = results[np.float32]
+    assert np.abs(null64.values - null32.values).max() < 1e-4
+    assert np.abs(stats64["SNR"].values - stats32["SNR"].values).max() < 1e-4
+    assert list(stats64["pval"] <= 0.05) == list(stats32["pval"] <= 0.05)
+    assert len(bics64) == len(bics32) > 0
+    for col in ["genes", "samples"]:
+        assert list(bics64[col]) == list(bics32[col])
+    assert np.abs(bics64["SNR"].values - bics32["SNR"].values).max() < 1e-4
+
+
+def test_histogram_2means():
+    rng = np.random.default_rng(0)
+    row = np.concatenate([rng.normal(size=4000), rng.normal(4, 1, size=400)])
+    labels = histogram_2means(row, seed=1)
+    kmeans_labels = KMeans(n_clusters=2, n_init=1, random_state=1).fit_predict(row[:, None])
+    assert max((labels == kmeans_labels).mean(), (labels != kmeans_labels).mean()) > 0.99
+    # the quality check rejects any split if no deviation is allowed
+    assert histogram_2means(row, seed=1, n_bins=2, tol=-0.5) is None
+
+
+def test_histogram_2means_sorted():
+    rng = np.random.default_rng(0)
+    row = np.concatenate([rng.normal(size=4000), rng.normal(4, 1, size=400)])
+    labels = histogram_2means(row, seed=1, order=np.argsort(row))
+    # the exact split is at the midpoint of the centers
+    threshold = (row[labels].mean() + row[~labels].mean()) / 2
+    assert (labels == (row >= threshold)).all()
+    assert (labels == histogram_2means(row, seed=1)).mean() > 0.99
+
+
+def test_ward_split_sorted():
+    rng = np.random.default_rng(0)
+    for _ in range(20):
+        row = np.sort(np.concatenate([rng.normal(size=50), rng.normal(3, 1, size=10)]))
+        labels = AgglomerativeClustering(n_clusters=2, linkage="ward").fit_predict(row[:, None])
+        n_lower = (labels == labels[0]).sum()
+        assert ward_split_sorted(row) == n_lower
+        assert (labels[:n_lower] == labels[0]).all()
+    # equal merge costs
+    assert ward_split_sorted(np.array([0.0, 1.0, 2.0, 3.0])) is None
+    # outdated pairs with equal costs do not cause a fallback
+    row = np.array([1.0, 2.0, 2.0, 2.0, 3.0, 4.0, 4.0, 5.0, 5.0])
+    labels = AgglomerativeClustering(n_clusters=2, linkage="ward").fit_predict(row[:, None])
+    assert ward_split_sorted(row) == (labels == labels[0]).sum() == 4
+
+
+def test_sort_rows():
+    rng = np.random.default_rng(0)
+    exprs = pd.DataFrame(rng.normal(size=(30, 40)))
+    order = sort_rows(exprs, chunksize=7)
+    assert order.dtype == np.uint16
+    assert (order == np.argsort(exprs.values, axis=1, kind="stable")).all()
+    for method_name in ["ward", "kmeans"]:
+        expected = sklearn_binarization(exprs, 5, verbose=False, plot=False, method=method_name)
+        result = sklearn_binarization(
+            exprs, 5, verbose=False, plot=False, method=method_name, sorted_rows=order
+        )
+        assert expected[0].equals(result[0])
+        assert expected[1].equals(result[1])
+
+
+def test_select_pos_neg_by_histogram(monkeypatch):
+    rng = np.random.default_rng(0)
+    row = np.concatenate([rng.normal(size=1800), rng.normal(4, 1, size=200)])
+    expected = select_pos_neg(row, 5, seed=1, method="kmeans")
+    monkeypatch.setattr(method, "HISTOGRAM_MIN_SAMPLES", 1000)
+    result = select_pos_neg(row, 5, seed=1, method="kmeans")
+    assert (result[0] != expected[0]).sum() <= 5
+    assert abs(result[2] - expected[2]) < 0.05
+
+
+def test_minibatch_2means(monkeypatch):
+    rng = np.random.default_rng(0)
+    data = rng.normal(size=(3000, 5))
+    data[:300] += 3
+    labels = minibatch_2means(data, seed=0)
+    kmeans_labels = KMeans(n_clusters=2, n_init=10, random_state=0).fit_predict(data)
+    assert max((labels == kmeans_labels).mean(), (labels != kmeans_labels).mean()) > 0.99
+    assert minibatch_2means(data, seed=0, tol=-0.5) is None
+
+    expected = cluster_samples(data, seed=0)
+    monkeypatch.setattr(method, "MINIBATCH_MIN_SAMPLES", 1000)
+    assert cluster_samples(data, seed=0) == expected
@@ -0,0 +1,128 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.sparse import csr_matrix
+from unpast.run_unpast import run, run_ensemble, run_sweep
+from unpast.utils.method import prepare_input_matrix, binarize, make_biclusters
+from unpast.utils.sparse_exprs import SparseExprs, calc_sparse_row_moments
+
+
+def _make_sparse_data(n_genes=60, n_samples=200, seed=0):
+    # mostly zeros; genes 1-10 are high in samples 0-29
+    rng = np.random.default_rng(seed)
+    values = (rng.random((n_genes, n_samples)) < 0.2) * rng.lognormal(
+        size=(n_genes, n_samples)
+    )
+    values[1:11, :30] += rng.lognormal(2, size=(10, 30))
+    values[0] = 0  # constant
+    values[20, :] = 0
+    values[20, :3] = 1  # too few non-zero values
+    return pd.DataFrame(
+        values,
+        index=["g%s" % i for i in range(n_genes)],
+        columns=["s%s" % i for i in range(n_samples)],
+    )
+
+
+def test_calc_sparse_row_moments():
+    df = _make_sparse_data()
+    means, stds = calc_sparse_row_moments(csr_matrix(df.values))
+    assert np.allclose(means, df.mean(axis=1).values)
+    assert np.allclose(stds, df.std(axis=1).values)
+
+
+def test_prepare_sparse_matrix():
+    df = _make_sparse_data()
+    exprs = SparseExprs(csr_matrix(df.values), index=df.index, columns=df.columns)
+    prepared = prepare_input_matrix(exprs, ceiling=3)
+    assert isinstance(prepared, SparseExprs)
+    assert prepared.values.nnz == exprs.values.nnz - 3
+    assert "g0" not in prepared.index and "g20" not in prepared.index
+    expected = prepare_input_matrix(df.drop(index="g20"), ceiling=3)
+    dense = prepared.to_dense()
+    assert list(dense.index) == list(expected.index)
+    assert np.allclose(dense.values, expected.values)
+    rows = list(prepared.iterrows())
+    assert [name for name, _ in rows] == list(expected.index)
+    assert np.allclose(rows[5][1].values, expected.iloc[5].values)
+    # z-scores are kept when a prepared matrix is prepared again
+    assert prepare_input_matrix(prepared, standradize=False) is prepared
+
+
+def test_sparse_biclusters_match_dense():
+    df = _make_sparse_data().drop(index="g20")
+    sparse = SparseExprs(csr_matrix(df.values), index=df.index, columns=df.columns)
+    kwargs = dict(
+        method="kmeans",
+        save=False,
+        min_n_samples=5,
+        pval=0.01,
+        plot_all=False,
+        verbose=False,
+        seed=1,
+        n_permutations=1000,
+    )
+    results = []
+    for data in [df, sparse]:
+        exprs = prepare_input_matrix(data, ceiling=3)
+        binarized, stats, null = binarize("unused", exprs=exprs, **kwargs)
+        modules = [["g%s" % i for i in range(1, 11)]]
+        biclusters = make_biclusters(
+            modules, binarized, exprs, null, min_n_samples=5, seed=1, verbose=False
+        )
+        results.append((binarized, biclusters))
+
+    (bin_dense, bics_dense), (bin_sparse, bics_sparse) = results
+    assert bin_dense.equals(bin_sparse)
+    assert len(bics_dense) == len(bics_sparse) == 1
+    for col in ["genes", "samples", "gene_indexes", "sample_indexes"]:
+        assert bics_dense.loc[0, col] == bics_sparse.loc[0, col]
+    assert bics_dense.loc[0, "gene_indexes"] == set(range(0, 10))
+    assert np.isclose(bics_dense.loc[0, "SNR"], bics_sparse.loc[0, "SNR"])
+
+
+def _require_louvain():
+    clustering = pytest.importorskip("sknetwork.clustering")
+    if not hasattr(clustering, "modularity"):
+        pytest.skip("run_Louvain() requires sknetwork.clustering.modularity")
+
+
+def test_sparse_run_matches_dense(tmp_path):
+    _require_louvain()
+    df = _make_sparse_data()
+    sparse = SparseExprs(csr_matrix(df.values), index=df.index, columns=df.columns)
+    kwargs = dict(out_dir=str(tmp_path), save=False, clust_method="Louvain", seed=1)
+    # default verbosity
+    bics_sparse = run(sparse, basename="sparse", **kwargs)
+    bics_dense = run(df, basename="dense", verbose=False, **kwargs)
+    assert bics_sparse.shape[0] == bics_dense.shape[0] > 0
+    for col in ["genes", "samples", "gene_indexes"]:
+        assert list(bics_sparse[col]) == list(bics_dense[col])
+
+
+def test_sparse_run_ensemble(tmp_path):
+    _require_louvain()
+    df = _make_sparse_data()
+    sparse = SparseExprs(csr_matrix(df.values), index=df.index, columns=df.columns)
+    kwargs = dict(
+        seeds=[1, 2], out_dir=str(tmp_path), save=False, clust_method="Louvain", verbose=False
+    )
+    consensus, results = run_ensemble(sparse, basename="sparse", **kwargs)
+    expected, _ = run_ensemble(df, basename="dense", **kwargs)
+    assert consensus.shape[0] == expected.shape[0] > 0
+    for col in ["genes", "samples", "gene_indexes"]:
+        assert list(consensus[col]) == list(expected[col])
+
+
+def test_sparse_run_sweep(tmp_path):
+    _require_louvain()
+    df = _make_sparse_data()
+    sparse = SparseExprs(csr_matrix(df.values), index=df.index, columns=df.columns)
+    kwargs = dict(
+        param_grid={"seed": [1, 2]}, out_dir=str(tmp_path), clust_method="Louvain", verbose=False
+    )
+    table = run_sweep(sparse, basename="sparse", **kwargs)
+    expected = run_sweep(df, basename="dense", **kwargs)
+    assert table.shape[0] == expected.shape[0] > 0
+    for col in ["param_set", "genes", "samples", "gene_indexes"]:
+        assert list(table[col]) == list(expected[col])
@@ -0,0 +1,207 @@
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+
+
+class BiclusterSet:
+    """Compact collection of biclusters.
+
+    Membership is stored as sparse CSR incidence matrices
+    (biclusters x genes and biclusters x samples) over fixed gene and sample
+    name arrays; all other bicluster attributes (SNR, e_pval, direction, ...)
+    are kept as one array per column.
+    Use from_dataframe() and to_dataframe() to convert from and to the
+    DataFrame of sets returned by make_biclusters() and read_bic_table().
+    """
+
+    __slots__ = (
+        "index",
+        "gene_names",
+        "sample_names",
+        "genes",
+        "genes_up",
+        "samples",
+        "metadata",
+        "columns",
+    )
+
+    # columns derived from the incidence matrices
+    _set_columns = [
+        "genes",
+        "genes_up",
+        "genes_down",
+        "samples",
+        "gene_indexes",
+        "sample_indexes",
+        "n_genes",
+        "n_samples",
+    ]
+
+    def __init__(
+        self,
+        genes,
+        samples,
+        gene_names,
+        sample_names,
+        index=None,
+        genes_up=None,
+        metadata=None,
+        columns=None,
+    ):
+        self.genes = csr_matrix(genes, dtype=bool)
+        self.samples = csr_matrix(samples, dtype=bool)
+        self.genes_up = None if genes_up is None else csr_matrix(genes_up, dtype=bool)
+        self.gene_names = np.asarray(gene_names, dtype=object)
+        self.sample_names = np.asarray(sample_names, dtype=object)
+        n_bics = self.genes.shape[0]
+        if self.samples.shape[0] != n_bics:
+            raise ValueError("gene and sample incidence matrices differ in length")
+        self.index = np.arange(n_bics) if index is None else np.asarray(index)
+        self.metadata = {} if metadata is None else dict(metadata)
+        if columns is None:
+            columns = ["genes", "samples", "gene_indexes", "sample_indexes"]
+            columns += ["n_genes", "n_samples"]
+            if self.genes_up is not None:
+                columns += ["genes_up", "genes_down"]
+            columns += list(self.metadata.keys())
+        self.columns = list(columns)
+
+    @classmethod
+    def from_dataframe(cls, biclusters, gene_names=None, sample_names=None):
+        """Builds a BiclusterSet from a DataFrame of biclusters.
+
+        gene_names and sample_names are usually data.index and data.columns;
+        then the gene and sample indexes of the biclusters are preserved.
+        If not given, sorted unions of bicluster genes (samples) are used.
+        """
+        genes = _names_column(biclusters, "genes", gene_names)
+        samples = _names_column(biclusters, "samples", sample_names)
+        if gene_names is None:
+            gene_names = sorted(set().union(*genes))
+        if sample_names is None:
+            sample_names = sorted(set().union(*samples))
+        gene_names = np.asarray(gene_names, dtype=object)
+        sample_names = np.asarray(sample_names, dtype=object)
+        n_bics = biclusters.shape[0]
+        genes_up = None
+        if "genes_up" in biclusters.columns:
+            genes_up = _incidence_matrix(biclusters["genes_up"], gene_names, n_bics)
+        metadata = {
+            col: biclusters[col].values.copy()
+            for col in biclusters.columns
+            if col not in cls._set_columns
+        }
+        return cls(
+            _incidence_matrix(genes, gene_names, n_bics),
+            _incidence_matrix(samples, sample_names, n_bics),
+            gene_names,
+            sample_names,
+            index=biclusters.index.values,
+            genes_up=genes_up,
+            metadata=metadata,
+            columns=biclusters.columns,
+        )
+
+    def to_dataframe(self):
+        """Returns biclusters as a DataFrame of sets, as make_biclusters() does."""
+        gene_indexes = _row_indexes(self.genes)
+        sample_indexes = _row_indexes(self.samples)
+        columns = {
+            "genes": [set(self.gene_names[ndx]) for ndx in gene_indexes],
+            "samples": [set(self.sample_names[ndx]) for ndx in sample_indexes],
+            "gene_indexes": [set(ndx.tolist()) for ndx in gene_indexes],
+            "sample_indexes": [set(ndx.tolist()) for ndx in sample_indexes],
+            "n_genes": self.n_genes,
+            "n_samples": self.n_samples,
+        }
+        if self.genes_up is not None:
+            up = [set(self.gene_names[ndx]) for ndx in _row_indexes(self.genes_up)]
+            columns["genes_up"] = up
+            columns["genes_down"] = [
+                genes.difference(genes_up) for genes, genes_up in zip(columns["genes"], up)
+            ]
+        columns.update(self.metadata)
+        df = pd.DataFrame(
+            {col: columns[col] for col in self.columns if col in columns},
+            index=self.index,
+        )
+        if len(df) == 0:
+            df = df.astype(object)
+        return df
+
+    def __len__(self):
+        return self.genes.shape[0]
+
+    def __getitem__(self, rows):
+        """Selects biclusters by positions, a boolean mask or a slice."""
+        rows = np.arange(len(self))[rows]
+        return BiclusterSet(
+            self.genes[rows],
+            self.samples[rows],
+            self.gene_names,
+            self.sample_names,
+            index=self.index[rows],
+            genes_up=None if self.genes_up is None else self.genes_up[rows],
+            metadata={col: values[rows] for col, values in self.metadata.items()},
+            columns=self.columns,
+        )
+
+    def copy(self):
+        return self[:]
+
+    @property
+    def n_genes(self):
+        return self.genes.getnnz(axis=1)
+
+    @property
+    def n_samples(self):
+        return self.samples.getnnz(axis=1)
+
+    def overlaps(self, other=None, by="samples"):
+        """Sparse matrix of shared genes or samples between biclusters
+        of this and other set (or of this set with itself)."""
+        other = self if other is None else other
+        a = getattr(self, by).astype(np.int32)
+        b = getattr(other, by).astype(np.int32)
+        return a.dot(b.T).tocsr()
+
+    def jaccard(self, other=None, by="samples"):
+        """Dense matrix of Jaccard similarities of genes or samples."""
+        other = self if other is None else other
+        shared = self.overlaps(other, by=by).toarray()
+        sizes1 = getattr(self, by).getnnz(axis=1)
+        sizes2 = getattr(other, by).getnnz(axis=1)
+        union = sizes1[:, np.newaxis] + sizes2[np.newaxis, :] - shared
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(union > 0, shared / union, 0.0)
+
+
+def _names_column(biclusters, col, names):
+    # sets of names; falls back to the *_indexes column if names are known
+    if col in biclusters.columns:
+        return list(biclusters[col].values)
+    if names is not None and col[:-1] + "_indexes" in biclusters.columns:
+        names = np.asarray(names, dtype=object)
+        return [set(names[list(x)]) for x in biclusters[col[:-1] + "_indexes"]]
+    raise KeyError(col)
+
+
+def _incidence_matrix(sets, names, n_rows):
+    # the first occurrence of a name wins, as in update_bicluster_data()
+    name_ndx = {}
+    for i, name in enumerate(names):
+        name_ndx.setdefault(name, i)
+    rows, cols = [], []
+    for i, members in enumerate(sets):
+        ndx = [name_ndx[x] for x in members]
+        rows += [i] * len(ndx)
+        cols += ndx
+    m = csr_matrix(
+        (np.ones(len(rows), dtype=bool), (rows, cols)), shape=(n_rows, len(names))
+    )
+    m.sort_indices()
+    return m
+
+
+def _row_indexes(m):
+    return [m.indices[m.indptr[i] : m.indptr[i + 1]] for i in range(m.shape[0])]
@@ -0,0 +1,101 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+
+class BinarizedMatrix:
+    """Samples x features binarized data stored as bit-packed masks.
+
+    Each feature is a row of masks with n_samples bits packed into bytes
+    (1 bit per value instead of 8 bytes of an int64 DataFrame); directions
+    are optional "UP"/"DOWN" labels of features.
+    Implements the part of the DataFrame interface used by the clustering
+    stage: shape, index (samples), columns (features) and values;
+    select() subsets features without unpacking them, to_bool() unpacks
+    masks of features, to_dense() returns a DataFrame of 0/1 values.
+    """
+
+    __slots__ = ("masks", "n_samples", "index", "columns", "directions")
+
+    def __init__(self, masks, n_samples, index=None, columns=None, directions=None):
+        self.masks = np.asarray(masks, dtype=np.uint8)
+        self.n_samples = int(n_samples)
+        n_features, n_bytes = self.masks.shape
+        if n_bytes != (self.n_samples + 7) // 8:
+            raise ValueError("masks do not match the number of samples")
+        self.index = pd.Index(range(self.n_samples) if index is None else index)
+        self.columns = pd.Index(range(n_features) if columns is None else columns)
+        if len(self.index) != self.n_samples or len(self.columns) != n_features:
+            raise ValueError("sample or feature names do not match the matrix shape")
+        self.directions = None if directions is None else np.asarray(directions, dtype=object)
+
+    @property
+    def shape(self):
+        return self.n_samples, self.masks.shape[0]
+
+    @property
+    def values(self):
+        """Unpacked samples x features array of 0/1 values (uint8)."""
+        return self.to_bool().T.astype(np.uint8)
+
+    def select(self, features):
+        """Returns a BinarizedMatrix of features with given names."""
+        ndx = self.columns.get_indexer(features)
+        if (ndx < 0).any():
+            raise KeyError("features not found: %s" % list(np.array(features)[ndx < 0]))
+        return BinarizedMatrix(
+            self.masks[ndx],
+            self.n_samples,
+            index=self.index,
+            columns=self.columns.values[ndx],
+            directions=None if self.directions is None else self.directions[ndx],
+        )
+
+    def to_bool(self, features=None):
+        """Returns features x samples boolean masks of features (all by default)."""
+        masks = self.masks if features is None else self.masks[self.columns.get_indexer(features)]
+        return np.unpackbits(masks, axis=1, count=self.n_samples).astype(bool)
+
+    def to_dense(self):
+        """Returns a samples x features DataFrame of 0/1 integers."""
+        return pd.DataFrame(
+            self.to_bool().T.astype(int), index=self.index, columns=self.columns
+        )
+
+    def save(self, fname):
+        """Saves masks, names and directions to a .npz file."""
+        arrays = {
+            "masks": self.masks,
+            "n_samples": np.array(self.n_samples),
+            "index": np.array(self.index.values, dtype=str),
+            "columns": np.array(self.columns.values, dtype=str),
+        }
+        if self.directions is not None:
+            arrays["directions"] = np.array(self.directions, dtype=str)
+        tmp_fname = fname + ".tmp.npz"
+        np.savez(tmp_fname, **arrays)
+        os.replace(tmp_fname, fname)
+
+
+def pack_binarized(binarized_data, directions=None):
+    """BinarizedMatrix of a samples x features DataFrame of 0/1 values."""
+    return BinarizedMatrix(
+        np.packbits(np.asarray(binarized_data.values, dtype=bool).T, axis=1),
+        binarized_data.shape[0],
+        index=binarized_data.index.values,
+        columns=binarized_data.columns.values,
+        directions=directions,
+    )
+
+
+def load_binarized_matrix(fname):
+    """Loads a BinarizedMatrix saved by BinarizedMatrix.save()."""
+    with np.load(fname) as arrays:
+        return BinarizedMatrix(
+            arrays["masks"],
+            int(arrays["n_samples"]),
+            index=arrays["index"].astype(object),
+            columns=arrays["columns"].astype(object),
+            directions=arrays["directions"].astype(object) if "directions" in arrays else None,
+        )
@@ -0,0 +1,97 @@
+import hashlib
+import os
+import pickle
+import sys
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import issparse
+
+from unpast.utils.disk_exprs import DiskExprs
+from unpast.utils.sparse_exprs import SparseExprs
+
+
+def hash_data(*parts):
+    """Returns a hex digest of the content of DataFrames, arrays and other values.
+
+    DataFrames are hashed with their index and columns, arrays with their
+    shape and dtype, sparse matrices by their CSR arrays, memory-mapped
+    matrices by chunks of rows; other values are hashed by repr().
+    """
+    h = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, pd.DataFrame):
+            h.update(b"DataFrame")
+            h.update(pd.util.hash_pandas_object(part, index=True).values.tobytes())
+            h.update(repr(list(part.columns)).encode())
+            h.update(repr(list(part.dtypes)).encode())
+        elif isinstance(part, SparseExprs):
+            h.update(b"SparseExprs")
+            h.update(
+                hash_data(
+                    part.values, list(part.index), list(part.columns),
+                    part.means, part.stds, part.ceiling, part.dtype,
+                ).encode()
+            )
+        elif isinstance(part, DiskExprs):
+            # read by chunks of rows
+            h.update(b"DiskExprs")
+            h.update(repr((part.shape, part.values.dtype.str)).encode())
+            h.update(repr((list(part.index), list(part.columns))).encode())
+            for _, rows in part.iter_chunks():
+                h.update(np.ascontiguousarray(rows).tobytes())
+        elif issparse(part):
+            part = part.tocsr()
+            h.update(repr((part.shape, part.dtype.str)).encode())
+            for a in [part.data, part.indices, part.indptr]:
+                h.update(np.ascontiguousarray(a).tobytes())
+        elif isinstance(part, np.ndarray):
+            h.update(repr((part.shape, part.dtype.str)).encode())
+            h.update(np.ascontiguousarray(part).tobytes())
+        else:
+            h.update(repr(part).encode())
+        h.update(b"|")
+    return h.hexdigest()
+
+
+def get_checkpoint_fname(checkpoint_dir, stage, key):
+    return os.path.join(checkpoint_dir, stage + "." + key + ".pkl")
+
+
+def save_checkpoint(checkpoint_dir, stage, key, result, verbose=True):
+    """Saves a result of a pipeline stage under its key.
+
+    The file is written to a temporary name first, so an interrupted run
+    never leaves an incomplete checkpoint.
+    """
+    if not os.path.exists(checkpoint_dir):
+        os.makedirs(checkpoint_dir)
+    fname = get_checkpoint_fname(checkpoint_dir, stage, key)
+    tmp_fname = fname + ".tmp"
+    with open(tmp_fname, "wb") as f:
+        pickle.dump((key, result), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_fname, fname)
+    if verbose:
+        print("Saved %s checkpoint to %s" % (stage, fname), file=sys.stdout)
+
+
+def load_checkpoint(checkpoint_dir, stage, key, verbose=True):
+    """Loads a result of a pipeline stage saved under the key.
+
+    Returns None if there is no valid checkpoint for this key.
+    """
+    fname = get_checkpoint_fname(checkpoint_dir, stage, key)
+    if not os.path.exists(fname):
+        return None
+    try:
+        with open(fname, "rb") as f:
+            saved_key, result = pickle.load(f)
+    except Exception:
+        print("Checkpoint %s is broken and will be recomputed" % fname, file=sys.stderr)
+        return None
+    if saved_key != key:
+        print("Checkpoint %s is outdated and will be recomputed" % fname, file=sys.stderr)
+        return None
+    if verbose:
+        print("Loaded %s from checkpoint %s" % (stage, fname), file=sys.stdout)
+    return result
@@ -0,0 +1,67 @@
+import numpy as np
+import pandas as pd
+
+
+class DiskExprs:
+    """Features x samples matrix of z-scores kept in a memory-mapped file.
+
+    Only chunks of chunksize rows are read into memory at a time: during
+    binarization, rows are streamed chunk by chunk; for sample clustering,
+    rows of module features are gathered into a dense submatrix.
+    Implements the same part of the DataFrame interface as SparseExprs:
+    shape, index, columns, dtypes, iterrows() and to_dense().
+    """
+
+    __slots__ = ("values", "index", "columns", "chunksize")
+
+    def __init__(self, values, index=None, columns=None, chunksize=1000):
+        self.values = values
+        n_rows, n_cols = values.shape
+        self.index = pd.Index(range(n_rows) if index is None else index)
+        self.columns = pd.Index(range(n_cols) if columns is None else columns)
+        if len(self.index) != n_rows or len(self.columns) != n_cols:
+            raise ValueError("row or column names do not match the matrix shape")
+        self.chunksize = max(int(chunksize), 1)
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    @property
+    def dtypes(self):
+        return pd.Series(self.values.dtype, index=self.columns)
+
+    def get_rows(self, row_indexes):
+        """Returns a dense in-memory array of rows with given indexes."""
+        return np.array(self.values[np.asarray(row_indexes, dtype=int), :])
+
+    def iter_chunks(self):
+        """Yields (start row, in-memory array of chunksize rows)."""
+        for start in range(0, self.shape[0], self.chunksize):
+            yield start, np.array(self.values[start : start + self.chunksize])
+
+    def iterrows(self):
+        """Yields (feature name, Series of values) as DataFrame.iterrows() does."""
+        for start, rows in self.iter_chunks():
+            for name, row in zip(self.index.values[start : start + len(rows)], rows):
+                yield name, pd.Series(row, index=self.columns, name=name)
+
+    def to_dense(self, rows=None):
+        """Returns a DataFrame of rows with given names (all by default)."""
+        if rows is None:
+            row_indexes = np.arange(self.shape[0])
+        else:
+            row_indexes = self.index.get_indexer(rows)
+            if (row_indexes < 0).any():
+                raise KeyError("features not found: %s" % list(np.array(rows)[row_indexes < 0]))
+        return pd.DataFrame(
+            self.get_rows(row_indexes),
+            index=self.index.values[row_indexes],
+            columns=self.columns,
+        )
+
+
+def get_budget_chunksize(n_samples, memory_budget, n_copies=8):
+    """Number of rows of n_samples float64 values such that n_copies
+    such chunks (the chunk and temporary arrays) fit in memory_budget MB."""
+    return max(int(memory_budget * 2**20 / (n_samples * 8 * n_copies)), 1)
@@ -1,8 +1,6 @@
 import sys
 import numpy as np
 import pandas as pd
-from fisher import pvalue
-from scipy.stats import chi2_contingency
 from statsmodels.stats.multitest import fdrcorrection
 
 from unpast.utils.method import zscore
@@ -447,6 +445,7 @@ def evaluate_overlaps_ARI(biclusters, known_groups, all_elements):
         for j in range(len(all_elements_list)):
             if all_elements_list[j] in group_members:
                 group_binary[j] = 1
+        counts = []
         for i in biclusters.index.values:
             bic = biclusters.loc[i, :]
             bic_members = bic["samples"]
@@ -457,16 +456,17 @@ def evaluate_overlaps_ARI(biclusters, known_groups, all_elements):
             # calculate ARI for 2 binary vectors:
             ARI[group][i] = adjusted_rand_score(group_binary, bic_binary)
 
-            # Fisher's exact test
             shared = len(bic_members.intersection(group_members))
             bic_only = len(bic_members.difference(group_members))
             group_only = len(group_members.difference(bic_members))
             union = shared + bic_only + group_only
-            pval = pvalue(shared, bic_only, group_only, N - union)
-            pvals[group][i] = pval.two_tail
-            is_enriched[group][i] = False
-            if pval.right_tail < pval.left_tail:
-                is_enriched[group][i] = True
+            counts.append((shared, bic_only, group_only, N - union))
+
+        # Fisher's exact test for all biclusters at once
+        left, right, two_tail = calc_fisher_pvals(*np.array(counts).reshape(-1, 4).T)
+        for k, i in enumerate(biclusters.index.values):
+            pvals[group][i] = two_tail[k]
+            is_enriched[group][i] = bool(right[k] < left[k])
 
     pvals = pd.DataFrame.from_dict(pvals).loc[:, sorted_group_names]
     is_enriched = pd.DataFrame.from_dict(is_enriched).loc[:, sorted_group_names]
@@ -526,6 +526,7 @@ def evaluate_overlaps(biclusters, known_groups, all_elements, dimension="samples
         pvals[group] = {}
         is_enriched[group] = {}
         jaccards[group] = {}
+        counts = []
         for i in biclusters.index.values:
             bic = biclusters.loc[i, :]
             bic_members = bic[dimension]
@@ -533,25 +534,15 @@ def evaluate_overlaps(biclusters, known_groups, all_elements, dimension="samples
             bic_only = len(bic_members.difference(group_members))
             group_only = len(group_members.difference(bic_members))
             union = shared + bic_only + group_only
-            pval = pvalue(shared, bic_only, group_only, N - union)
-            """pvals[group][i] = 1 
-            if pval.right_tail < pval.left_tail:
-                pvals[group][i] = pval.right_tail
-                is_enriched[group][i] = True
-            # if under-representation, flip query set
-            else:
-                pvals[group][i] = pval.left_tail # save left-tail p-value and record that this is not enrichment
-                is_enriched[group][i] = False
-                bic_members = all_elements.difference(bic_members)
-                shared = len(bic_members.intersection(group_members))
-                union = len(bic_members.union(group_members))"""
-            pvals[group][i] = pval.two_tail
-            is_enriched[group][i] = False
-            if pval.right_tail < pval.left_tail:
-                is_enriched[group][i] = True
-
+            counts.append((shared, bic_only, group_only, N - union))
             jaccards[group][i] = shared / union
 
+        # Fisher's exact test for all biclusters at once
+        left, right, two_tail = calc_fisher_pvals(*np.array(counts).reshape(-1, 4).T)
+        for k, i in enumerate(biclusters.index.values):
+            pvals[group][i] = two_tail[k]
+            is_enriched[group][i] = bool(right[k] < left[k])
+
         # print(group,jaccards[group])
 
     pvals = pd.DataFrame.from_dict(pvals).loc[:, sorted_group_names]
@@ -560,16 +551,131 @@ def evaluate_overlaps(biclusters, known_groups, all_elements, dimension="samples
     return pvals, is_enriched, jaccards
 
 
+_log_factorials = np.zeros(1)
+
+
+def get_log_factorials(n):
+    """Returns an array of log(k!) for k = 0,...,n or longer.
+    The table is cached and extended when a larger n is requested."""
+    global _log_factorials
+    if len(_log_factorials) <= n:
+        from scipy.special import gammaln
+
+        size = max(n + 1, 2 * len(_log_factorials))
+        _log_factorials = gammaln(np.arange(size) + 1.0)
+    return _log_factorials
+
+
+def calc_fisher_pvals(a, b, c, d, max_chunk_size=10**7):
+    """Fisher's exact test for arrays of 2x2 tables [[a, b], [c, d]].
+
+    Returns arrays of left-, right- and two-tailed p-values, as fisher.pvalue() does.
+    Hypergeometric probabilities of all tables with the same margins are computed
+    in log-space from a cached table of log-factorials and summed with
+    the log-sum-exp trick, so that exact tests are affordable at any N.
+    Tables are processed in chunks of at most max_chunk_size probabilities.
+    """
+    shape = np.shape(a)
+    tables = np.stack([np.ravel(x) for x in (a, b, c, d)], axis=1).astype(np.int64)
+    left = np.ones(tables.shape[0])
+    right = np.ones(tables.shape[0])
+    two_tail = np.ones(tables.shape[0])
+    if tables.shape[0] > 0:
+        a = tables[:, 0]
+        n = tables.sum(axis=1)
+        r1 = tables[:, 0] + tables[:, 1]
+        c1 = tables[:, 0] + tables[:, 2]
+        lo = np.maximum(0, r1 + c1 - n)
+        support = np.minimum(r1, c1) - lo + 1
+        log_factorials = get_log_factorials(n.max())
+        ends = np.cumsum(support)
+        start = 0
+        while start < len(a):
+            chunk_start = ends[start] - support[start]
+            end = np.searchsorted(ends, chunk_start + max_chunk_size, side="right")
+            end = max(end, start + 1)
+            ndx = slice(start, end)
+            left[ndx], right[ndx], two_tail[ndx] = _calc_fisher_pvals_chunk(
+                a[ndx], r1[ndx], c1[ndx], n[ndx], lo[ndx], support[ndx], log_factorials
+            )
+            start = end
+    return left.reshape(shape), right.reshape(shape), two_tail.reshape(shape)
+
+
+def _calc_fisher_pvals_chunk(a, r1, c1, n, lo, support, log_factorials):
+    lf = log_factorials
+    # all possible values x of the top left cell, given the table margins
+    offsets = np.cumsum(support) - support
+    table_ndx = np.repeat(np.arange(len(a)), support)
+    x = lo[table_ndx] + np.arange(len(table_ndx)) - offsets[table_ndx]
+    r1_, c1_, n_ = r1[table_ndx], c1[table_ndx], n[table_ndx]
+    # log-probabilities up to a constant, which is cancelled by normalization
+    logp = -(lf[x] + lf[r1_ - x] + lf[c1_ - x] + lf[n_ - r1_ - c1_ + x])
+    logp_a = -(lf[a] + lf[r1 - a] + lf[c1 - a] + lf[n - r1 - c1 + a])
+    total = _logsumexp_by_segments(logp, table_ndx, offsets)
+    a_ = a[table_ndx]
+    # relative tolerance for probabilities equal to that of the observed table
+    is_extreme = logp <= logp_a[table_ndx] + 1e-7
+    pvals = []
+    for tail in [x <= a_, x >= a_, is_extreme]:
+        log_tail = _logsumexp_by_segments(
+            np.where(tail, logp, -np.inf), table_ndx, offsets
+        )
+        pvals.append(np.minimum(1.0, np.exp(log_tail - total)))
+    return pvals
+
+
+def _logsumexp_by_segments(values, segment_ndx, offsets):
+    m = np.maximum.reduceat(values, offsets)
+    m = np.where(np.isfinite(m), m, 0)
+    with np.errstate(divide="ignore"):
+        return m + np.log(np.add.reduceat(np.exp(values - m[segment_ndx]), offsets))
+
+
 def calc_overlap_pval(overlap, group1_only, group2_only, background, max_N=5000):
     # if sample size < max_N), use Fisher's exact
     # otherwise replacing exact Fisher's with chi2
-    if overlap + group1_only + group2_only + background < max_N:
-        pval = pvalue(overlap, group1_only, group2_only, background).right_tail
+    return calc_overlap_pvals(
+        overlap, group1_only, group2_only, background, max_N=max_N
+    )[()]
+
+
+def calc_overlap_pvals(overlap, group1_only, group2_only, background, max_N=5000):
+    """calc_overlap_pval() for arrays of 2x2 tables.
+    If max_N is None, Fisher's exact test is used for tables of any size."""
+    tables = np.stack(
+        [np.ravel(x) for x in (overlap, group1_only, group2_only, background)], axis=1
+    ).astype(np.int64)
+    pvals = np.ones(tables.shape[0])
+    if max_N is None:
+        is_exact = np.ones(tables.shape[0], dtype=bool)
     else:
-        chi2, pval, dof, expected = chi2_contingency(
-            [[overlap, group1_only], [group2_only, background]]
-        )
-    return pval
+        is_exact = tables.sum(axis=1) < max_N
+    if is_exact.any():
+        pvals[is_exact] = calc_fisher_pvals(*tables[is_exact].T)[1]
+    if not is_exact.all():
+        pvals[~is_exact] = calc_chi2_pvals(tables[~is_exact])
+    return pvals.reshape(np.shape(overlap))
+
+
+def calc_chi2_pvals(tables):
+    """Vectorized chi2_contingency() p-values with Yates' correction
+    for 2x2 tables given as rows [a, b, c, d]."""
+    from scipy.special import chdtrc
+
+    observed = tables.reshape(-1, 2, 2).astype(float)
+    n = tables.sum(axis=1)
+    rows = tables[:, [0, 2]] + tables[:, [1, 3]]
+    cols = tables[:, [0, 1]] + tables[:, [2, 3]]
+    expected = (rows[:, :, np.newaxis] * cols[:, np.newaxis, :]) / n[
+        :, np.newaxis, np.newaxis
+    ]
+    diff = expected - observed
+    observed = observed + np.minimum(0.5, np.abs(diff)) * np.sign(diff)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        terms = ((observed - expected) ** 2 / expected).reshape(-1, 4)
+    chi2 = ((terms[:, 0] + terms[:, 1]) + terms[:, 2]) + terms[:, 3]
+    return chdtrc(1, chi2)
 
 
 def find_best_matching_biclusters(
@@ -579,113 +685,106 @@ def find_best_matching_biclusters(
     # by = "genes" or "samples" or "both"
     # sizes - dimensions of input matrix (n_genes,n_samples)
     # finds best matches of bics1 biclusters among bics2 biclusters
+    # all pairwise overlaps are computed from sparse incidence matrices
+
+    from unpast.utils.bicluster_set import BiclusterSet
 
     N_g, N_s = sizes
     n_bics1 = bics1.shape[0]
     n_bics2 = bics2.shape[0]
 
-    best_matches = {}  # OrderedDict({})
-    for row1 in bics1.iterrows():
-        bic1 = row1[1]
-        i1 = row1[0]
+    gene_names = sorted(set().union(*bics1["genes"], *bics2["genes"]))
+    sample_names = sorted(set().union(*bics1["samples"], *bics2["samples"]))
+    set1 = BiclusterSet.from_dataframe(
+        bics1.loc[:, ["genes", "samples"]], gene_names, sample_names
+    )
+    set2 = BiclusterSet.from_dataframe(
+        bics2.loc[:, ["genes", "samples"]], gene_names, sample_names
+    )
+    # n_bics1 x n_bics2 matrices of overlaps and sizes
+    o_g = set1.overlaps(set2, by="genes").toarray().astype(np.int64)
+    o_s = set1.overlaps(set2, by="samples").toarray().astype(np.int64)
+    g1 = np.repeat(set1.n_genes[:, np.newaxis], n_bics2, axis=1).astype(np.int64)
+    g2 = np.repeat(set2.n_genes[np.newaxis, :], n_bics1, axis=0).astype(np.int64)
+    s1 = np.repeat(set1.n_samples[:, np.newaxis], n_bics2, axis=1).astype(np.int64)
+    s2 = np.repeat(set2.n_samples[np.newaxis, :], n_bics1, axis=0).astype(np.int64)
+
+    # if not by="samples", ignore overlaps with gene < min_g
+    if by == "samples":
+        passed = np.ones((n_bics1, n_bics2), dtype=bool)
+    else:
+        passed = o_g >= min_g
+    J = np.zeros((n_bics1, n_bics2))
+    pval = np.ones((n_bics1, n_bics2))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if by == "genes":
+            g2_ = g2 - o_g  # genes exclusively in bicluster 2
+            g1_ = g1 - o_g
+            u_g = g1_ + g2_ + o_g
+            bg_g = N_g - u_g
+            J = o_g * 1.0 / u_g
+            pval[passed] = calc_overlap_pvals(
+                o_g[passed], g1_[passed], g2_[passed], bg_g[passed]
+            )
+        elif by == "samples":
+            s2_ = s2 - o_s  # samples exclusively in bicluster 2
+            s1_ = s1 - o_s
+            u_s = s1_ + s2_ + o_s
+            bg_s = N_s - u_s
+            pval = calc_overlap_pvals(o_s, s1_, s2_, bg_s)
+            # if p-val is high but one of the biclusters is large,
+            # try flipping the largest bicluster if it is close to 50% of the cohort
+            flip = (pval > adj_pval_thr) & (np.maximum(s1, s2) > 0.4 * N_s)
+            flip1 = flip & (s1 > s2)  # flip s1
+            flip2 = flip & ~(s1 > s2)  # flip s2
+            o_flipped = np.where(flip1, s2_, np.where(flip2, s1_, o_s))
+            u_s = np.where(flip1, bg_s + s2, np.where(flip2, bg_s + s1, u_s))
+            bg_s = np.where(flip1, s1_, np.where(flip2, s2_, bg_s))
+            s1 = np.where(flip1, N_s - s1, s1)
+            s2 = np.where(flip2, N_s - s2, s2)
+            o_s = o_flipped
+            s1_ = s1 - o_s
+            s2_ = s2 - o_s
+            assert (bg_s == N_s - u_s).all()
+            assert (u_s == o_s + s1_ + s2_).all()
+            # compute p-value again
+            pval[flip] = calc_overlap_pvals(o_s[flip], s1_[flip], s2_[flip], bg_s[flip])
+            J = o_s * 1.0 / u_s
+        else:
+            o = o_s * o_g  # bicluster overlap
+            b1_ = s1 * g1 - o  # exclusive bicluster 1 area
+            b2_ = s2 * g2 - o
+            u = o + b1_ + b2_
+            bg = N_s * N_g - u
+            J = o * 1.0 / u
+            pval[passed] = calc_overlap_pvals(
+                o[passed], b1_[passed], b2_[passed], bg[passed]
+            )
+
+    adj_pval = pval * n_bics2 * n_bics1
+    is_match = passed & (adj_pval < adj_pval_thr) & (J > 0)
 
+    best_matches = {}  # OrderedDict({})
+    bics2_ids = bics2.index.values
+    for k, i1 in enumerate(bics1.index.values):
         best_matches[i1] = {}
         bm_J = 0
-        bm_o = 0
         bm_adj_pval = 1
         bm_id = None
-
-        for row2 in bics2.iterrows():
-            bic2 = row2[1]
-            i2 = row2[0]
-
-            g1 = bic1["genes"]
-            s1 = bic1["samples"]
-            g2 = bic2["genes"]
-            s2 = bic2["samples"]
-            o_g = len(g1.intersection(g2))
-            o_s = len(s1.intersection(s2))
-            s1 = len(s1)
-            s2 = len(s2)
-            g1 = len(g1)
-            g2 = len(g2)
-            J = 0
-            adj_pval = 1
-            # if not by="samples", ignore overlaps with gene < min_g
-            if (by != "samples" and o_g >= min_g) or by == "samples":
-                if by == "genes" or by == "both":
-                    g2_ = g2 - o_g  # genes exclusively in bicluster 2
-                    g1_ = g1 - o_g
-                    u_g = g1_ + g2_ + o_g
-                    bg_g = N_g - u_g
-                    J_g = o_g * 1.0 / u_g
-                    if not by == "both":
-                        pval_g = calc_overlap_pval(o_g, g1_, g2_, bg_g)
-                elif by == "samples" or by == "both":
-                    s2_ = s2 - o_s  # samples exclusively in bicluster 2
-                    s1_ = s1 - o_s
-                    u_s = s1_ + s2_ + o_s
-                    bg_s = N_s - u_s
-                    pval_s = calc_overlap_pval(o_s, s1_, s2_, bg_s)
-                    # if p-val is high but one of the biclusters is large,
-                    # try flipping the largest bicluster if it is close to 50% of the cohort
-                    if pval_s > adj_pval_thr and max(s1, s2) > 0.4 * N_s:
-                        if s1 > s2:  # flip s1
-                            s1 = N_s - s1
-                            u_s = bg_s + s2
-                            o_s = s2_
-                            s2_ = s2 - o_s
-                            bg_s = s1_
-                            s1_ = s1 - o_s
-                        else:  # flip s2
-                            s2 = N_s - s2
-                            u_s = bg_s + s1
-                            o_s = s1_
-                            s1_ = s1 - o_s
-                            bg_s = s2_
-                            s2_ = s2 - o_s
-                        assert bg_s == N_s - u_s, (
-                            "i1=%s; i2=%s: bg=%s, N_s=%s, u_s=%s"
-                            % (i1, i2, bg_s, N_s, u_s)
-                        )
-                        assert u_s == o_s + s1_ + s2_, (
-                            "i1=%s; i2=%s: u_s=%s, o_s=%s, s1_=%s, s2_=%s"
-                            % (i1, i2, u_s, o_s, s1_, s2_)
-                        )
-                        if not by == "both":
-                            # compute p-value again
-                            pval_s = calc_overlap_pval(o_s, s1_, s2_, bg_s)
-                    J_s = o_s * 1.0 / u_s
-
-                if by == "genes":
-                    J = J_g
-                    pval = pval_g
-                    o = o_g
-                elif by == "samples":
-                    J = J_s
-                    pval = pval_s
-                    o = o_s
-                else:
-                    o = o_s * o_g  # bicluster overlap
-                    b1_ = s1 * g1 - o  # exclusive bicluster 1 area
-                    b2_ = s2 * g2 - o
-                    u = o + b1_ + b2_
-                    bg = N_s * N_g - u
-                    J = o * 1.0 / u
-                    pval = calc_overlap_pval(o, b1_, b2_, bg)
-
-                adj_pval = pval * n_bics2 * n_bics1
-                if adj_pval < adj_pval_thr and J > 0:
-                    if J > bm_J or (J == bm_J and adj_pval < bm_adj_pval):
-                        bm_J = J
-                        bm_adj_pval = adj_pval
-                        bm_id = i2
-                        bm_o = o
+        candidates = np.where(is_match[k])[0]
+        if len(candidates) > 0:
+            # the highest J, then the lowest adj. p-value, then the first
+            best = candidates[
+                np.lexsort((candidates, adj_pval[k, candidates], -J[k, candidates]))[0]
+            ]
+            bm_J = float(J[k, best])
+            bm_adj_pval = float(adj_pval[k, best])
+            bm_id = bics2_ids[best]
         best_matches[i1]["bm_id"] = bm_id
         best_matches[i1]["J"] = bm_J
         best_matches[i1]["adj_pval"] = bm_adj_pval
         if "genes" in bics1.columns and "genes" in bics2.columns:
-            if bm_id:
+            if bm_id is not None:
                 best_matches[i1]["shared_genes"] = bics2.loc[
                     bm_id, "genes"
                 ].intersection(bics1.loc[i1, "genes"])
@@ -699,7 +798,7 @@ def find_best_matching_biclusters(
         if "samples" in bics1.columns and "samples" in bics2.columns:
             best_matches[i1]["n_samples"] = bics1.loc[i1, "n_samples"]
             best_matches[i1]["samples"] = bics1.loc[i1, "samples"]
-            if bm_id:
+            if bm_id is not None:
                 best_matches[i1]["bm_n_samples"] = bics2.loc[bm_id, "n_samples"]
                 best_matches[i1]["bm_samples"] = bics2.loc[bm_id, "samples"]
                 best_matches[i1]["shared_samples"] = bics2.loc[
@@ -888,7 +987,7 @@ def test_sample_overlap(row, sample_set, N):
     bic_only = len(bic_samples) - o
     sample_set_only = len(sample_set) - o
     bg = N - o - bic_only - sample_set_only
-    p = pvalue(o, bic_only, sample_set_only, bg).right_tail
+    p = float(calc_fisher_pvals(o, bic_only, sample_set_only, bg)[1])
     # if p<0.001:
     #    print(p,(o,bic_only,sample_set_only,bg),row["genes"])
     return pd.Series({"pval": p, "counts": (o, bic_only, sample_set_only, bg)})
@@ -0,0 +1,216 @@
+import os
+import sys
+import tempfile
+from time import time
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import load_npz
+
+from unpast.utils.disk_exprs import DiskExprs
+from unpast.utils.sparse_exprs import SparseExprs
+
+
+# input formats detected by file extensions; other files are read as tab-separated text
+INPUT_FORMATS = {
+    ".parquet": "parquet",
+    ".pq": "parquet",
+    ".feather": "feather",
+    ".arrow": "feather",
+    ".ipc": "feather",
+    ".h5": "hdf5",
+    ".hdf5": "hdf5",
+    ".hdf": "hdf5",
+    ".npy": "npy",
+    ".npz": "npz",
+}
+
+
+def get_input_format(fname, fmt=None):
+    """Returns fmt if given, otherwise the input format guessed from the file extension."""
+    if fmt:
+        return fmt
+    ext = os.path.splitext(str(fname))[1].lower()
+    return INPUT_FORMATS.get(ext, "tsv")
+
+
+def read_exprs(fname, fmt=None, verbose=False):
+    """Reads a matrix with features in rows and samples in columns.
+
+    fmt is one of 'tsv', 'parquet', 'feather' (Arrow IPC), 'hdf5', 'npy' or 'npz';
+    if not given, it is guessed from the file extension.
+    Parquet, Feather and HDF5 files are read with pandas (Parquet and
+    Feather require pyarrow, HDF5 requires pytables). If such a table has no
+    index, its first column is used as feature names.
+    A .npy file is memory-mapped; feature and sample names are read from
+    <name>.rows.txt and <name>.columns.txt (one name per line) if they exist.
+    A .npz file is a sparse matrix saved with scipy.sparse.save_npz(); it is
+    returned as a SparseExprs matrix, with names read as for .npy.
+    """
+    t0 = time()
+    fmt = get_input_format(fname, fmt)
+    if fmt == "tsv":
+        exprs = pd.read_csv(fname, sep="\t", index_col=0)
+    elif fmt == "parquet":
+        exprs = _set_feature_index(pd.read_parquet(fname, memory_map=True))
+    elif fmt == "feather":
+        from pyarrow import feather
+
+        exprs = _set_feature_index(feather.read_table(fname, memory_map=True).to_pandas())
+    elif fmt == "hdf5":
+        exprs = _set_feature_index(pd.read_hdf(fname))
+    elif fmt == "npy":
+        exprs = _read_npy(fname)
+    elif fmt == "npz":
+        exprs = _read_npz(fname)
+    else:
+        raise ValueError(
+            "Unknown input format '%s'; use one of 'tsv', 'parquet', 'feather', 'hdf5', 'npy', 'npz'."
+            % fmt
+        )
+    if verbose:
+        print(
+            "\tRead %s input in {:.2f} s".format(time() - t0) % fmt, file=sys.stdout
+        )
+    return exprs
+
+
+def _set_feature_index(df):
+    if isinstance(df.index, pd.RangeIndex) and df.shape[1] > 0:
+        if df.dtypes.iloc[0] == object:
+            df = df.set_index(df.columns[0])
+            df.index.name = None
+    return df
+
+
+def _read_names(fname, shape):
+    # row and column names from <name>.rows.txt and <name>.columns.txt
+    base = os.path.splitext(fname)[0]
+    names = []
+    for suffix, n in [(".rows.txt", shape[0]), (".columns.txt", shape[1])]:
+        if os.path.exists(base + suffix):
+            with open(base + suffix) as f:
+                names.append([line.rstrip("\n") for line in f if line.rstrip("\n")])
+        else:
+            names.append(list(range(n)))
+    return names
+
+
+def _read_npy(fname):
+    values = np.load(fname, mmap_mode="r")
+    index, columns = _read_names(fname, values.shape)
+    return pd.DataFrame(values, index=index, columns=columns, copy=False)
+
+
+def _read_npz(fname):
+    values = load_npz(fname)
+    index, columns = _read_names(fname, values.shape)
+    return SparseExprs(values, index=index, columns=columns)
+
+
+def read_exprs_chunked(
+    exprs_file,
+    min_n_samples=5,
+    tol=0.01,
+    standradize=True,
+    ceiling=0,
+    chunksize=1000,
+    mmap_fname=None,
+    out_of_core=False,
+    verbose=False,
+):
+    """Reads a tab-separated matrix by chunks of rows and prepares it as
+    prepare_input_matrix() does, without keeping the whole table in memory.
+
+    Features (rows) are processed one chunk at a time and written as float32
+    to a memory-mapped file mmap_fname (an anonymous temporary file if not
+    given). Whether the input is already standardized is decided from all
+    rows, so standardization and ceiling are applied in a second pass
+    over the memory-mapped array.
+    Returns a DataFrame backed by the memory-mapped array, or with
+    out_of_core=True, a DiskExprs matrix reading it by chunks of rows.
+    """
+    t0 = time()
+    if mmap_fname is None:
+        mmap_file = tempfile.TemporaryFile()
+    else:
+        mmap_file = open(mmap_fname, "wb+")
+
+    # 1st pass: drop constant features and features with too many missing values,
+    # keep row means and stds for standardization
+    features, means, stds = [], [], []
+    samples = None
+    n_zero_var, n_na_rows, n_too_few = 0, 0, 0
+    mean_passed, std_passed = True, True
+    reader = pd.read_csv(exprs_file, sep="\t", index_col=0, chunksize=chunksize)
+    for chunk in reader:
+        if samples is None:
+            samples = [str(x) for x in chunk.columns.values]
+        values = chunk.values.astype(float)
+        std = chunk.std(axis=1).values
+        m = chunk.mean(axis=1).values
+        nonconst = std != 0
+        n_zero_var += (~nonconst).sum()
+        mean_passed = mean_passed and np.all(np.abs(m[nonconst]) < tol)
+        std_passed = std_passed and np.all(np.abs(std[nonconst] - 1) < tol)
+        n_na = np.isnan(values).sum(axis=1)
+        n_na_rows += (nonconst & (n_na > 0)).sum()
+        keep = nonconst & (n_na <= values.shape[1] - min_n_samples)
+        n_too_few += (nonconst & ~keep).sum()
+        features += [str(x) for x in chunk.index.values[keep]]
+        means.append(m[keep])
+        stds.append(std[keep])
+        mmap_file.write(np.ascontiguousarray(values[keep], dtype=np.float32).tobytes())
+    mmap_file.flush()
+    means = np.concatenate(means) if means else np.zeros(0)
+    stds = np.concatenate(stds) if stds else np.zeros(0)
+    shape = (len(features), len(samples))
+    if verbose:
+        print(
+            "\tRead %s features x %s samples in {:.2f} s".format(time() - t0)
+            % shape,
+            file=sys.stdout,
+        )
+        if n_zero_var > 0:
+            print("\tZero variance rows will be dropped: %s" % n_zero_var, file=sys.stdout)
+    if len(features) <= 2:
+        print(
+            "After excluding constant features (rows) , less than 3 features (rows) remain in the input matrix.",
+            file=sys.stderr,
+        )
+    if len(set(features)) < len(features):
+        print("\tRow names are not unique.", file=sys.stderr)
+    if verbose and n_na_rows > 0:
+        print("\tMissing values detected in %s rows" % n_na_rows, file=sys.stdout)
+        print(
+            "\tFeatures with too few values (<%s) dropped: %s" % (min_n_samples, n_too_few),
+            file=sys.stdout,
+        )
+
+    exprs = np.memmap(mmap_file, dtype=np.float32, mode="r+", shape=shape)
+
+    # 2nd pass: standardize and limit values to [-ceiling,ceiling]
+    zscore = standradize and not (mean_passed and std_passed)
+    if verbose and not (mean_passed and std_passed):
+        print("\tInput is not standardized.", file=sys.stdout)
+    if standradize:
+        if verbose and ceiling > 0:
+            print(
+                "\tStandardized expressions will be limited to [-%s,%s]:"
+                % (ceiling, ceiling),
+                file=sys.stdout,
+            )
+        for start in range(0, shape[0], chunksize):
+            values = exprs[start : start + chunksize].astype(float)
+            if zscore:
+                values = (values - means[start : start + chunksize, np.newaxis]) / stds[
+                    start : start + chunksize, np.newaxis
+                ]
+            if ceiling > 0:
+                values = np.clip(values, -ceiling, ceiling)
+                values[np.isnan(values)] = -ceiling
+            exprs[start : start + chunksize] = values
+        exprs.flush()
+    if out_of_core:
+        return DiskExprs(exprs, index=features, columns=samples, chunksize=chunksize)
+    return pd.DataFrame(exprs, index=features, columns=samples, copy=False)
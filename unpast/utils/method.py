@@ -7,10 +7,10 @@ import pandas as pd
 import numpy as np
 from time import time
 import math
+import heapq
 
 from scipy.interpolate import interp1d
-from scipy.sparse.csr import csr_matrix
-from scipy.stats import chi2_contingency
+from scipy.sparse import csr_matrix, issparse
 
 from sklearn.mixture import GaussianMixture
 from sklearn.cluster import KMeans, AgglomerativeClustering
@@ -20,6 +20,11 @@ import matplotlib.pyplot as plt
 import statsmodels.api as sm
 from statsmodels.stats.multitest import fdrcorrection
 
+from unpast.utils.bicluster_set import BiclusterSet
+from unpast.utils.sparse_exprs import SparseExprs, prepare_sparse_matrix
+from unpast.utils.disk_exprs import DiskExprs
+from unpast.utils.binarized import BinarizedMatrix, pack_binarized, load_binarized_matrix
+
 # optimizer
 TRY_USE_NUMBA = True
 
@@ -40,6 +45,11 @@ if TRY_USE_NUMBA:
     except:
         print("Numba is not available. Install numba for a bit faster calculations")
 
+# from these numbers of samples, 2-means is approximated: with mini-batches
+# in cluster_samples() and on a histogram in binarization (see select_pos_neg())
+MINIBATCH_MIN_SAMPLES = 20000
+HISTOGRAM_MIN_SAMPLES = 20000
+
 
 def zscore(df):
     m = df.mean(axis=1)
@@ -60,6 +70,58 @@ def zscore(df):
     return df
 
 
+def calc_row_moments(values):
+    """Means and standard deviations (ddof=1) of rows of a 2D array ignoring NaN,
+    computed as DataFrame.mean(axis=1) and DataFrame.std(axis=1) do."""
+    values = np.asarray(values, dtype=np.float64)
+    na = np.isnan(values)
+    if na.any():
+        count = (values.shape[1] - na.sum(axis=1)).astype(np.float64)
+        values = np.where(na, 0, values)
+    else:
+        count = np.float64(values.shape[1])
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = values.sum(axis=1) / count
+        sqr = (mean[:, np.newaxis] - values) ** 2
+        if na.any():
+            sqr[na] = 0
+        d = count - 1
+        std = np.sqrt(sqr.sum(axis=1) / d)
+    std = np.where(d > 0, std, np.nan)
+    return mean, std
+
+
+def standardize_rows(values, means=None, out=None, zscore=True, ceiling=0, chunksize=10000):
+    """Standardizes rows of a 2D float array by chunks of rows.
+
+    Results are written to out (values itself by default), so temporary
+    memory is limited to a few chunks of rows. Row z-scores are computed
+    as zscore() does, values are limited to [-ceiling,ceiling] and NaN
+    are replaced with -ceiling if ceiling > 0. Row means can be given
+    if they are known already.
+    """
+    if out is None:
+        out = values
+    for start in range(0, values.shape[0], chunksize):
+        x = np.array(values[start : start + chunksize], dtype=np.float64, order="C")
+        if zscore:
+            if means is None:
+                m, _ = calc_row_moments(np.asfortranarray(x))
+            else:
+                m = means[start : start + chunksize]
+            x -= m[:, np.newaxis]
+            _, s = calc_row_moments(x)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                x /= s[:, np.newaxis]
+            # not variable rows get zero z-scores
+            x[s == 0, :] = 0
+        if ceiling > 0:
+            np.clip(x, -ceiling, ceiling, out=x)
+            x[np.isnan(x)] = -ceiling
+        out[start : start + chunksize] = x
+    return out
+
+
 def prepare_input_matrix(
     input_matrix: pd.DataFrame,
     min_n_samples: int =5,
@@ -67,78 +129,119 @@ def prepare_input_matrix(
     standradize: bool = True,
     ceiling: float =0,  # if float>0, limit z-scores to [-x,x]
     verbose: bool =False,
+    dtype=None,  # e.g. np.float32 to halve memory of the prepared matrix
+    inplace: bool = False,  # standardize values of input_matrix without copying
+    chunksize: int = 10000,
 ):
-    exprs = input_matrix.copy()
-    exprs.index = [str(x) for x in exprs.index.values]
-    exprs.columns = [str(x) for x in exprs.columns.values]
-    m = exprs.mean(axis=1)
-    std = exprs.std(axis=1)
+    """Checks and standardizes a matrix with features in rows and samples in columns.
+
+    Drops constant features and features with less than min_n_samples values;
+    if rows are not standardized and standradize is True, computes row
+    z-scores and limits them to [-ceiling,ceiling].
+    Values are standardized by chunks of rows (see standardize_rows()) and
+    written to a single output array; with inplace=True, the values of
+    input_matrix are overwritten instead if it keeps them as a writeable
+    column-major array of dtype (as pandas does for a matrix read from a file).
+    A SparseExprs matrix stays sparse, see prepare_sparse_matrix().
+    """
+    if isinstance(input_matrix, SparseExprs):
+        return prepare_sparse_matrix(
+            input_matrix,
+            min_n_samples=min_n_samples,
+            tol=tol,
+            standradize=standradize,
+            ceiling=ceiling,
+            verbose=verbose,
+            dtype=dtype,
+        )
+    index = [str(x) for x in input_matrix.index.values]
+    columns = [str(x) for x in input_matrix.columns.values]
+    values = input_matrix.values
+    if dtype is None:
+        dtype = values.dtype if values.dtype.kind == "f" else np.float64
+
+    # row moments by chunks
+    m, std = np.zeros(values.shape[0]), np.zeros(values.shape[0])
+    n_missing = np.zeros(values.shape[0], dtype=int)
+    for start in range(0, values.shape[0], chunksize):
+        # summing over columns of a column-major chunk, as pandas does
+        chunk = np.asfortranarray(values[start : start + chunksize], dtype=np.float64)
+        m[start : start + chunksize], std[start : start + chunksize] = calc_row_moments(chunk)
+        n_missing[start : start + chunksize] = np.isnan(chunk).sum(axis=1)
+
     # find zero variance rows
-    zero_var = list(std[std == 0].index.values)
-    if len(zero_var) > 0:
+    keep = std != 0
+    n_zero_var = (~keep).sum()
+    if n_zero_var > 0:
         if verbose:
-            print("\tZero variance rows will be dropped: %s"%len(zero_var),
+            print("\tZero variance rows will be dropped: %s"%n_zero_var,
                 file=sys.stdout,
             )
-        exprs = exprs.loc[std > 0]
-        m = m[std > 0]
-        std = std[std > 0]
-        if exprs.shape[0]<=2:
-            print("After excluding constant features (rows) , less than 3 features (rows) remain in the input matrix."% exprs.shape[0], file=sys.stderr)
-
-    mean_passed = np.all(np.abs(m) < tol)
-    std_passed = np.all(np.abs(std - 1) < tol)
+        if keep.sum()<=2:
+            print("After excluding constant features (rows) , less than 3 features (rows) remain in the input matrix.", file=sys.stderr)
+
+    mean_passed = np.all(np.abs(m[keep]) < tol)
+    std_passed = np.all(np.abs(std[keep] - 1) < tol)
+    zscore = False
     if not (mean_passed and std_passed):
         if verbose:
             print("\tInput is not standardized.", file=sys.stdout)
         if standradize:
-            exprs = zscore(exprs)
+            zscore = True
             if not mean_passed:
                 if verbose:
                     print("\tCentering mean to 0", file=sys.stdout)
             if not std_passed:
                 if verbose:
                     print("\tScaling std to 1", file=sys.stdout)
-    if len(set(exprs.index.values)) < exprs.shape[0]:
+    if len(set(np.array(index)[keep])) < keep.sum():
         print("\tRow names are not unique.", file=sys.stderr)
-    missing_values = exprs.isna().sum(axis=1)
-    n_na = missing_values[missing_values > 0].shape[0]
+    n_na = (n_missing[keep] > 0).sum()
     if n_na > 0:
         if verbose:
             print(
-                "\tMissing values detected in %s rows"%missing_values[missing_values > 0].shape[0],
+                "\tMissing values detected in %s rows"%n_na,
                 file=sys.stdout,
             )
-        keep_features = missing_values[
-            missing_values <= exprs.shape[1] - min_n_samples
-        ].index.values
+        keep_features = keep & (n_missing <= values.shape[1] - min_n_samples)
         if verbose:
             print(
                 "\tFeatures with too few values (<%s) dropped: %s"
-                % (min_n_samples, exprs.shape[0] - len(keep_features)),
+                % (min_n_samples, keep.sum() - keep_features.sum()),
                 file=sys.stdout,
             )
-        exprs = exprs.loc[keep_features, :]
-
-    if standradize:
-        if ceiling>0:
-            if verbose:
-                print(
-                    "\tStandardized expressions will be limited to [-%s,%s]:"
-                    % (ceiling, ceiling),
-                    file=sys.stdout,
-                )
-            exprs[exprs > ceiling] = ceiling
-            exprs[exprs < -ceiling] = -ceiling
-            if n_na > 0:
-                exprs.fillna(-ceiling, inplace=True)
-                if verbose:
-                    print(
-                        "\tMissing values will be replaced with -%s."
-                        % ceiling,
-                        file=sys.stdout,
-                    )
-    return exprs
+        keep = keep_features
+    if not keep.all():
+        values = values[keep]
+        m = m[keep]
+        index = list(np.array(index, dtype=object)[keep])
+
+    if not standradize:
+        ceiling = 0
+    if ceiling>0 and verbose:
+        print(
+            "\tStandardized expressions will be limited to [-%s,%s]:"
+            % (ceiling, ceiling),
+            file=sys.stdout,
+        )
+        if n_na > 0:
+            print(
+                "\tMissing values will be replaced with -%s."
+                % ceiling,
+                file=sys.stdout,
+            )
+    # the result is column-major, as pandas keeps a float matrix
+    if inplace and values.dtype == dtype and values.flags.f_contiguous and values.flags.writeable:
+        out = values
+    else:
+        out = np.empty(values.shape, dtype=dtype, order="F")
+    if zscore or ceiling>0:
+        standardize_rows(
+            values, means=m, out=out, zscore=zscore, ceiling=ceiling, chunksize=chunksize
+        )
+    elif out is not values:
+        out[:] = values
+    return pd.DataFrame(out, index=index, columns=columns, copy=False)
 
 
 def calc_snr_per_row(s, N, exprs, exprs_sums, exprs_sq_sums):
@@ -171,8 +274,21 @@ def calc_SNR(ar1, ar2):
 
 
 ######### Binarization #########
+def sample_null_values(N, n_permutations, seed=42, dtype=np.float64, chunksize=1000):
+    """Random expressions from the standard normal distribution used by generate_null_dist():
+    n_permutations rows of N sorted values."""
+    exprs = np.zeros((n_permutations, N), dtype=dtype)
+    # values = exprs.values.reshape(-1) # random samples from expression matrix
+    # exprs = np.random.choice(values,size=exprs.shape[1])
+    np.random.seed(seed=seed)
+    for start in range(0, n_permutations, chunksize):
+        n_rows = min(chunksize, n_permutations - start)
+        exprs[start : start + n_rows] = np.sort(np.random.normal(size=(n_rows, N)), axis=1)
+    return exprs
+
+
 def generate_null_dist(
-    N, sizes, n_permutations=10000, pval=0.001, seed=42, verbose=True
+    N, sizes, n_permutations=10000, pval=0.001, seed=42, verbose=True, dtype=np.float64
 ):
     # samples 'N' values from standard normal distribution, and split them into bicluster and background groups
     # 'sizes' defines bicluster sizes to test
@@ -191,27 +307,21 @@ def generate_null_dist(
         )
         print("\t\tsnr pval threshold:", pval, file=sys.stdout)
 
-    exprs = np.zeros((n_permutations, N))  # generate random expressions from st.normal
-    # values = exprs.values.reshape(-1) # random samples from expression matrix
-    # exprs = np.random.choice(values,size=exprs.shape[1])
-    np.random.seed(seed=seed)
-    for i in range(n_permutations):
-        exprs[i,] = sorted(np.random.normal(size=N))
-
+    exprs = sample_null_values(N, n_permutations, seed=seed, dtype=dtype)
     exprs_sums = exprs.sum(axis=1)
     exprs_sq_sums = np.square(exprs).sum(axis=1)
 
+    null_distribution = np.zeros((sizes.shape[0], n_permutations), dtype=dtype)
+    for i, s in enumerate(sizes):
+        null_distribution[i, :] = -1 * calc_snr_per_row(
+            s, N, exprs, exprs_sums, exprs_sq_sums
+        )
     null_distribution = pd.DataFrame(
-        np.zeros((sizes.shape[0], n_permutations)),
+        null_distribution,
         index=sizes,
         columns=range(n_permutations),
     )
 
-    for s in sizes:
-        null_distribution.loc[s, :] = -1 * calc_snr_per_row(
-            s, N, exprs, exprs_sums, exprs_sq_sums
-        )
-
     if verbose:
         print(
             "\tBackground ditribution generated in {:.2f} s".format(time() - t0),
@@ -220,6 +330,41 @@ def generate_null_dist(
     return null_distribution
 
 
+def get_null_sizes(N, min_n_samples):
+    """Bicluster sizes of the background distribution used by binarize():
+    about 100 sizes from min_n_samples to N/2 with an equal step."""
+    step = max(int((int(N / 2) - min_n_samples) / 100), 1)
+    return np.arange(min_n_samples, int(N / 2) + 1, step)
+
+
+def extend_null_dist(
+    null_distribution, N, sizes, n_permutations=10000, pval=0.001, seed=42, verbose=True, dtype=np.float64
+):
+    """Adds missing sizes to null_distribution or generates it if None."""
+    if null_distribution is None:
+        return generate_null_dist(
+            N, sizes, n_permutations=n_permutations, pval=pval, seed=seed, verbose=verbose, dtype=dtype
+        )
+    add_sizes = np.array(sorted(set(sizes).difference(null_distribution.index.values)))
+    if len(add_sizes) > 0:
+        null_distribution = pd.concat(
+            [
+                null_distribution,
+                generate_null_dist(
+                    N,
+                    add_sizes,
+                    pval=pval,
+                    n_permutations=null_distribution.shape[1],
+                    seed=seed,
+                    verbose=verbose,
+                    dtype=dtype,
+                ),
+            ],
+            axis=0,
+        )
+    return null_distribution
+
+
 def get_trend(sizes, thresholds, plot=True, verbose=True):
     """
     Smoothens the trend and retunrs a function min_SNR(size; p-val. cutoff)
@@ -259,6 +404,13 @@ def get_trend(sizes, thresholds, plot=True, verbose=True):
     return get_min_snr
 
 
+def get_snr_trend(null_distribution, sizes, pval, verbose=True):
+    """Trend of (1 - pval) quantiles of the null distribution for sizes,
+    used as the SNR threshold of binarize()."""
+    thresholds = np.quantile(null_distribution.loc[sizes, :].values, q=1 - pval, axis=1)
+    return get_trend(sizes, thresholds, plot=False, verbose=verbose)
+
+
 def calc_e_pval(snr, size, null_distribution):
     e_dist = null_distribution.loc[int(size), :]
     return (len(e_dist[e_dist >= abs(snr)]) + 1.0) / (null_distribution.shape[1] + 1.0)
@@ -298,9 +450,340 @@ def plot_binarized_feature(feature_name, down_group, up_group, colors, hist_rang
     plt.show()
 
 
-def select_pos_neg(row, min_n_samples, seed=42, prob_cutoff=0.5, method="GMM"):
+def calc_split_sse(values, labels):
+    # within-cluster sum of squares of a split of rows of values into two groups
+    sse = 0
+    for group in [labels, ~labels]:
+        if group.any():
+            sse += ((values[group] - values[group].mean(axis=0)) ** 2).sum()
+    return sse
+
+
+def histogram_2means(row, n_bins=1000, seed=42, n_check=5000, tol=0.01, order=None):
+    """Approximate 1D 2-means: the best split of a histogram of row values.
+
+    Per-bin counts, sums and sums of squares give the within-cluster sum of
+    squares (SSE) of every split between bins in O(n_bins) after a single pass
+    over the values. If order (argsort of row, see sort_rows()) is given,
+    every split between distinct sorted values is evaluated instead.
+    The result is checked against KMeans on a random subsample
+    of n_check values: if the SSE of the histogram split exceeds SSE of the
+    KMeans threshold (both evaluated on all values) by more than tol,
+    returns None. Otherwise returns a boolean array, True for values above the split.
+    """
+    if order is None:
+        counts, edges = np.histogram(row, bins=n_bins)
+        sums = np.histogram(row, bins=edges, weights=row)[0]
+        sq_sums = np.histogram(row, bins=edges, weights=row**2)[0]
+    else:
+        sums = row[order]
+        counts, sq_sums = np.ones(len(row)), sums**2
+    n1, s1, q1 = np.cumsum(counts)[:-1], np.cumsum(sums)[:-1], np.cumsum(sq_sums)[:-1]
+    n2, s2, q2 = len(row) - n1, sums.sum() - s1, sq_sums.sum() - q1
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sse = (q1 - s1**2 / n1) + (q2 - s2**2 / n2)
+    sse[(n1 == 0) | (n2 == 0)] = np.inf
+    if order is not None:
+        # equal values are not split
+        sse[sums[1:] == sums[:-1]] = np.inf
+    if not np.isfinite(sse).any():
+        return None
+    if order is None:
+        labels = row >= edges[np.argmin(sse) + 1]
+    else:
+        labels = np.zeros(len(row), dtype=bool)
+        labels[order[np.argmin(sse) + 1 :]] = True
+
+    # quality check
+    rng = np.random.default_rng(seed)
+    subsample = rng.choice(len(row), size=min(n_check, len(row)), replace=False)
+    model = KMeans(n_clusters=2, n_init=1, random_state=seed).fit(row[subsample, np.newaxis])
+    kmeans_labels = row >= model.cluster_centers_.mean()
+    row2d = row[:, np.newaxis]
+    if calc_split_sse(row2d, labels) > (1 + tol) * calc_split_sse(row2d, kmeans_labels):
+        return None
+    return labels
+
+
+def ward_split_sorted(sorted_values, tie_tol=1e-9):
+    """Two clusters of 1D Ward agglomerative clustering of sorted values.
+
+    In 1D, the closest pair of clusters by Ward's criterion is always a pair
+    of neighbours, so clusters stay intervals of sorted values and merges are
+    found with a heap of neighbour pairs in O(n log n) time and O(n) memory,
+    instead of the pairwise distances used by AgglomerativeClustering.
+    Returns the number of values in the lower cluster, or None if two
+    merges have equal costs (up to tie_tol) and the result may depend
+    on the order in which they are done.
+    """
+    n = len(sorted_values)
+    sizes = [1] * n
+    sums = [float(x) for x in sorted_values]
+    left = list(range(-1, n - 1))
+    right = list(range(1, n + 1))
+    right[-1] = -1
+    versions = [0] * n
+    alive = [True] * n
+
+    def merge_cost(a, b):
+        d = sums[a] / sizes[a] - sums[b] / sizes[b]
+        return sizes[a] * sizes[b] / (sizes[a] + sizes[b]) * d * d
+
+    def is_outdated(pair):
+        _, a, b, version_a, version_b = pair
+        return not (alive[a] and alive[b]) or versions[a] != version_a or versions[b] != version_b
+
+    heap = [(merge_cost(i, i + 1), i, i + 1, 0, 0) for i in range(n - 1)]
+    heapq.heapify(heap)
+    n_clusters = n
+    while n_clusters > 2:
+        pair = heapq.heappop(heap)
+        if is_outdated(pair):
+            continue
+        cost, a, b, _, _ = pair
+        # the next merge is compared with the current one only if it is up to date
+        while heap and is_outdated(heap[0]):
+            heapq.heappop(heap)
+        if cost > 0 and heap and heap[0][0] - cost <= tie_tol * cost:
+            return None  # the order of tied merges is implementation-specific
+        # merge b into a
+        sizes[a] += sizes[b]
+        sums[a] += sums[b]
+        alive[b] = False
+        versions[a] += 1
+        right[a] = right[b]
+        if right[b] != -1:
+            left[right[b]] = a
+        n_clusters -= 1
+        if left[a] != -1:
+            heapq.heappush(
+                heap, (merge_cost(left[a], a), left[a], a, versions[left[a]], versions[a])
+            )
+        if right[a] != -1:
+            heapq.heappush(
+                heap, (merge_cost(a, right[a]), a, right[a], versions[a], versions[right[a]])
+            )
+    return sizes[0]
+
+
+def sort_rows(exprs, chunksize=10000):
+    """Argsort of each row of a features x samples matrix.
+
+    Computed once per standardized matrix and shared by binarizations with
+    different methods and seeds. Indexes are stored as uint16 (or uint32
+    for more than 65535 samples); sorted values of a row are row[order].
+    """
+    n_rows, n_samples = exprs.shape
+    dtype = np.uint16 if n_samples <= np.iinfo(np.uint16).max else np.uint32
+    order = np.empty((n_rows, n_samples), dtype=dtype)
+    for start in range(0, n_rows, chunksize):
+        row_indexes = np.arange(start, min(start + chunksize, n_rows))
+        if hasattr(exprs, "get_rows"):  # SparseExprs or DiskExprs
+            values = exprs.get_rows(row_indexes)
+        else:
+            values = np.asarray(exprs.values[start : start + chunksize])
+        order[start : start + chunksize] = np.argsort(values, axis=1, kind="stable")
+    return order
+
+
+def calc_kmeans_split_snr(sorted_values, tol=0.05):
+    """Bicluster sizes and |SNR| (see calc_SNR()) of all splits of each row of sorted_values
+    which 'kmeans' binarization can give, in O(N) time per row from prefix sums.
+
+    A converged 1D 2-means splits values by the midpoint of the two group means;
+    splits with the midpoint within tol standard deviations of the split are kept.
+    The smaller group and the sign filter of select_pos_neg() are applied.
+    Returns two arrays of shape (n_rows, 2*(N-1)); other splits have size and SNR 0.
+    """
+    values = np.asarray(sorted_values, dtype=np.float64)
+    n_rows, N = values.shape
+    x = values - values.mean(axis=1)[:, np.newaxis]  # for accurate sums of squares
+    S = np.zeros((n_rows, N + 1))
+    np.cumsum(x, axis=1, out=S[:, 1:])
+    Q = np.zeros((n_rows, N + 1))
+    np.cumsum(x**2, axis=1, out=Q[:, 1:])
+    S_total, Q_total = S[:, -1:], Q[:, -1:]
+
+    # splits of j lower and N-j upper values close to a fixed point of 2-means
+    j = np.arange(1, N)[np.newaxis, :]
+    midpoint = (S[:, 1:-1] / j + (S_total - S[:, 1:-1]) / (N - j)) / 2
+    delta = tol * np.sqrt(Q_total / N)
+    is_split = (x[:, :-1] - delta <= midpoint) & (midpoint <= x[:, 1:] + delta)
+    is_split &= values[:, :-1] != values[:, 1:]  # equal values are not split
+
+    rows = np.arange(n_rows)[:, np.newaxis]
+    n_neg = (values < 0).sum(axis=1)[:, np.newaxis]
+    n_nonpos = (values <= 0).sum(axis=1)[:, np.newaxis]
+    all_sizes, all_snr = [], []
+    for start, end in [(np.zeros_like(j), j), (j, np.full_like(j, N))]:
+        start, end = np.broadcast_to(start, is_split.shape), np.broadcast_to(end, is_split.shape)
+        valid = is_split & (end - start <= N - (end - start))  # the smaller group
+        # values of the other sign than the group median are removed
+        median = (values[rows, (start + end - 1) // 2] + values[rows, (start + end) // 2]) / 2
+        start, end = (
+            np.where(median >= 0, np.clip(n_neg, start, end), start),
+            np.where(median >= 0, end, np.clip(n_nonpos, start, end)),
+        )
+        k = end - start
+        valid &= (k > 0) & (k < N)
+        k = np.where(valid, k, 1)
+        sums = S[rows, end] - S[rows, start]
+        sq_sums = Q[rows, end] - Q[rows, start]
+        mean_w, mean_rest = sums / k, (S_total - sums) / (N - k)
+        std_w = np.sqrt(np.maximum(sq_sums / k - mean_w**2, 0))
+        std_rest = np.sqrt(np.maximum((Q_total - sq_sums) / (N - k) - mean_rest**2, 0))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            snr = np.abs(mean_w - mean_rest) / (std_w + std_rest)
+        snr[~valid | np.isnan(snr)] = 0
+        all_sizes.append(np.where(valid, k, 0))
+        all_snr.append(snr)
+    return np.hstack(all_sizes), np.hstack(all_snr)
+
+
+def get_min_passing_snr(null_distribution, N, sizes, pval, seed=42):
+    """SNR values that must be exceeded to get calc_e_pval() <= pval for each size.
+
+    Sizes missing in null_distribution are not added to it: their SNR are
+    computed from prefix sums of the values of sample_null_values(seed=seed).
+    """
+    sizes = np.asarray(sizes)
+    n_permutations = null_distribution.shape[1]
+    # (number of null SNR >= snr + 1)/(n_permutations + 1) <= pval
+    n_allowed = int(np.floor(pval * (n_permutations + 1) - 1 + 1e-9))
+    if n_allowed < 0:
+        return np.full(len(sizes), np.inf)
+    if n_allowed >= n_permutations:
+        return np.full(len(sizes), -np.inf)
+    min_snr = np.zeros(len(sizes))
+    known = np.isin(sizes, null_distribution.index.values)
+    if known.any():
+        null = null_distribution.loc[sizes[known], :].values
+        min_snr[known] = -np.partition(-null, n_allowed, axis=1)[:, n_allowed]
+    if not known.all():
+        exprs = sample_null_values(N, n_permutations, seed=seed)
+        sq_sums = np.cumsum(np.square(exprs), axis=1)
+        sums = np.cumsum(exprs, axis=1, out=exprs)
+        missing = np.where(~known)[0]
+        for block_start in range(0, len(missing), 100):
+            block = missing[block_start : block_start + 100]
+            s = sizes[block]
+            bic_mean, bic_std = calc_mean_std_by_powers((s, sums[:, s - 1], sq_sums[:, s - 1]))
+            bg_mean, bg_std = calc_mean_std_by_powers(
+                (N - s, sums[:, -1:] - sums[:, s - 1], sq_sums[:, -1:] - sq_sums[:, s - 1])
+            )
+            null = (bg_mean - bic_mean) / (bic_std + bg_std)
+            min_snr[block] = -np.partition(-null, n_allowed, axis=0)[n_allowed]
+    return min_snr
+
+
+def _sorted_chunks(exprs, sorted_rows=None, chunksize=100):
+    """Yields indexes and sorted values of chunks of rows of exprs."""
+    n_rows = exprs.shape[0]
+    for start in range(0, n_rows, chunksize):
+        row_indexes = np.arange(start, min(start + chunksize, n_rows))
+        if hasattr(exprs, "get_rows"):  # SparseExprs or DiskExprs
+            values = exprs.get_rows(row_indexes)
+        else:
+            values = np.asarray(exprs.values[start : start + chunksize])
+        if sorted_rows is None:
+            values = np.sort(values, axis=1)
+        else:
+            values = np.take_along_axis(values, sorted_rows[row_indexes].astype(int), axis=1)
+        yield row_indexes, values
+
+
+def calc_2means_sizes(sorted_values, min_n_samples):
+    """Bicluster sizes given by the optimal 2-means split of each row of sorted_values,
+    with the smaller group and the sign filter of select_pos_neg(); 0 if below min_n_samples.
+
+    'kmeans' binarization usually finds this split.
+    """
+    values = np.asarray(sorted_values, dtype=np.float64)
+    n_rows, N = values.shape
+    if N < 2:
+        return np.zeros(n_rows, dtype=int)
+    x = values - values.mean(axis=1)[:, np.newaxis]
+    S = np.cumsum(x, axis=1)
+    S_total, S = S[:, -1:], S[:, :-1]
+    n_lower = np.arange(1, N)[np.newaxis, :]
+    # minimal within-group sum of squares <=> maximal between-group term
+    between = S**2 / n_lower + (S_total - S) ** 2 / (N - n_lower)
+    between[values[:, :-1] == values[:, 1:]] = -np.inf  # equal values are not split
+    n_lower = np.argmax(between, axis=1) + 1
+    has_split = np.isfinite(between.max(axis=1))
+
+    rows = np.arange(n_rows)
+    n_neg = (values < 0).sum(axis=1)
+    n_nonpos = (values <= 0).sum(axis=1)
+    # the smaller group is a prefix [0, n_lower) or a suffix [n_lower, N)
+    lower = n_lower <= N - n_lower
+    start = np.where(lower, 0, n_lower)
+    end = np.where(lower, n_lower, N)
+    median = (values[rows, (start + end - 1) // 2] + values[rows, (start + end) // 2]) / 2
+    sizes = np.where(
+        median >= 0,
+        np.clip(end - np.maximum(start, n_neg), 0, None),  # values >= 0
+        np.clip(np.minimum(end, n_nonpos) - start, 0, None),  # values <= 0
+    )
+    sizes[~has_split | (sizes < min_n_samples)] = 0
+    return sizes
+
+
+def get_kmeans_trend_sizes(exprs, min_n_samples, sorted_rows=None):
+    """Bicluster sizes the SNR threshold trend of 'kmeans' binarization is fitted on:
+    sizes from get_null_sizes(), N/2 and sizes from calc_2means_sizes() for all features.
+
+    Unlike sizes of binarized features, they are known before binarization,
+    so features skipped by prescreen_features() do not change the trend.
+    """
+    N = exprs.shape[1]
+    sizes = set(map(int, get_null_sizes(N, min_n_samples)))
+    if int(N / 2) >= min_n_samples:
+        sizes.add(int(N / 2))
+    for _, values in _sorted_chunks(exprs, sorted_rows=sorted_rows, chunksize=1000):
+        sizes.update(map(int, calc_2means_sizes(values, min_n_samples)))
+    sizes.discard(0)
+    return np.array(sorted(sizes))
+
+
+def prescreen_features(
+    exprs,
+    thresholds,
+    min_n_samples,
+    sorted_rows=None,
+    chunksize=100,
+    margin=1e-3,
+):
+    """Finds features which may pass 'kmeans' binarization.
+
+    thresholds are SNR values required for bicluster sizes from min_n_samples
+    to N/2 (see prepare_prescreen()). A feature is rejected only if none of its
+    splits from calc_kmeans_split_snr() has SNR exceeding the threshold for its size.
+    margin is a relative tolerance for rounding errors.
+    Returns a boolean array, True for passed features; binarize() keeps
+    the others in stats with pval=1 and True in the "prescreened" column.
+    """
+    n_rows, N = exprs.shape
+    passed = np.ones(n_rows, dtype=bool)
+    if int(N / 2) < min_n_samples:
+        return passed
+    size_thresholds = np.full(N + 1, np.inf)
+    size_thresholds[min_n_samples : int(N / 2) + 1] = thresholds
+    for row_indexes, values in _sorted_chunks(exprs, sorted_rows=sorted_rows, chunksize=chunksize):
+        sizes, snr = calc_kmeans_split_snr(values)
+        passed[row_indexes] = (snr * (1 + margin) > size_thresholds[sizes]).any(axis=1)
+    return passed
+
+
+def needs_sorted_rows(method, n_samples):
+    """Whether binarization with method uses sorted rows (see sort_rows())."""
+    return method == "ward" or (method == "kmeans" and n_samples >= HISTOGRAM_MIN_SAMPLES)
+
+
+def select_pos_neg(row, min_n_samples, seed=42, prob_cutoff=0.5, method="GMM", order=None):
     """ find 'higher' (positive), and 'lower' (negative) signal in vals. 
         vals are found with GM binarization
+        order - optional argsort of row (see sort_rows()), used by 'ward' and 'kmeans'
     """
     is_converged = None
     if method == "GMM":
@@ -328,14 +811,26 @@ def select_pos_neg(row, min_n_samples, seed=42, prob_cutoff=0.5, method="GMM"):
 
     elif method in ["kmeans", "ward"]:
         row2d = row[:, np.newaxis]  # adding mock axis
-        if method == "kmeans":
-            model = KMeans(n_clusters=2, max_iter=len(row), n_init=1, random_state=seed)
-        elif method == "ward":
-            model = AgglomerativeClustering(n_clusters=2, linkage="ward")
-        # elif method == "HC_ward":
-        #    model = Ward(n_clusters=2)
         labels = np.zeros(len(row), dtype=bool)
-        pred_labels = model.fit_predict(row2d)
+        pred_labels = None
+        if method == "ward":
+            # ward on sorted values, same clusters as AgglomerativeClustering
+            if order is None:
+                order = np.argsort(row, kind="stable")
+            n_lower = ward_split_sorted(row[order])
+            if n_lower is not None:
+                pred_labels = np.ones(len(row), dtype=int)
+                pred_labels[order[:n_lower]] = 0
+        elif len(row) >= HISTOGRAM_MIN_SAMPLES:
+            pred_labels = histogram_2means(row, seed=seed, order=order)
+            if pred_labels is not None:
+                pred_labels = pred_labels.astype(int)
+        if pred_labels is None:
+            if method == "kmeans":
+                model = KMeans(n_clusters=2, max_iter=len(row), n_init=1, random_state=seed)
+            else:
+                model = AgglomerativeClustering(n_clusters=2, linkage="ward")
+            pred_labels = model.fit_predict(row2d)
         # let labels == True be always a smaller sample set
         if len(pred_labels[pred_labels == 1]) >= len(pred_labels[pred_labels == 0]):
             labels[pred_labels == 0] = True
@@ -392,82 +887,278 @@ def sklearn_binarization(
     seed=1,
     prob_cutoff=0.5,
     method="GMM",
+    sorted_rows=None,
+    passed=None,
+    packed=False,
 ):
+    """Binarizes each row of exprs with select_pos_neg().
+
+    sorted_rows - optional argsorts of rows computed by sort_rows(exprs),
+    shared by binarizations with different methods and seeds.
+    method - a method name or a list of names; with a list, each row is
+    extracted once and binarized by all methods, and a dict
+    {method: (binarized_expressions, stats)} is returned.
+    passed - optional boolean array returned by prescreen_features():
+    other rows are not binarized and marked in the "prescreened" column of stats.
+    packed - if True, binarized expressions are collected as bit-packed masks
+    and returned as a BinarizedMatrix instead of a DataFrame of 0/1 integers.
+    """
     t0 = time()
 
-    binarized_expressions = {}
-
-    stats = {}
+    single_method = isinstance(method, str)
+    methods = [method] if single_method else list(method)
+    binarized_expressions = {method: {} for method in methods}
+    stats = {method: {} for method in methods}
     for i, (gene, row) in enumerate(exprs.iterrows()):
         e_pval = -1
         row = row.values
-        pos_mask, neg_mask, snr, size, is_converged = select_pos_neg(
-            row, min_n_samples, seed=seed, prob_cutoff=prob_cutoff, method=method
-        )
 
         # logging
         if verbose:
             if i % 1000 == 0:
                 print("\t\tgenes processed:", i)
 
-        up_group = row[pos_mask]
-        down_group = row[neg_mask]
-        n_up = len(up_group)
-        n_down = len(down_group)
+        if passed is not None and not passed[i]:
+            for method in methods:
+                stats[method][gene] = {
+                    "pval": 1,
+                    "SNR": np.nan,
+                    "size": np.nan,
+                    "direction": None,
+                    "convergence": None,
+                    "prescreened": True,
+                }
+            continue
+
+        for method in methods:
+            pos_mask, neg_mask, snr, size, is_converged = select_pos_neg(
+                row,
+                min_n_samples,
+                seed=seed,
+                prob_cutoff=prob_cutoff,
+                method=method,
+                order=None if sorted_rows is None else sorted_rows[i],
+            )
+
+            up_group = row[pos_mask]
+            down_group = row[neg_mask]
+            n_up = len(up_group)
+            n_down = len(down_group)
+
+            # if smaller sample group shows over- or under-expression
+            if n_up <= n_down:  # up-regulated group is bicluster
+                mask = pos_mask
+                direction = "UP"
+            else:  # down-regulated group is bicluster
+                mask = neg_mask
+                direction = "DOWN"
+            binarized_expressions[method][gene] = (
+                np.packbits(mask) if packed else mask.astype(int)
+            )
+
+            stats[method][gene] = {
+                "pval": 0,
+                "SNR": snr,
+                "size": size,
+                "direction": direction,
+                "convergence": is_converged,
+            }
+            if passed is not None:
+                stats[method][gene]["prescreened"] = False
+
+            if gene in show_fits or (abs(snr) > plot_SNR_thr and plot):
+                hist_range = row.min(), row.max()
+
+                # set colors to two sample groups
+                # red - overexpression
+                # blue - under-expression
+                # grey - background (group size > 1/2 of all samples)
+                colors = ["grey", "grey"]
+
+                if n_down - n_up >= 0:  # up-regulated group is bicluster
+                    colors[1] = "red"
+
+                if n_up - n_down > 0:  # down-regulated group is bicluster
+                    colors[0] = "blue"
+
+                # in case of insignificant size difference
+                # between up- and down-regulated groups
+                # the bigger half is treated as signal too
+                if abs(n_up - n_down) <= min_n_samples:
+                    colors = "blue", "red"
+
+                # plotting
+                plot_binarized_feature(gene, down_group, up_group, colors, hist_range, snr)
+
+    results = {}
+    for method in methods:
+        if packed:
+            genes = list(binarized_expressions[method].keys())
+            masks = np.zeros((len(genes), (exprs.shape[1] + 7) // 8), dtype=np.uint8)
+            for j, gene in enumerate(genes):
+                masks[j] = binarized_expressions[method][gene]
+            binarized = BinarizedMatrix(masks, exprs.shape[1], columns=genes)
+        else:
+            binarized = pd.DataFrame.from_dict(binarized_expressions[method])
+        results[method] = (binarized, pd.DataFrame.from_dict(stats[method]).T)
 
-        # if smaller sample group shows over- or under-expression
-        if n_up <= n_down:  # up-regulated group is bicluster
-            binarized_expressions[gene] = pos_mask.astype(int)
-            direction = "UP"
-        else:  # down-regulated group is bicluster
-            binarized_expressions[gene] = neg_mask.astype(int)
-            direction = "DOWN"
+    # logging
+    if verbose:
+        print(
+            "\tBinarization for {} features completed in {:.2f} s".format(
+                exprs.shape[0], time() - t0
+            )
+        )
 
-        stats[gene] = {
-            "pval": 0,
-            "SNR": snr,
-            "size": size,
-            "direction": direction,
-            "convergence": is_converged,
-        }
+    if single_method:
+        return results[methods[0]]
+    return results
 
-        if gene in show_fits or (abs(snr) > plot_SNR_thr and plot):
-            hist_range = row.min(), row.max()
 
-            # set colors to two sample groups
-            # red - overexpression
-            # blue - under-expression
-            # grey - background (group size > 1/2 of all samples)
-            colors = ["grey", "grey"]
+def save_binarization(fname, binarized_data, stats):
+    """Saves binarized features (a DataFrame or a BinarizedMatrix) as bit-packed
+    masks and their statistics column by column to a .npz file."""
+    if isinstance(binarized_data, BinarizedMatrix):
+        masks = binarized_data.masks.T  # bits of each feature along samples
+    else:
+        masks = np.packbits(binarized_data.values.astype(bool), axis=0)
+    arrays = {
+        "masks": masks,
+        "n_samples": np.array(binarized_data.shape[0]),
+        "features": np.array(binarized_data.columns.values, dtype=str),
+        "stats_index": np.array(stats.index.values, dtype=str),
+        "stats_columns": np.array(stats.columns.values, dtype=str),
+    }
+    for i, col in enumerate(stats.columns.values):
+        values = stats[col].values
+        if values.dtype != object:
+            arrays["stats_%s" % i] = values
+            continue
+        # object columns: numbers or strings and None
+        is_none = np.array([x is None for x in values])
+        try:
+            values = np.array([np.nan if x is None else float(x) for x in values])
+        except (TypeError, ValueError):
+            values = np.array(["" if x is None else str(x) for x in values], dtype=str)
+        arrays["stats_%s" % i] = values
+        arrays["stats_%s_none" % i] = is_none
+    tmp_fname = fname + ".tmp.npz"
+    np.savez(tmp_fname, **arrays)
+    os.replace(tmp_fname, fname)
+
+
+def load_binarization(fname, packed=False):
+    """Loads binarized features and statistics saved by save_binarization().
+    With packed=True, binarized features are returned as a BinarizedMatrix."""
+    with np.load(fname) as arrays:
+        n_samples = int(arrays["n_samples"])
+        if packed:
+            binarized_data = BinarizedMatrix(
+                arrays["masks"].T, n_samples, columns=arrays["features"].astype(object)
+            )
+        else:
+            masks = np.unpackbits(arrays["masks"], axis=0, count=n_samples)
+            binarized_data = pd.DataFrame(
+                masks.astype(int), columns=arrays["features"].astype(object)
+            )
+        stats = {}
+        for i, col in enumerate(arrays["stats_columns"]):
+            values = arrays["stats_%s" % i]
+            if "stats_%s_none" % i in arrays:
+                is_none = arrays["stats_%s_none" % i]
+                if values.dtype.kind == "f":
+                    values = np.where(is_none, 0, values)
+                    integral = np.all(values == np.round(values))
+                    values = values.astype(int if integral else float).astype(object)
+                else:
+                    values = values.astype(object)
+                values[is_none] = None
+            stats[str(col)] = values
+        stats = pd.DataFrame(stats, index=arrays["stats_index"].astype(object))
+    return binarized_data, stats
 
-            if n_down - n_up >= 0:  # up-regulated group is bicluster
-                colors[1] = "red"
 
-            if n_up - n_down > 0:  # down-regulated group is bicluster
-                colors[0] = "blue"
+def get_binarization_cache_fname(
+    binarized_fname_prefix, exprs_hash, method, seed, min_n_samples, prob_cutoff, *extra
+):
+    """<prefix>.binarization.<hash>.npz named by a hash of exprs and parameters;
+    exprs_hash is hash_data(exprs), computed once for all methods.
 
-            # in case of insignificant size difference
-            # between up- and down-regulated groups
-            # the bigger half is treated as signal too
-            if abs(n_up - n_down) <= min_n_samples:
-                colors = "blue", "red"
+    binarize() writes binarized features and raw statistics there with save=True,
+    and with load=True prefers this file over binarized.tsv and binarization_stats.tsv.
+    """
+    from unpast.utils.checkpoint import hash_data
 
-            # plotting
-            plot_binarized_feature(gene, down_group, up_group, colors, hist_range, snr)
+    return (
+        binarized_fname_prefix
+        + ".binarization."
+        + hash_data(exprs_hash, method, seed, min_n_samples, prob_cutoff, *extra)
+        + ".npz"
+    )
 
-    stats = pd.DataFrame.from_dict(stats).T
 
-    binarized_expressions = pd.DataFrame.from_dict(binarized_expressions)
+def get_sorted_rows(
+    binarized_fname_prefix, exprs, load=False, save=False, verbose=True, exprs_hash=None
+):
+    """sort_rows(exprs) cached in <prefix>.sorted_rows.<hash>.npy named by a hash of exprs.
 
-    # logging
+    The cache is read if load and written if save, so binarizations of the same
+    matrix with other methods and seeds do not sort its rows again.
+    binarize() calls it when sorted_rows are not given and the method
+    needs them (see needs_sorted_rows()).
+    exprs_hash is an optional precomputed hash_data(exprs).
+    """
+    from unpast.utils.checkpoint import hash_data
+
+    fname = None
+    if load or save:
+        if exprs_hash is None:
+            exprs_hash = hash_data(exprs)
+        fname = binarized_fname_prefix + ".sorted_rows." + exprs_hash + ".npy"
+    if load and os.path.exists(fname):
+        if verbose:
+            print("Load sorted rows from", fname, file=sys.stdout)
+        return np.load(fname)
+    t0 = time()
+    sorted_rows = sort_rows(exprs)
     if verbose:
-        print(
-            "\tBinarization for {} features completed in {:.2f} s".format(
-                len(exprs), time() - t0
-            )
-        )
+        print("\tRows sorted in {:.2f} s".format(time() - t0), file=sys.stdout)
+    if save and not os.path.exists(fname):
+        fpath = os.path.dirname(fname)
+        if fpath and not os.path.exists(fpath):
+            os.makedirs(fpath)
+        tmp_fname = fname + ".tmp.npy"
+        np.save(tmp_fname, sorted_rows)
+        os.replace(tmp_fname, fname)
+    return sorted_rows
+
 
-    return binarized_expressions, stats
+def prepare_prescreen(
+    exprs, null_distribution, trend_sizes, min_n_samples, pval, n_permutations, seed, verbose
+):
+    """SNR thresholds for prescreen_features(): for each size from min_n_samples to N/2,
+    the minimum of the SNR threshold trend of binarize() fitted on trend_sizes
+    (see get_kmeans_trend_sizes()) and the SNR required for the empirical
+    p-value <= pval (see get_min_passing_snr()).
+    Returns the null distribution extended with trend_sizes and the thresholds."""
+    N = exprs.shape[1]
+    null_dtype = np.float32 if np.all(exprs.dtypes == np.float32) else np.float64
+    null_distribution = extend_null_dist(
+        null_distribution,
+        N,
+        trend_sizes,
+        n_permutations=n_permutations,
+        pval=pval,
+        seed=seed,
+        verbose=verbose,
+        dtype=null_dtype,
+    )
+    sizes = np.arange(min_n_samples, int(N / 2) + 1)
+    size_snr_trend = get_snr_trend(null_distribution, trend_sizes, pval, verbose=verbose)
+    thresholds = np.minimum(
+        size_snr_trend(sizes), get_min_passing_snr(null_distribution, N, sizes, pval, seed=seed)
+    )
+    return null_distribution, thresholds
 
 
 def binarize(
@@ -485,11 +1176,52 @@ def binarize(
     seed=random.randint(0, 100000),
     prob_cutoff=0.5,
     n_permutations=10000,
+    null_distribution=None,
+    binarization=None,
+    sorted_rows=None,
+    prescreen=False,
+    packed=False,
+    exprs_hash=None,
 ):
     """
        binarized_fname_prefix is a basename of binarized data file;
-       exprs is a dataframe with normalized features to be binarized.
+       exprs is a dataframe with normalized features to be binarized;
+       null_distribution is an optional precomputed background SNR distribution
+       (bicluster sizes x permutations), e.g. shared by runs with different seeds;
+       sizes missing in it are generated with this seed;
+       binarization is an optional pair of binarized data and statistics
+       returned by sklearn_binarization(), e.g. shared by runs with different pval;
+       method can be a list of methods (see binarize_methods());
+       save and load also write and read get_binarization_cache_fname();
+       sorted_rows is an optional argsort of rows (see get_sorted_rows());
+       prescreen=True skips kmeans features which can not pass (see prescreen_features());
+       with packed=True, binarized features are a BinarizedMatrix
+       saved to <...>.binarized.npz;
+       exprs_hash is an optional precomputed hash_data(exprs).
     """
+    if not isinstance(method, str):
+        return binarize_methods(
+            binarized_fname_prefix,
+            exprs=exprs,
+            methods=method,
+            save=save,
+            load=load,
+            min_n_samples=min_n_samples,
+            pval=pval,
+            plot_all=plot_all,
+            plot_SNR_thr=plot_SNR_thr,
+            show_fits=show_fits,
+            verbose=verbose,
+            seed=seed,
+            prob_cutoff=prob_cutoff,
+            n_permutations=n_permutations,
+            null_distribution=null_distribution,
+            binarizations=binarization,
+            sorted_rows=sorted_rows,
+            prescreen=prescreen,
+            packed=packed,
+            exprs_hash=exprs_hash,
+        )
     t0 = time()
 
     # a file with binarized gene expressions
@@ -503,6 +1235,8 @@ def binarize(
         + str(min_n_samples)
         + ".binarized.tsv"
     )
+    # bit-packed binarized features
+    bin_packed_fname = bin_exprs_fname[: -len(".tsv")] + ".npz"
     # a file with statistics of binarization results
     bin_stats_fname = (
         binarized_fname_prefix
@@ -527,8 +1261,58 @@ def binarize(
         + ".background.tsv"
     )
 
-    if load:
+    if prescreen and method != "kmeans":
+        print("prescreen is only used with kmeans binarization", file=sys.stderr)
+        prescreen = False
+    # the SNR threshold trend of 'kmeans' does not depend on binarized features
+    trend_sizes = None
+    if method == "kmeans" and exprs is not None:
+        trend_sizes = get_kmeans_trend_sizes(exprs, min_n_samples, sorted_rows=sorted_rows)
+    prescreen_params = ()
+    if prescreen and exprs is not None and binarization is None:
+        null_distribution, thresholds = prepare_prescreen(
+            exprs,
+            null_distribution,
+            trend_sizes,
+            min_n_samples,
+            pval,
+            n_permutations,
+            seed,
+            verbose,
+        )
+        prescreen_params = ("prescreen", pval, thresholds)
+
+    # binarization results cached under a hash of the input matrix
+    # and of the binarization parameters
+    computed = False
+    if (load or save) and exprs is not None:
+        if exprs_hash is None:
+            from unpast.utils.checkpoint import hash_data
+
+            exprs_hash = hash_data(exprs)
+        bin_cache_fname = get_binarization_cache_fname(
+            binarized_fname_prefix,
+            exprs_hash,
+            method,
+            seed,
+            min_n_samples,
+            prob_cutoff,
+            *prescreen_params
+        )
+        if load and binarization is None and os.path.exists(bin_cache_fname):
+            binarization = load_binarization(bin_cache_fname, packed=packed)
+            if verbose:
+                print(
+                    "Load binarized features and statistics from",
+                    bin_cache_fname,
+                    "\n",
+                    file=sys.stdout,
+                )
+
+    if load and binarization is None:
         load_failed = False
+        if packed and os.path.exists(bin_packed_fname):
+            bin_exprs_fname = bin_packed_fname
         try:
             if verbose:
                 print(
@@ -538,7 +1322,10 @@ def binarize(
                     file=sys.stdout,
                 )
             # load binary expressions
-            binarized_data = pd.read_csv(bin_exprs_fname, sep="\t", index_col=0)
+            if bin_exprs_fname == bin_packed_fname:
+                binarized_data = load_binarized_matrix(bin_packed_fname)
+            else:
+                binarized_data = pd.read_csv(bin_exprs_fname, sep="\t", index_col=0)
         except:
             print(
                 "file " + bin_exprs_fname + " is not found and will be created",
@@ -556,8 +1343,27 @@ def binarize(
                 file=sys.stderr,
             )
             load_failed = True
+        if not load_failed and exprs is not None:
+            # files without a hash can only be checked roughly
+            if binarized_data.shape[0] != exprs.shape[1] or not set(
+                stats.index.values
+            ).issubset(set(exprs.index.values)):
+                print(
+                    "Binarization results in %s do not match the input and will be recomputed"
+                    % bin_exprs_fname,
+                    file=sys.stderr,
+                )
+                load_failed = True
+            else:
+                print(
+                    "Binarization results in %s and %s are not checked against input values and parameters"
+                    % (bin_exprs_fname, bin_stats_fname),
+                    file=sys.stderr,
+                )
 
-    if not load or load_failed:
+    if binarization is not None:
+        binarized_data, stats = binarization
+    elif not load or load_failed:
         if exprs is None:
             print("Provide either raw or binarized data.", file=sys.stderr)
             return None
@@ -570,6 +1376,24 @@ def binarize(
         t0 = time()
 
         if method in ["GMM", "kmeans", "ward"]:
+            if sorted_rows is None and needs_sorted_rows(method, exprs.shape[1]):
+                sorted_rows = get_sorted_rows(
+                    binarized_fname_prefix,
+                    exprs,
+                    load=load,
+                    save=save,
+                    verbose=verbose,
+                    exprs_hash=exprs_hash,
+                )
+            passed = None
+            if prescreen:
+                passed = prescreen_features(exprs, thresholds, min_n_samples, sorted_rows=sorted_rows)
+                if verbose:
+                    print(
+                        "\tPre-screen: %s of %s features can not pass the SNR threshold"
+                        % ((~passed).sum(), len(passed)),
+                        file=sys.stdout,
+                    )
             binarized_data, stats = sklearn_binarization(
                 exprs,
                 min_n_samples,
@@ -580,24 +1404,40 @@ def binarize(
                 verbose=verbose,
                 seed=seed,
                 method=method,
+                sorted_rows=sorted_rows,
+                passed=passed,
+                packed=packed,
             )
+            computed = True
         else:
             print("Method must be 'GMM','kmeans', or 'ward'.", file=sys.stderr)
             return
 
+    if packed and not isinstance(binarized_data, BinarizedMatrix):
+        binarized_data = pack_binarized(binarized_data)
+    elif not packed and isinstance(binarized_data, BinarizedMatrix):
+        binarized_data = binarized_data.to_dense()
+
     # load or generate empirical distributions for all bicluster sizes
     N = exprs.shape[1]
+    # float32 inputs get float32 background distributions
+    null_dtype = np.float32 if np.all(exprs.dtypes == np.float32) else np.float64
     # sizes of binarized features
-    sizes1 = set([x for x in stats["size"].values if not np.isnan(x)])
+    sizes1 = set([int(x) for x in stats["size"].values if not np.isnan(x)])
     # no more than 100 of bicluster sizes are computed
-    # step = max(int((N - min_n_samples) / 100), 1) 
-    step = max(int((int(N / 2) - min_n_samples) / 100), 1) 
-    #sizes2 = set(map(int, np.arange(min_n_samples, int(N / 2), step)))
-    sizes2 = set(map(int, np.arange(min_n_samples, int(N / 2)+1, step)))
+    sizes2 = set(map(int, get_null_sizes(N, min_n_samples)))
+    if trend_sizes is not None:
+        sizes2 |= set(map(int, trend_sizes))
     sizes = np.array(sorted(sizes1 | sizes2))
 
+    precomputed = null_distribution is not None
+    if precomputed:
+        null_distribution = extend_null_dist(
+            null_distribution, N, sizes, pval=pval, seed=seed, verbose=verbose, dtype=null_dtype
+        )
+
     load_failed = False
-    if load:
+    if load and not precomputed:
         try:
             # load background distribution
             null_distribution = pd.read_csv(bin_bg_fname, sep="\t", index_col=0)
@@ -622,6 +1462,7 @@ def binarize(
                     n_permutations=n_permutations,
                     seed=seed,
                     verbose=verbose,
+                    dtype=null_dtype,
                 )
                 null_distribution2.columns = [
                     int(x) for x in null_distribution2.columns.values
@@ -649,7 +1490,7 @@ def binarize(
                 file=sys.stderr,
             )
             load_failed = True
-    if not load or load_failed:
+    if not precomputed and (not load or load_failed):
         null_distribution = generate_null_dist(
             N,
             sizes,
@@ -657,10 +1498,24 @@ def binarize(
             n_permutations=n_permutations,
             seed=seed,
             verbose=verbose,
+            dtype=null_dtype,
         )
 
+    if save and computed and not os.path.exists(bin_cache_fname):
+        fpath = os.path.dirname(bin_cache_fname)
+        if fpath and not os.path.exists(fpath):
+            os.makedirs(fpath)
+        save_binarization(bin_cache_fname, binarized_data, stats)
+        if verbose:
+            print("Binarization results are cached in", bin_cache_fname, file=sys.stdout)
+
     # if not load or load_failed:
     # add SNR p-val depends on bicluster size
+    prescreened = None
+    if "prescreened" in stats.columns:
+        # features rejected by the pre-screen are kept in stats with pval=1
+        prescreened = stats.loc[stats["prescreened"].astype(bool), :].copy()
+        stats = stats.loc[~stats["prescreened"].astype(bool), :]
     stats = stats.dropna(subset=["size"])
     stats["pval"] = stats.apply(
         lambda row: calc_e_pval(row["SNR"], row["size"], null_distribution), axis=1
@@ -669,9 +1524,15 @@ def binarize(
     stats["pval_BH"] = pval_adj
 
     # find SNR threshold
-    thresholds = np.quantile(null_distribution.loc[sizes, :].values, q=1 - pval, axis=1)
-    size_snr_trend = get_trend(sizes, thresholds, plot=False, verbose=verbose)
+    if trend_sizes is None:
+        trend_sizes = sizes
+    size_snr_trend = get_snr_trend(null_distribution, trend_sizes, pval, verbose=verbose)
     stats["SNR_threshold"] = stats["size"].apply(lambda x: size_snr_trend(x))
+    if prescreened is not None and prescreened.shape[0] > 0:
+        prescreened["pval"] = 1.0
+        prescreened["pval_BH"] = 1.0
+        prescreened["SNR_threshold"] = np.nan
+        stats = pd.concat([stats, prescreened.loc[:, stats.columns]], axis=0)
 
     if save:
         # save binarized data
@@ -679,8 +1540,13 @@ def binarize(
         if not os.path.exists(fpath):
             os.makedirs(fpath)
 
+        if packed:
+            bin_exprs_fname = bin_packed_fname
         if not os.path.exists(bin_exprs_fname):
-            binarized_data.to_csv(bin_exprs_fname, sep="\t")
+            if packed:
+                binarized_data.save(bin_exprs_fname)
+            else:
+                binarized_data.to_csv(bin_exprs_fname, sep="\t")
             if verbose:
                 print(
                     "Binarized gene expressions are saved to",
@@ -695,7 +1561,7 @@ def binarize(
                 print("Statistics is saved to", bin_stats_fname, file=sys.stdout)
 
         # save null distribution: null_distribution, size,threshold
-        if not os.path.exists(bin_bg_fname):
+        if not os.path.exists(bin_bg_fname) and not precomputed:
             null_distribution.to_csv(bin_bg_fname, sep="\t")
             if verbose:
                 print(
@@ -720,9 +1586,15 @@ def binarize(
         # print("\t\tambiguous features:\t%s"%(passed.loc[passed["direction"]=="UP,DOWN",:].shape[0]),file = sys.stdout)
 
     # keep only binarized features
-    binarized_data = binarized_data.loc[:, list(passed.index.values)]
-    # add sample names
-    binarized_data.index = exprs.columns.values
+    if packed:
+        binarized_data = binarized_data.select(list(passed.index.values))
+        binarized_data.directions = passed["direction"].values.astype(object)
+        # add sample names
+        binarized_data.index = pd.Index(exprs.columns.values)
+    else:
+        binarized_data = binarized_data.loc[:, list(passed.index.values)]
+        # add sample names
+        binarized_data.index = exprs.columns.values
 
     if plot_all:
         fig, ax = plt.subplots(figsize=(10, 4.5))
@@ -761,6 +1633,158 @@ def binarize(
     return binarized_data, stats, null_distribution
 
 
+def binarize_methods(
+    binarized_fname_prefix,
+    exprs=None,
+    methods=None,
+    save=True,
+    load=False,
+    min_n_samples=5,
+    pval=0.001,
+    plot_all=True,
+    plot_SNR_thr=np.inf,
+    show_fits=[],
+    verbose=True,
+    seed=random.randint(0, 100000),
+    prob_cutoff=0.5,
+    n_permutations=10000,
+    null_distribution=None,
+    binarizations=None,
+    sorted_rows=None,
+    prescreen=False,
+    packed=False,
+    exprs_hash=None,
+):
+    """binarize() with several methods in one pass over rows of exprs.
+
+    methods default to ["kmeans", "ward", "GMM"].
+    Methods with cached binarizations (load=True) or given in binarizations
+    (a dict {method: (binarized_data, stats)}) are not recomputed;
+    the others are computed by one sklearn_binarization() call, so rows are
+    extracted and sorted once, and the null distribution is generated once.
+    Each method's binarization is cached separately, as with a single method;
+    exprs is hashed once for cache names of all methods.
+    Returns a dict {method: (binarized_data, stats, null_distribution)}.
+    """
+    if methods is None:
+        methods = ["kmeans", "ward", "GMM"]
+    binarizations = {} if binarizations is None else dict(binarizations)
+    todo = [method for method in methods if method not in binarizations]
+    n_permutations = max(n_permutations, int(1.0 / pval * 10))
+    if prescreen and any(method != "kmeans" for method in todo):
+        print("prescreen is only used with kmeans binarization", file=sys.stderr)
+        prescreen = False
+    prescreen_params = ()
+    if prescreen and exprs is not None and len(todo) > 0:
+        null_distribution, thresholds = prepare_prescreen(
+            exprs,
+            null_distribution,
+            get_kmeans_trend_sizes(exprs, min_n_samples, sorted_rows=sorted_rows),
+            min_n_samples,
+            pval,
+            n_permutations,
+            seed,
+            verbose,
+        )
+        prescreen_params = ("prescreen", pval, thresholds)
+    cache_fnames = {}
+    if exprs is not None and (load or save):
+        if exprs_hash is None:
+            from unpast.utils.checkpoint import hash_data
+
+            exprs_hash = hash_data(exprs)
+        for method in todo:
+            cache_fnames[method] = get_binarization_cache_fname(
+                binarized_fname_prefix,
+                exprs_hash,
+                method,
+                seed,
+                min_n_samples,
+                prob_cutoff,
+                *prescreen_params
+            )
+            if load and os.path.exists(cache_fnames[method]):
+                binarizations[method] = load_binarization(cache_fnames[method], packed=packed)
+                if verbose:
+                    print(
+                        "Load binarized features and statistics from",
+                        cache_fnames[method],
+                        file=sys.stdout,
+                    )
+        todo = [method for method in todo if method not in binarizations]
+    if len(todo) > 0:
+        if exprs is None:
+            print("Provide either raw or binarized data.", file=sys.stderr)
+            return None
+        for method in todo:
+            if method not in ["GMM", "kmeans", "ward"]:
+                print("Method must be 'GMM','kmeans', or 'ward'.", file=sys.stderr)
+                return
+        if sorted_rows is None and any(
+            needs_sorted_rows(method, exprs.shape[1]) for method in todo
+        ):
+            sorted_rows = get_sorted_rows(
+                binarized_fname_prefix,
+                exprs,
+                load=load,
+                save=save,
+                verbose=verbose,
+                exprs_hash=exprs_hash,
+            )
+        passed = None
+        if prescreen:
+            passed = prescreen_features(exprs, thresholds, min_n_samples, sorted_rows=sorted_rows)
+        if verbose:
+            print("\nBinarization with %s started ....\n" % ", ".join(todo))
+        computed = sklearn_binarization(
+            exprs,
+            min_n_samples,
+            plot=plot_all,
+            plot_SNR_thr=plot_SNR_thr,
+            prob_cutoff=prob_cutoff,
+            show_fits=show_fits,
+            verbose=verbose,
+            seed=seed,
+            method=todo,
+            sorted_rows=sorted_rows,
+            passed=passed,
+            packed=packed,
+        )
+        for method in todo:
+            binarizations[method] = computed[method]
+            if save and not os.path.exists(cache_fnames[method]):
+                fpath = os.path.dirname(cache_fnames[method])
+                if fpath and not os.path.exists(fpath):
+                    os.makedirs(fpath)
+                save_binarization(cache_fnames[method], *computed[method])
+
+    # p-values; the null distribution is extended with sizes of each method
+    results = {}
+    for method in methods:
+        results[method] = binarize(
+            binarized_fname_prefix,
+            exprs=exprs,
+            method=method,
+            save=save,
+            load=load,
+            min_n_samples=min_n_samples,
+            pval=pval,
+            plot_all=plot_all,
+            plot_SNR_thr=plot_SNR_thr,
+            show_fits=show_fits,
+            verbose=verbose,
+            seed=seed,
+            prob_cutoff=prob_cutoff,
+            n_permutations=n_permutations,
+            null_distribution=null_distribution,
+            binarization=binarizations[method],
+            packed=packed,
+            exprs_hash=exprs_hash,
+        )
+        null_distribution = results[method][2]
+    return results
+
+
 #### Cluster binarized genes #####
 
 
@@ -1016,11 +2040,23 @@ def run_Louvain(
     verbose=True,
     plot=False,
     modularity_measure="newman",
+    feature_names=None,
 ):
+    """Clusters features by Louvain on a binarized similarity matrix.
+    similarity is a DataFrame or a sparse matrix with feature_names of its rows
+    (features not given in a sparse matrix have zero similarity)."""
     t0 = time()
     if similarity.shape[0] == 0:
         print("no features to cluster", file=sys.stderr)
         return [], [], None
+    if issparse(similarity):
+        similarity = similarity.tocsr()
+        if feature_names is None:
+            feature_names = np.arange(similarity.shape[0])
+        feature_names = np.asarray(feature_names)
+    else:
+        feature_names = similarity.index.values
+        similarity = similarity.values
 
     if verbose:
         print("\tRunning Louvain ...", file=sys.stdout)
@@ -1034,20 +2070,24 @@ def run_Louvain(
     for cutoff in similarity_cutoffs:
         # scan the whole range of similarity cutoffs
         # e.g. [1/4;9/10] with step 0.5
-        sim_binary = similarity.copy()
-        sim_binary[sim_binary < cutoff] = 0
-        sim_binary[sim_binary != 0] = 1
-        rsums = sim_binary.sum()
-        non_zero_features = rsums[rsums > 0].index
-        sim_binary = sim_binary.loc[non_zero_features, non_zero_features]
-        gene_names = sim_binary.index.values
+        if issparse(similarity):
+            sim_binary = similarity.copy()
+            sim_binary.data = (sim_binary.data >= cutoff).astype(float)
+            sim_binary.eliminate_zeros()
+        else:
+            sim_binary = (~(similarity < cutoff) & (similarity != 0)).astype(float)
+        rsums = np.asarray(sim_binary.sum(axis=0)).reshape(-1)
+        non_zero_features = np.where(rsums > 0)[0]
+        sim_binary = sim_binary[non_zero_features, :][:, non_zero_features]
+        gene_names = feature_names[non_zero_features]
         sparse_matrix = csr_matrix(sim_binary)
+        sparse_matrix.sort_indices()
         labels = Louvain(modularity=modularity_measure).fit_transform(sparse_matrix)
         Q = modularity(sparse_matrix, labels)
         modularities.append(Q)
         # if binary similarity matrix contains no zeroes
         # bugfix for Louvain()
-        if sim_binary.min().min() == 1:
+        if sparse_matrix.nnz == len(gene_names) ** 2:
             labels = np.zeros(len(labels))
         feature_clusters[cutoff] = labels
 
@@ -1155,15 +2195,19 @@ def run_Louvain(
         )
     return modules, not_clustered, best_cutoff
 
-def get_similarity_jaccard(binarized_data, verbose=True):  # ,J=0.5
+
+def get_similarity_jaccard(binarized_data, verbose=True, dtype=np.float64):  # ,J=0.5
     t0 = time()
     genes = binarized_data.columns.values
     n_samples = binarized_data.shape[0]
     size_threshold = int(min(0.45 * n_samples, (n_samples) / 2 - 10))
     # print("size threshold",size_threshold)
     n_genes = binarized_data.shape[1]
-    df = np.array(binarized_data.T, dtype=bool)
-    results = np.zeros((n_genes, n_genes))
+    if isinstance(binarized_data, BinarizedMatrix):
+        df = binarized_data.to_bool()
+    else:
+        df = np.array(binarized_data.T, dtype=bool)
+    results = np.zeros((n_genes, n_genes), dtype=dtype)
     for i in range(0, n_genes):
         results[i, i] = 1
         g1 = df[i]
@@ -1201,11 +2245,11 @@ def get_similarity_jaccard(binarized_data, verbose=True):  # ,J=0.5
     return results
 
 
-def get_similarity_corr(df, verbose=True):
+def get_similarity_corr(df, verbose=True, dtype=np.float64):
     t0 = time()
     corr = df.corr()  # .applymap(abs)
     corr = corr[corr > 0]  # to consider only direct correlations
-    corr = corr.fillna(0)
+    corr = corr.fillna(0).astype(dtype)
     if verbose:
         print(
             "\tPearson's r similarities for {} features computed in {:.2f} s.".format(
@@ -1218,34 +2262,111 @@ def get_similarity_corr(df, verbose=True):
 ######## Make biclusters #########
 
 
-def cluster_samples(data, min_n_samples=5, seed=0, method="kmeans"):
-    # identify identify bicluster and backgound groups using 2-means
+def warm_start_2means(data, init_mask, max_n_iter=500):
+    """Runs Lloyd iterations of 2-means starting from the split given by a boolean mask.
+
+    Returns a boolean array with True for samples assigned to the cluster initialized
+    by init_mask==True, or None if either cluster gets empty.
+    float32 data is not converted to float64.
+    """
+    data = np.asarray(data)
+    if data.dtype.kind != "f":
+        data = data.astype(float)
+    labels = np.asarray(init_mask, dtype=bool)
+    for _ in range(max_n_iter):
+        n1 = labels.sum()
+        if n1 == 0 or n1 == len(labels):
+            return None
+        c1 = data[labels].mean(axis=0)
+        c0 = data[~labels].mean(axis=0)
+        # x is closer to c1 than to c0 if x.(c1-c0) > (|c1|^2 - |c0|^2)/2
+        new_labels = data.dot(c1 - c0) > (c1.dot(c1) - c0.dot(c0)) / 2
+        if np.array_equal(new_labels, labels):
+            break
+        labels = new_labels
+    return labels
+
+
+def minibatch_2means(data, seed=0, n_check=5000, tol=0.01):
+    """2-means of rows of data with MiniBatchKMeans.
+
+    The result is checked against KMeans on a random subsample of n_check rows:
+    if the within-cluster sum of squares of the mini-batch split of the subsample
+    exceeds that of KMeans by more than tol, returns None.
+    Otherwise returns an array of 0/1 labels.
+    float32 data is not converted to float64.
+    """
+    from sklearn.cluster import MiniBatchKMeans
+
+    data = np.asarray(data)
+    if data.dtype.kind != "f":
+        data = data.astype(float)
+    labels = (
+        MiniBatchKMeans(n_clusters=2, random_state=seed, n_init=3, batch_size=4096)
+        .fit(data)
+        .labels_
+    )
+
+    # quality check
+    rng = np.random.default_rng(seed)
+    subsample = rng.choice(len(data), size=min(n_check, len(data)), replace=False)
+    model = KMeans(n_clusters=2, random_state=seed, init="random", n_init=10).fit(
+        data[subsample]
+    )
+    if calc_split_sse(data[subsample], labels[subsample] == 1) > (1 + tol) * model.inertia_:
+        return None
+    return labels
+
+
+def cluster_samples(
+    data, min_n_samples=5, seed=0, method="kmeans", init_mask=None, min_agreement=0.5
+):
+    """Identifies bicluster and background sample groups using 2-means (or ward, GMM).
+
+    For kmeans, a boolean init_mask (e.g. a majority vote of binarized module features)
+    enables a fast path: 2-means is warm-started from this split, and the multi-start
+    KMeans is run only if Jaccard similarity of the resulting and the initial
+    bicluster sample sets is below min_agreement.
+    From MINIBATCH_MIN_SAMPLES samples, mini-batch 2-means is tried before
+    the multi-start KMeans (see minibatch_2means()).
+    """
     max_n_iter = max(max(data.shape), 500)
-    if method == "kmeans" or method == "Jenks":
-        labels = (
-            KMeans(
-                n_clusters=2,
-                random_state=seed,
-                init="random",
-                n_init=10,
-                max_iter=max_n_iter,
+    labels = None
+    if init_mask is not None and method in ["kmeans", "Jenks"]:
+        warm_labels = warm_start_2means(data, init_mask, max_n_iter=max_n_iter)
+        if warm_labels is not None:
+            init_mask = np.asarray(init_mask, dtype=bool)
+            J = (warm_labels & init_mask).sum() / (warm_labels | init_mask).sum()
+            if J >= min_agreement:
+                labels = warm_labels.astype(int)
+    if labels is None and method in ["kmeans", "Jenks"] and len(data) >= MINIBATCH_MIN_SAMPLES:
+        labels = minibatch_2means(data, seed=seed)
+    if labels is None:
+        if method == "kmeans" or method == "Jenks":
+            labels = (
+                KMeans(
+                    n_clusters=2,
+                    random_state=seed,
+                    init="random",
+                    n_init=10,
+                    max_iter=max_n_iter,
+                )
+                .fit(data)
+                .labels_
             )
-            .fit(data)
-            .labels_
-        )
-    elif method == "ward":
-        labels = AgglomerativeClustering(n_clusters=2, linkage="ward").fit(data).labels_
-    # elif method == "HC_ward":
-    #        model = Ward(n_clusters=2).fit(data).labels_
-    elif method == "GMM":
-        labels = GaussianMixture(
-            n_components=2,
-            init_params="kmeans",
-            max_iter=max_n_iter,
-            n_init=5,
-            covariance_type="spherical",
-            random_state=seed,
-        ).fit_predict(data)
+        elif method == "ward":
+            labels = AgglomerativeClustering(n_clusters=2, linkage="ward").fit(data).labels_
+        # elif method == "HC_ward":
+        #        model = Ward(n_clusters=2).fit(data).labels_
+        elif method == "GMM":
+            labels = GaussianMixture(
+                n_components=2,
+                init_params="kmeans",
+                max_iter=max_n_iter,
+                n_init=5,
+                covariance_type="spherical",
+                random_state=seed,
+            ).fit_predict(data)
     ndx0 = np.where(labels == 0)[0]
     ndx1 = np.where(labels == 1)[0]
     if min(len(ndx1), len(ndx0)) < min_n_samples:
@@ -1259,6 +2380,84 @@ def cluster_samples(data, min_n_samples=5, seed=0, method="kmeans"):
     return bicluster
 
 
+def get_n_workers(n_jobs):
+    # n_jobs follows the joblib convention: -1 means all CPUs, -2 all but one, etc.
+    if not n_jobs:
+        return 1
+    if n_jobs < 0:
+        return max(os.cpu_count() + 1 + n_jobs, 1)
+    return n_jobs
+
+
+# data shared with worker processes (a matrix or a table of biclusters);
+# set once per worker by the pool initializer
+_shared_data = None
+
+
+def _init_shared_data(data):
+    global _shared_data
+    _shared_data = data
+
+
+def _cluster_samples_by_rows(args):
+    # clusters samples in a subspace of the rows of a shared matrix
+    row_indexes, min_n_samples, seed, method, init_mask = args
+    return cluster_samples(
+        _shared_data[row_indexes, :].T,
+        min_n_samples=min_n_samples,
+        seed=seed,
+        method=method,
+        init_mask=init_mask,
+    )
+
+
+def cluster_samples_in_subspaces(
+    data,
+    row_indexes,
+    min_n_samples=5,
+    seed=0,
+    method="kmeans",
+    n_jobs=1,
+    init_masks=None,
+):
+    """Runs cluster_samples() for each list of row indexes of a features x samples array.
+
+    With n_jobs > 1, subspaces are distributed over a process pool and the array is
+    sent to each worker once. Each subspace is clustered with the same seed,
+    so the results do not depend on n_jobs or the order of execution.
+    init_masks is an optional list of warm start sample masks, one per subspace.
+    """
+    if init_masks is None:
+        init_masks = [None] * len(row_indexes)
+    tasks = [
+        (ndx, min_n_samples, seed, method, init_mask)
+        for ndx, init_mask in zip(row_indexes, init_masks)
+    ]
+    n_workers = min(get_n_workers(n_jobs), len(tasks))
+    if n_workers <= 1:
+        return [
+            cluster_samples(
+                data[ndx, :].T,
+                min_n_samples=min_n_samples,
+                seed=seed,
+                method=method,
+                init_mask=init_mask,
+            )
+            for ndx, _, _, _, init_mask in tasks
+        ]
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(
+        max_workers=n_workers, initializer=_init_shared_data, initargs=(data,)
+    ) as executor:
+        chunksize = max(1, len(tasks) // (4 * n_workers))
+        results = list(
+            executor.map(_cluster_samples_by_rows, tasks, chunksize=chunksize)
+        )
+    return results
+
+
 def modules2biclusters(
     modules,
     data_to_cluster,
@@ -1267,9 +2466,14 @@ def modules2biclusters(
     min_n_genes=2,
     seed=0,
     verbose=True,
+    n_jobs=1,
+    binarized_data=None,
 ):
-    """Identifies optimal sample set for each module: 
-    splits samples into two sets in a subspace of each module
+    """Identifies optimal sample set for each module:
+    splits samples into two sets in a subspace of each module;
+    modules are processed in parallel if n_jobs > 1.
+    If binarized_data (samples x features) is given, 2-means in each module subspace
+    is warm-started from the majority vote of the binarized module features.
     """
     t0 = time()
     biclusters = {}
@@ -1277,20 +2481,41 @@ def modules2biclusters(
     low_SNR = 0
     i = 0
 
-    for mid in range(0, len(modules)):
-        genes = modules[mid]
-        if len(genes) >= min_n_genes:
-            # cluster samples in a space of selected genes
-            data = data_to_cluster.loc[genes, :].T
-            bicluster = cluster_samples(
-                data, min_n_samples=min_n_samples, seed=seed, method=method
-            )
-            if len(bicluster) > 0:
-                bicluster["id"] = i
-                bicluster["genes"] = set(genes)
-                bicluster["n_genes"] = len(bicluster["genes"])
-                biclusters[i] = bicluster
-                i += 1
+    # map gene names to row indexes once instead of a .loc lookup per module
+    data_values = np.asarray(data_to_cluster.values)
+    gene_ndx = dict(zip(data_to_cluster.index.values, range(data_to_cluster.shape[0])))
+    passed_modules = [genes for genes in modules if len(genes) >= min_n_genes]
+    init_masks = None
+    if isinstance(binarized_data, BinarizedMatrix):
+        # unpack masks of module features only
+        init_masks = [
+            binarized_data.to_bool(genes).mean(axis=0) >= 0.5
+            for genes in passed_modules
+        ]
+    elif binarized_data is not None:
+        bin_values = np.asarray(binarized_data.values)
+        bin_ndx = dict(zip(binarized_data.columns.values, range(bin_values.shape[1])))
+        init_masks = [
+            bin_values[:, [bin_ndx[g] for g in genes]].mean(axis=1) >= 0.5
+            for genes in passed_modules
+        ]
+    # cluster samples in a space of selected genes
+    results = cluster_samples_in_subspaces(
+        data_values,
+        [[gene_ndx[g] for g in genes] for genes in passed_modules],
+        min_n_samples=min_n_samples,
+        seed=seed,
+        method=method,
+        n_jobs=n_jobs,
+        init_masks=init_masks,
+    )
+    for genes, bicluster in zip(passed_modules, results):
+        if len(bicluster) > 0:
+            bicluster["id"] = i
+            bicluster["genes"] = set(genes)
+            bicluster["n_genes"] = len(bicluster["genes"])
+            biclusters[i] = bicluster
+            i += 1
 
     if verbose:
         print(
@@ -1313,78 +2538,207 @@ def update_bicluster_data(bicluster, data):
     calculates average z-score
     bicluster must contain "sample_indexes" and "genes"
     data must contain all features, not just binarized"""
+    return update_biclusters_data({0: bicluster}, data)[0]
 
-    # add "samples" and "gene_indexes"
+
+def update_biclusters_data(biclusters, data, exact=True, max_chunk_size=10**7):
+    """Vectorized update_bicluster_data() for a dict of biclusters.
+
+    Works on a NumPy view of data with name->index maps and boolean sample masks.
+    Rows of all bicluster genes are stacked into one matrix to find up- and
+    down-regulated genes of many biclusters at once; max_chunk_size limits
+    the number of elements in this matrix.
+    If exact is False, average z-scores and SNR are computed with matrix
+    operations too; otherwise they are summed per bicluster in the same order
+    as pandas does, which keeps SNR values bit-identical to earlier versions.
+    Only rows of bicluster genes are converted to float64, not the whole data.
+    """
+    values = data.values
     sample_names = data.columns.values
-    gene_names = data.index.values
+    n_samples = values.shape[1]
+    # the first occurrence of a name wins, as in np.where(gene_names == x)[0][0]
+    gene_ndx = {}
+    for i, gene in enumerate(data.index.values):
+        gene_ndx.setdefault(gene, i)
+
+    bic_ids = list(biclusters.keys())
+    chunk = []
+    chunk_size = 0
+    for k, i in enumerate(bic_ids):
+        chunk.append(biclusters[i])
+        chunk_size += len(biclusters[i]["genes"]) * n_samples
+        if chunk_size >= max_chunk_size or k == len(bic_ids) - 1:
+            _update_biclusters_chunk(chunk, values, gene_ndx, sample_names, exact)
+            chunk = []
+            chunk_size = 0
+    return biclusters
 
-    bic_samples = sample_names[list(bicluster["sample_indexes"])]
-    bic_genes = list(bicluster["genes"])
-    bg_samples = [x for x in sample_names if not x in bic_samples]
-    bicluster["samples"] = set(bic_samples)
-    bicluster["gene_indexes"] = set(
-        [np.where(gene_names == x)[0][0] for x in bicluster["genes"]]
-    )
+
+def sum_rows(values, row_indexes):
+    # sums selected rows in the same order as DataFrame.sum() does:
+    # the order of summation in numpy reductions depends on the memory layout
+    if values.flags.f_contiguous and not values.flags.c_contiguous:
+        return np.ascontiguousarray(values.T[:, row_indexes], dtype=np.float64).sum(axis=1)
+    return values[row_indexes, :].astype(np.float64, copy=False).sum(axis=0)
+
+
+def _update_biclusters_chunk(bics, values, gene_ndx, sample_names, exact=True):
+    n_bics = len(bics)
+    n_samples = values.shape[1]
+    # biclusters x samples boolean masks
+    sample_masks = np.zeros((n_bics, n_samples), dtype=bool)
+    for k, bic in enumerate(bics):
+        sample_masks[k, list(bic["sample_indexes"])] = True
+    n_bic_samples = sample_masks.sum(axis=1)
+    n_bg_samples = n_samples - n_bic_samples
+
+    # stack rows of all bicluster genes; row_bic maps each row to its bicluster
+    bic_genes = [list(bic["genes"]) for bic in bics]
+    n_genes = np.array([len(genes) for genes in bic_genes])
+    row_bic = np.repeat(np.arange(n_bics), n_genes)
+    row_ndx = np.array([gene_ndx[g] for genes in bic_genes for g in genes], dtype=int)
+    rows = values[row_ndx, :].astype(np.float64, copy=False)
+    row_masks = sample_masks[row_bic]
 
     # distinguish up- and down-regulated features
-    m_bic = data.loc[bic_genes, bic_samples].mean(axis=1)
-    m_bg = data.loc[bic_genes, bg_samples].mean(axis=1)
-    genes_up = m_bic[m_bic >= m_bg].index.values
-    genes_down = m_bic[m_bic < m_bg].index.values
-    bicluster["genes_up"] = set(genes_up)
-    bicluster["genes_down"] = set(genes_down)
-
-    genes_up = m_bic[m_bic >= m_bg].index.values
-    genes_down = m_bic[m_bic < m_bg].index.values
-
-    # calculate average z-score for each sample
-    if min(len(genes_up), len(genes_down)) > 0:  # take direction into account
-        avg_zscore = (
-            data.loc[genes_up, :].sum() - data.loc[genes_down, :].sum()
-        ) / bicluster["n_genes"]
-    else:
-        avg_zscore = data.loc[list(bicluster["genes"]), :].mean()
+    m_bic = np.where(row_masks, rows, 0).sum(axis=1) / n_bic_samples[row_bic]
+    m_bg = np.where(row_masks, 0, rows).sum(axis=1) / n_bg_samples[row_bic]
+    is_up = m_bic >= m_bg
+    n_up = np.bincount(row_bic, weights=is_up, minlength=n_bics)
+    n_down = n_genes - n_up
+    # take direction into account only if both up- and down-regulated genes are found
+    both = (n_up > 0) & (n_down > 0)
+
+    # calculate average z-score for each sample and its SNR
+    if not exact:
+        signs = np.where(is_up | ~both[row_bic], 1.0, -1.0)
+        weights = csr_matrix(
+            (signs, (row_bic, np.arange(len(row_bic)))), shape=(n_bics, len(row_bic))
+        )
+        avg_zscores = np.asarray(weights.dot(rows)) / n_genes[:, np.newaxis]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            snr = calc_masked_snr(avg_zscores, sample_masks)
+
+    bic_ends = np.cumsum(n_genes)
+    for k, bic in enumerate(bics):
+        ndx = row_ndx[bic_ends[k] - n_genes[k] : bic_ends[k]]
+        up = is_up[bic_ends[k] - n_genes[k] : bic_ends[k]]
+        genes = np.array(bic_genes[k], dtype=object)
+        bic["samples"] = set(sample_names[list(bic["sample_indexes"])])
+        bic["gene_indexes"] = set(ndx.tolist())
+        bic["genes_up"] = set(genes[up])
+        bic["genes_down"] = set(genes[~up])
+        if exact:
+            if both[k]:
+                avg_zscore = (
+                    sum_rows(values, ndx[up]) - sum_rows(values, ndx[~up])
+                ) / n_genes[k]
+            else:
+                avg_zscore = sum_rows(values, ndx) / n_genes[k]
+            bic["SNR"] = calc_SNR_ddof1(
+                avg_zscore[list(bic["sample_indexes"])], avg_zscore[~sample_masks[k]]
+            )
+        else:
+            bic["SNR"] = snr[k]
+
+
+def calc_SNR_ddof1(ar1, ar2):
+    # absolute SNR with pandas-like (ddof=1) standard deviations
+    m1 = ar1.sum() / len(ar1)
+    m2 = ar2.sum() / len(ar2)
+    s1 = np.sqrt(((m1 - ar1) ** 2).sum() / (len(ar1) - 1))
+    s2 = np.sqrt(((m2 - ar2) ** 2).sum() / (len(ar2) - 1))
+    return np.abs(m1 - m2) / (s1 + s2)
 
-    # compute SNR for average z-score for this bicluster
-    m = avg_zscore[bic_samples].mean() - avg_zscore[bg_samples].mean()
-    s = avg_zscore[bic_samples].std() + avg_zscore[bg_samples].std()
-    snr = np.abs(m) / s
-    bicluster["SNR"] = snr
-    return bicluster
+
+def calc_masked_snr(values, masks):
+    """Row-wise absolute SNR of values inside and outside of boolean masks.
+    Standard deviations are computed with ddof=1 as in pandas."""
+    n1 = masks.sum(axis=1)
+    n2 = masks.shape[1] - n1
+    m1 = np.where(masks, values, 0).sum(axis=1) / n1
+    m2 = np.where(masks, 0, values).sum(axis=1) / n2
+    d1 = np.where(masks, values - m1[:, np.newaxis], 0)
+    d2 = np.where(masks, 0, values - m2[:, np.newaxis])
+    s1 = np.sqrt((d1 ** 2).sum(axis=1) / (n1 - 1))
+    s2 = np.sqrt((d2 ** 2).sum(axis=1) / (n2 - 1))
+    return np.abs(m1 - m2) / (s1 + s2)
+
+
+
+def get_similarity_jaccard_sparse(incidence):
+    """Jaccard similarities of rows of a sparse binary matrix (e.g. biclusters x samples).
+
+    Computes the same values as get_similarity_jaccard(), including matching of
+    complements of large sets, from a single sparse product of the matrix with itself.
+    """
+    incidence = csr_matrix(incidence, dtype=np.int64)
+    N = incidence.shape[1]
+    size_threshold = int(min(0.45 * N, (N) / 2 - 10))
+    sizes = np.asarray(incidence.sum(axis=1)).reshape(-1)
+    a = sizes[:, np.newaxis]
+    b = sizes[np.newaxis, :]
+    o = incidence.dot(incidence.T).toarray()
+    with np.errstate(divide="ignore", invalid="ignore"):
+        jaccard = o / (a + b - o)
+        # for a pair i < j, try the complement of set i, if it is large, or of set j
+        jaccard_c = np.where(
+            a > size_threshold,
+            (b - o) / (N - a + o),
+            np.where(b > size_threshold, (a - o) / (N - b + o), 0),
+        )
+    results = np.triu(np.maximum(jaccard, jaccard_c), k=1)
+    results = results + results.T
+    np.fill_diagonal(results, 1)
+    return results
 
 
 def merge_biclusters(
-    biclusters, data, J=0.8, min_n_samples=5, seed=42, method="kmeans", verbose=True
+    biclusters,
+    data,
+    J=0.8,
+    min_n_samples=5,
+    seed=42,
+    method="kmeans",
+    verbose=True,
+    n_jobs=1,
 ):
+    """Merges biclusters with similar sample sets.
+
+    Biclusters connected by sample set Jaccard similarity >= J are grouped
+    into connected components; the samples of each merged group are then
+    re-clustered in the space of all its genes (in parallel if n_jobs > 1).
+    """
+    from scipy.sparse.csgraph import connected_components
+
     #  bicluaters -> binary -> jaccard sim
-    binary_representation = {}
-    N = data.shape[1]
-    for i in biclusters.keys():
-        b = np.zeros(N)
-        s_ndx = list(biclusters[i]["sample_indexes"])
-        b[s_ndx] = 1
-        binary_representation[i] = b
-    binary_representation = pd.DataFrame.from_dict(binary_representation)
-    binary_representation.index = data.columns.values
-    bic_similarity = get_similarity_jaccard(binary_representation, verbose=verbose)
-    # bic_similarity[bic_similarity >= J] = 1
-    # bic_similarity[bic_similarity < J] = 0
-    # find groups of biclusters including the same sample sets
-    merged, not_merged, similarity_cutoff = run_Louvain(
-        bic_similarity, verbose=False, plot=False, similarity_cutoffs=[J]
+    bic_ids = list(biclusters.keys())
+    rows = np.repeat(
+        np.arange(len(bic_ids)),
+        [len(biclusters[i]["sample_indexes"]) for i in bic_ids],
     )
-    if len(merged) == 0 and verbose:
-        print("No biclusters to merge", file=sys.stdout)
+    cols = [s for i in bic_ids for s in biclusters[i]["sample_indexes"]]
+    incidence = csr_matrix(
+        (np.ones(len(cols)), (rows, cols)), shape=(len(bic_ids), data.shape[1])
+    )
+    bic_similarity = get_similarity_jaccard_sparse(incidence)
+    # find groups of biclusters including the same sample sets
+    adjacency = csr_matrix((bic_similarity >= J) & (bic_similarity > 0))
+    n_groups, labels = connected_components(adjacency, directed=False)
+    merged = []
+    for label in range(n_groups):
+        bic_group = [bic_ids[k] for k in np.where(labels == label)[0]]
+        if len(bic_group) > 1:
+            merged.append(sorted(bic_group))
+    if len(merged) == 0:
+        if verbose:
+            print("No biclusters to merge", file=sys.stdout)
         return biclusters
 
-    merged_biclusters = {}
-    # add biclusters with no changes
-    for bic_id in not_merged:
-        merged_biclusters[bic_id] = biclusters[bic_id]
-
     # merge biclusters with overlapping sample sets
+    merged_ids = set()
+    new_biclusters = []
     for bic_group in merged:
-        bic_group = sorted(bic_group)
         if verbose:
             print("merged biclustres", bic_group, file=sys.stderr)
         new_bicluster = biclusters[bic_group[0]]
@@ -1393,16 +2747,28 @@ def merge_biclusters(
             bic2 = biclusters[bic_id]
             new_bicluster["genes"] = new_bicluster["genes"] | bic2["genes"]
             new_bicluster["n_genes"] = len(new_bicluster["genes"])
-        # update sample set for new bicluster
-        # cluster samples in a space of selected genes
-        new_bicluster.update(
-            cluster_samples(
-                data.loc[list(new_bicluster["genes"]), :].T,
-                min_n_samples=min_n_samples,
-                seed=seed,
-                method=method,
-            )
-        )
+        new_biclusters.append(new_bicluster)
+        merged_ids.update(bic_group)
+
+    # update sample sets of new biclusters:
+    # cluster samples in a space of selected genes
+    gene_ndx = dict(zip(data.index.values, range(data.shape[0])))
+    results = cluster_samples_in_subspaces(
+        np.asarray(data.values),
+        [[gene_ndx[g] for g in bic["genes"]] for bic in new_biclusters],
+        min_n_samples=min_n_samples,
+        seed=seed,
+        method=method,
+        n_jobs=n_jobs,
+    )
+
+    merged_biclusters = {}
+    # add biclusters with no changes
+    for bic_id in bic_ids:
+        if bic_id not in merged_ids:
+            merged_biclusters[bic_id] = biclusters[bic_id]
+    for bic_group, new_bicluster, result in zip(merged, new_biclusters, results):
+        new_bicluster.update(result)
         new_bicluster["n_samples"] = len(new_bicluster["sample_indexes"])
         merged_biclusters[bic_group[0]] = new_bicluster
     return merged_biclusters
@@ -1420,15 +2786,28 @@ def make_biclusters(
     seed=42,
     cluster_binary=False,
     verbose=True,
+    n_jobs=1,
+    warm_start=False,
 ):
     sample_names = data.columns.values
     gene_names = data.index.values
     biclusters = []
+    data_gene_indexes = None
+    cluster_genes = binarized_data.columns.values
+    if isinstance(data, (SparseExprs, DiskExprs)):
+        # z-scores of module features only; gene indexes refer to all features
+        module_genes = set().union(*[set(genes) for genes in feature_clusters])
+        cluster_genes = [g for g in cluster_genes if g in module_genes]
+        data_gene_indexes = data.index.get_indexer(cluster_genes)
+        data = data.to_dense(cluster_genes)
 
     if cluster_binary:
-        data_to_cluster = binarized_data.loc[:, :].T  # binarized expressions
+        if isinstance(binarized_data, BinarizedMatrix):
+            data_to_cluster = binarized_data.to_dense().T  # binarized expressions
+        else:
+            data_to_cluster = binarized_data.loc[:, :].T  # binarized expressions
     else:
-        data_to_cluster = data.loc[binarized_data.columns.values, :]  # z-scores
+        data_to_cluster = data.loc[cluster_genes, :]  # z-scores
 
     if len(feature_clusters) == 0:
         print("No biclusters found.", file=sys.stderr)
@@ -1441,6 +2820,8 @@ def make_biclusters(
             min_n_genes=2,
             verbose=False,
             seed=seed,
+            n_jobs=n_jobs,
+            binarized_data=binarized_data if warm_start else None,
         )
 
         ### merge biclusters with highly similar sample sets
@@ -1453,10 +2834,13 @@ def make_biclusters(
                 min_n_samples=min_n_samples,
                 seed=seed,
                 verbose=verbose,
+                n_jobs=n_jobs,
             )
 
-        for i in list(biclusters.keys()):
-            biclusters[i] = update_bicluster_data(biclusters[i], data)
+        biclusters = update_biclusters_data(biclusters, data)
+        if data_gene_indexes is not None:
+            for bic in biclusters.values():
+                bic["gene_indexes"] = set(data_gene_indexes[list(bic["gene_indexes"])].tolist())
 
     biclusters = pd.DataFrame.from_dict(biclusters).T
     # add direction
@@ -1509,7 +2893,7 @@ def calc_bicluster_similarities(
     colorbar_off=True,
 ):
 
-    biclusters_dict = biclusters.T.to_dict()
+    from unpast.utils.eval import calc_chi2_pvals
 
     if similarity not in ["genes", "samples", "both"]:
         print(
@@ -1518,71 +2902,58 @@ def calc_bicluster_similarities(
         )
         similarity = "both"
 
-    J_heatmap = {}
-    s = set(exprs.columns.values)
-    g = set(exprs.index.values)
+    bic_ids = biclusters.index.values
     N_bics = len(biclusters.keys())
-    ### plot pairwise comparisons:
-    for bic_n1 in biclusters_dict.keys():
-        b1 = biclusters_dict[bic_n1]
-        g1 = b1["genes"]
-        s1 = b1["samples"]
-        J_heatmap[bic_n1] = {}
-        for bic_n2 in biclusters_dict.keys():
-            b2 = biclusters_dict[bic_n2]
-            g2 = b2["genes"]
-            s2 = b2["samples"]
-            g_overlap = g1.intersection(g2)
-            g_union = g1.union(g2)
-            s_overlap = s1.intersection(s2)
-            s_union = s1.union(s2)
-            J_g = len(g_overlap) / len(g_union)
-            J_s = len(s_overlap) / len(s_union)
-            J_heatmap[bic_n1][bic_n2] = 0
-
-            # significance of gene overlap
-            if similarity != "samples":
-                if len(g_overlap) == 0:
-                    p_g = 1
-                else:
-                    chi2, p_g, dof, expected = chi2_contingency(
-                        [
-                            [len(g_overlap), len(g1.difference(g2))],
-                            [len(g2.difference(g1)), len(g.difference(g1 | g2))],
-                        ]
-                    )
-
-            # significance of sample overlap
-            if similarity != "genes":
-                # skip if similarity==both and gene overlap is empty
-                if similarity == "both" and len(g) == 0:
-                    p_s = 1
-                else:
-                    chi2, p_s, dof, expected = chi2_contingency(
-                        [
-                            [len(s_overlap), len(s1.difference(s2))],
-                            [len(s2.difference(s1)), len(s.difference(s1 | s2))],
-                        ]
-                    )
-
-            if similarity == "genes":
-                if p_g * (N_bics - 1) * N_bics / 2 < adj_pval_thr:
-                    J_heatmap[bic_n1][bic_n2] = J_g
-            elif similarity == "samples":
-                if p_s * (N_bics - 1) * N_bics / 2 < adj_pval_thr:
-                    J_heatmap[bic_n1][bic_n2] = J_s
-            elif similarity == "both":  # both genes and samples considered
-                # consider significant overlaps in g and s and save max. J
-                if (
-                    p_g * (N_bics - 1) * N_bics / 2 < adj_pval_thr
-                    and len(s_overlap) > 0
-                ) or (
-                    p_s * (N_bics - 1) * N_bics / 2 < adj_pval_thr
-                    and len(g_overlap) > 0
-                ):
-                    J_heatmap[bic_n1][bic_n2] = max(J_s, J_g)
-
-    J_heatmap = pd.DataFrame.from_dict(J_heatmap)
+    bics = BiclusterSet.from_dataframe(
+        biclusters.loc[:, ["genes", "samples"]], exprs.index.values, exprs.columns.values
+    )
+    # compare all pairs of biclusters in the upper triangle (incl. the diagonal)
+    rows, cols = np.triu_indices(len(bic_ids))
+
+    def overlap_tables(by, N):
+        # 2x2 tables [overlap, only in 1st, only in 2nd, background] for all pairs
+        o = bics.overlaps(by=by).toarray()[rows, cols].astype(np.int64)
+        n1 = getattr(bics, "n_" + by)[rows].astype(np.int64)
+        n2 = getattr(bics, "n_" + by)[cols].astype(np.int64)
+        return np.stack([o, n1 - o, n2 - o, N - (n1 + n2 - o)], axis=1)
+
+    g_tables = overlap_tables("genes", exprs.shape[0])
+    s_tables = overlap_tables("samples", exprs.shape[1])
+    g_overlap = g_tables[:, 0]
+    s_overlap = s_tables[:, 0]
+    J_g = g_overlap / (g_tables[:, 0] + g_tables[:, 1] + g_tables[:, 2])
+    J_s = s_overlap / (s_tables[:, 0] + s_tables[:, 1] + s_tables[:, 2])
+
+    # significance of gene overlap
+    p_g = np.ones(len(rows))
+    if similarity != "samples":
+        p_g[g_overlap > 0] = calc_chi2_pvals(g_tables[g_overlap > 0])
+
+    # significance of sample overlap
+    p_s = np.ones(len(rows))
+    if similarity != "genes":
+        # skip if similarity==both and gene overlap is empty
+        if not (similarity == "both" and exprs.shape[0] == 0):
+            p_s = calc_chi2_pvals(s_tables)
+
+    J = np.zeros(len(rows))
+    if similarity == "genes":
+        passed = p_g * (N_bics - 1) * N_bics / 2 < adj_pval_thr
+        J[passed] = J_g[passed]
+    elif similarity == "samples":
+        passed = p_s * (N_bics - 1) * N_bics / 2 < adj_pval_thr
+        J[passed] = J_s[passed]
+    elif similarity == "both":  # both genes and samples considered
+        # consider significant overlaps in g and s and save max. J
+        passed = (
+            (p_g * (N_bics - 1) * N_bics / 2 < adj_pval_thr) & (s_overlap > 0)
+        ) | ((p_s * (N_bics - 1) * N_bics / 2 < adj_pval_thr) & (g_overlap > 0))
+        J[passed] = np.maximum(J_s, J_g)[passed]
+
+    J_heatmap = np.zeros((len(bic_ids), len(bic_ids)))
+    J_heatmap[rows, cols] = J
+    J_heatmap[cols, rows] = J
+    J_heatmap = pd.DataFrame(J_heatmap, index=bic_ids, columns=bic_ids)
 
     if plot:
         import seaborn as sns
@@ -1607,6 +2978,49 @@ def calc_bicluster_similarities(
     return J_heatmap
 
 
+def _match_runs(args):
+    # finds best matches of biclusters from run i among biclusters from run j
+    # in a shared table of biclusters from all runs
+    from unpast.utils.eval import find_best_matching_biclusters
+
+    i, j, sizes, by, min_g, adj_pval_thr = args
+    runs = _shared_data["run"].values
+    bm = find_best_matching_biclusters(
+        _shared_data.loc[runs == i, :],
+        _shared_data.loc[runs == j, :],
+        sizes,
+        by=by,
+        min_g=min_g,
+        adj_pval_thr=adj_pval_thr,
+    )
+    return bm.dropna()
+
+
+def match_run_pairs(biclusters, run_pairs, sizes, by, min_g, adj_pval_thr, n_jobs=1):
+    """Finds best matching biclusters for each pair of runs (i, j).
+
+    Returns a list of dropna()-ed outputs of find_best_matching_biclusters()
+    in the order of run_pairs. With n_jobs > 1, pairs are evaluated in a process pool
+    and the table of biclusters is sent to each worker once.
+    """
+    biclusters = biclusters.loc[:, ["genes", "samples", "n_genes", "n_samples", "run"]]
+    tasks = [(i, j, sizes, by, min_g, adj_pval_thr) for i, j in run_pairs]
+    n_workers = min(get_n_workers(n_jobs), len(tasks))
+    if n_workers <= 1:
+        _init_shared_data(biclusters)
+        try:
+            return [_match_runs(task) for task in tasks]
+        finally:
+            _init_shared_data(None)
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(
+        max_workers=n_workers, initializer=_init_shared_data, initargs=(biclusters,)
+    ) as executor:
+        return list(executor.map(_match_runs, tasks))
+
+
 def make_consensus_biclusters(
     biclusters_list,
     exprs,
@@ -1626,11 +3040,11 @@ def make_consensus_biclusters(
     labels=False,
     colorbar_off=True,
     verbose=True,
+    n_jobs=1,
 ):
     # considers only best matching bicluster pairs
-    from unpast.utils.eval import find_best_matching_biclusters
+    # pairs of runs are compared in parallel if n_jobs > 1
 
-    
     # list of biclusters from several runs
     n_runs = len(biclusters_list)
     if n_runs < min_n_times_detected:
@@ -1655,48 +3069,53 @@ def make_consensus_biclusters(
     biclusters["detected_n_times"] = 1
 
     n_bics = biclusters.shape[0]
-    J_heatmap = pd.DataFrame(np.zeros((n_bics, n_bics)), index=bic_ids, columns=bic_ids)
+    # biclusters are referred to by their positions in the concatenated table
+    runs = biclusters["run"].values
+    run_positions = {}
+    for i in range(n_runs):
+        ndx = np.where(runs == i)[0]
+        run_positions[i] = pd.Series(ndx, index=bic_ids[ndx])
 
     # add only best matches to Jaccard similarity matrix
-    avg_J_sim = {}
-    for i in range(n_runs):
-        # bicluster is always the best match of itself,
-        # similarity matrix block for output of a biclustering method w. itself is  an identity matrix
-        bics1 = biclusters.loc[biclusters["run"] == i, :]
-        J_heatmap.loc[bics1.index.values, bics1.index.values] = np.identity(
-            bics1.shape[0]
-        )
-        avg_J_sim[i] = {i: 1}
-        for j in range(n_runs):
-            if i != j:
-                bics2 = biclusters.loc[biclusters["run"] == j, :]
-                # find best matches between bics1 and bics2
-                bm = find_best_matching_biclusters(
-                    bics1,
-                    bics2,
-                    exprs.shape,
-                    by=similarity,
-                    min_g=min_n_genes,
-                    adj_pval_thr=p,
-                )
-                bm = bm.dropna()
-                if bm.shape[0] > 0:
-                    avg_J_sim[i][j] = np.mean(bm["J"])
-                    df = bm.loc[:, ["bm_id", "J"]]
-                    for row in df.iterrows():
-                        J_heatmap.loc[row[0], row[1]["bm_id"]] += row[1]["J"] / 2
-                        J_heatmap.loc[row[1]["bm_id"], row[0]] += row[1]["J"] / 2
+    # bicluster is always the best match of itself,
+    # similarity matrix block for output of a biclustering method w. itself is  an identity matrix
+    J_rows = [np.arange(n_bics)]
+    J_cols = [np.arange(n_bics)]
+    J_values = [np.ones(n_bics)]
+    # find best matches between all pairs of runs
+    run_pairs = [(i, j) for i in range(n_runs) for j in range(n_runs) if i != j]
+    best_matches = match_run_pairs(
+        biclusters, run_pairs, exprs.shape, similarity, min_n_genes, p, n_jobs=n_jobs
+    )
+    avg_J_sim = {i: {i: 1} for i in range(n_runs)}
+    for (i, j), bm in zip(run_pairs, best_matches):
+        if bm.shape[0] > 0:
+            avg_J_sim[i][j] = np.mean(bm["J"])
+            ndx1 = run_positions[i].loc[bm.index.values].values
+            ndx2 = run_positions[j].loc[bm["bm_id"].values].values
+            J = bm["J"].values.astype(float) / 2
+            J_rows += [ndx1, ndx2]
+            J_cols += [ndx2, ndx1]
+            J_values += [J, J]
+    # duplicate entries are summed up
+    J_heatmap = csr_matrix(
+        (
+            np.concatenate(J_values),
+            (np.concatenate(J_rows), np.concatenate(J_cols)),
+        ),
+        shape=(n_bics, n_bics),
+    )
+    J_heatmap.eliminate_zeros()
 
-    
     # if all biclusters are exactly the same
-    if J_heatmap.min().min() == 1:
+    if J_heatmap.nnz == n_bics**2 and J_heatmap.data.min() == 1:
         # return the first bicluster
         consensus_biclusters = biclusters.iloc[[0], :].copy()
         consensus_biclusters.index = [0]
         consensus_biclusters.loc[0, "detected_n_times"] = biclusters.shape[0]
         print("all biclusters are exactly the same", file=sys.stderr)
         return consensus_biclusters
-    
+
     # plot bicluster similarity heatmaps
     if plot:
         import seaborn as sns
@@ -1720,7 +3139,7 @@ def make_consensus_biclusters(
         if len(bic_ids) > 20:
             labels = False
         g = sns.clustermap(
-            J_heatmap,
+            pd.DataFrame(J_heatmap.toarray(), index=bic_ids, columns=bic_ids),
             yticklabels=labels,
             xticklabels=labels,
             linewidths=0,
@@ -1748,6 +3167,7 @@ def make_consensus_biclusters(
         verbose=verbose,
         plot=plot,
         modularity_measure=modularity_measure,
+        feature_names=np.arange(n_bics),
     )
     t2 = time()
 
@@ -1758,39 +3178,36 @@ def make_consensus_biclusters(
     if verbose:
         print("keep genes included in at least %s merged biclusters" % round(min_n_times_detected))
         
+    # genes of all biclusters as a sparse incidence matrix
+    gene_incidence = BiclusterSet.from_dataframe(
+        biclusters.loc[:, ["genes", "samples"]], exprs.index.values, exprs.columns.values
+    ).genes.astype(np.int64)
+    gene_names = exprs.index.values
     consensus_biclusters = []
     # for each group of matched biclusters
     for i in range(len(matched)):
-        gsets = biclusters.loc[matched[i], "genes"].values
-        bic_ids = biclusters.loc[matched[i], :].index.values
-        detected_n_times = biclusters.loc[matched[i], "detected_n_times"].sum()
+        bic_ids = biclusters.index.values[matched[i]]
+        detected_n_times = biclusters["detected_n_times"].values[matched[i]].sum()
         # count gene occurencies
-        gene_occurencies = {}
-        for gene in set().union(*gsets):
-            gene_occurencies[gene] = 0
-            for gset in gsets:
-                if gene in gset:
-                    gene_occurencies[gene] += 1
-
-        gene_occurencies = pd.Series(gene_occurencies).sort_values()
-        passed_genes = sorted(
-            gene_occurencies[
-                gene_occurencies >= min(n_runs, len(matched)) * frac_runs
-            ].index.values
-        )
-        not_passed_genes = sorted(
-            gene_occurencies[
-                gene_occurencies < min(n_runs, len(matched)) * frac_runs
-            ].index.values
-        )
+        gene_occurencies = np.asarray(gene_incidence[matched[i], :].sum(axis=0))
+        gene_occurencies = gene_occurencies.reshape(-1)
+        min_occurencies = min(n_runs, len(matched)) * frac_runs
+        is_passed = gene_occurencies >= min_occurencies
+        passed_genes = sorted(gene_names[is_passed])
+        not_passed_genes = sorted(gene_names[(gene_occurencies > 0) & ~is_passed])
 
         if len(passed_genes) < min_n_genes:
             # move all biclusters to not matched
-            not_matched += list(matched[i])
+            not_matched = list(not_matched) + list(matched[i])
         else:
+            if isinstance(exprs, (SparseExprs, DiskExprs)):
+                # z-scores of passed genes only; gene indexes refer to all features
+                data = exprs.to_dense(passed_genes)
+            else:
+                data = exprs
             # cluster samples again in a subspace of a new gene set
             bicluster = cluster_samples(
-                exprs.loc[passed_genes, :].T,
+                data.loc[passed_genes, :].T,
                 min_n_samples=min_n_samples,
                 seed=seed,
                 method=method,
@@ -1799,14 +3216,19 @@ def make_consensus_biclusters(
             if "sample_indexes" in bicluster.keys():
                 bicluster["genes"] = set(passed_genes)
                 bicluster["n_genes"] = len(bicluster["genes"])
-                bicluster = update_bicluster_data(bicluster, exprs)
+                bicluster = update_bicluster_data(bicluster, data)
+                if data is not exprs:
+                    ndx = list(bicluster["gene_indexes"])
+                    bicluster["gene_indexes"] = set(
+                        exprs.index.get_indexer(data.index.values[ndx]).tolist()
+                    )
                 bicluster["detected_n_times"] = detected_n_times
                 bicluster["ids"] = set(bic_ids) # ids of biclusters merged to the consensus biclusters
                 consensus_biclusters.append(bicluster)
     consensus_biclusters = pd.DataFrame.from_records(consensus_biclusters)
 
     # add not matched
-    not_changed_biclusters = biclusters.loc[not_matched, :]
+    not_changed_biclusters = biclusters.iloc[list(not_matched), :]
     # not_changed_biclusters["detected_n_times"] = 1
     consensus_biclusters = pd.concat([consensus_biclusters, not_changed_biclusters])
 
@@ -1979,6 +3401,8 @@ def write_bic_table(
     else:
         write_mode = "w"
 
+    if isinstance(bics_dict_or_df, BiclusterSet):
+        bics_dict_or_df = bics_dict_or_df.to_dataframe()
     bics = bics_dict_or_df.copy()
     if len(bics) == 0:
         print("No biclusters found", file=sys.stderr)
@@ -0,0 +1,190 @@
+import sys
+from time import time
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+
+
+class SparseExprs:
+    """Features x samples matrix stored as a sparse CSR matrix.
+
+    Row z-scores are computed lazily: row means and standard deviations
+    are kept with the matrix and applied only to rows densified on demand,
+    one row at a time during binarization or as a submatrix of module
+    features during sample clustering.
+    Implements the part of the DataFrame interface used by binarize() and
+    make_biclusters(): shape, index, columns, dtypes and iterrows();
+    use to_dense() to get z-scores of selected rows as a DataFrame.
+    """
+
+    __slots__ = ("values", "index", "columns", "means", "stds", "ceiling", "dtype")
+
+    def __init__(
+        self,
+        values,
+        index=None,
+        columns=None,
+        means=None,
+        stds=None,
+        ceiling=0,
+        dtype=np.float64,
+    ):
+        self.values = csr_matrix(values)
+        if self.values.dtype.kind != "f":
+            self.values = self.values.astype(np.float64)
+        if np.isnan(self.values.data).any():
+            raise ValueError("missing values are not supported in sparse matrices")
+        n_rows, n_cols = self.values.shape
+        self.index = pd.Index(range(n_rows) if index is None else index)
+        self.columns = pd.Index(range(n_cols) if columns is None else columns)
+        if len(self.index) != n_rows or len(self.columns) != n_cols:
+            raise ValueError("row or column names do not match the matrix shape")
+        # z-scores are (x - means) / stds, if given
+        self.means = None if means is None else np.asarray(means, dtype=np.float64)
+        self.stds = None if stds is None else np.asarray(stds, dtype=np.float64)
+        self.ceiling = ceiling
+        self.dtype = np.dtype(dtype)
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    @property
+    def dtypes(self):
+        return pd.Series(self.dtype, index=self.columns)
+
+    def get_rows(self, row_indexes):
+        """Returns a dense array of z-scores of rows with given indexes."""
+        rows = self.values[row_indexes, :].toarray()
+        if self.means is not None:
+            rows -= self.means[row_indexes, np.newaxis]
+            rows /= self.stds[row_indexes, np.newaxis]
+        if self.ceiling > 0:
+            np.clip(rows, -self.ceiling, self.ceiling, out=rows)
+        return rows.astype(self.dtype, copy=False)
+
+    def iterrows(self, chunksize=1000):
+        """Yields (feature name, Series of z-scores) as DataFrame.iterrows() does.
+
+        Rows are densified by chunks of chunksize rows."""
+        for start in range(0, self.shape[0], chunksize):
+            rows = self.get_rows(np.arange(start, min(start + chunksize, self.shape[0])))
+            for name, row in zip(self.index.values[start : start + chunksize], rows):
+                yield name, pd.Series(row, index=self.columns, name=name)
+
+    def to_dense(self, rows=None):
+        """Returns a DataFrame of z-scores of rows with given names (all by default)."""
+        if rows is None:
+            row_indexes = np.arange(self.shape[0])
+        else:
+            row_indexes = self.index.get_indexer(rows)
+            if (row_indexes < 0).any():
+                raise KeyError("features not found: %s" % list(np.array(rows)[row_indexes < 0]))
+        return pd.DataFrame(
+            self.get_rows(row_indexes),
+            index=self.index.values[row_indexes],
+            columns=self.columns,
+        )
+
+
+def calc_sparse_row_moments(values):
+    """Means and standard deviations (ddof=1) of rows of a CSR matrix,
+    implicit zeros included."""
+    n_rows, N = values.shape
+    nnz = np.diff(values.indptr)
+    means = np.asarray(values.sum(axis=1), dtype=np.float64).reshape(-1) / N
+    # squared deviations of stored values and of N - nnz implicit zeros
+    d = values.data - np.repeat(means, nnz)
+    sq_sums = np.bincount(
+        np.repeat(np.arange(n_rows), nnz), weights=d**2, minlength=n_rows
+    )
+    sq_sums += (N - nnz) * means**2
+    stds = np.sqrt(sq_sums / (N - 1))
+    return means, stds
+
+
+def prepare_sparse_matrix(
+    input_matrix,
+    min_n_samples=5,
+    tol=0.01,
+    standradize=True,
+    ceiling=0,
+    verbose=False,
+    dtype=None,
+):
+    """prepare_input_matrix() for a SparseExprs matrix.
+
+    Drops constant features and features with less than min_n_samples
+    non-zero values, which cannot form an up-regulated bicluster;
+    row means and standard deviations are stored for lazy z-scoring,
+    so the matrix stays sparse.
+    A SparseExprs which is already z-scored (e.g. prepared by run_ensemble())
+    is returned as is.
+    """
+    if input_matrix.means is not None:
+        if verbose:
+            print("\tInput is already standardized.", file=sys.stdout)
+        return input_matrix
+    t0 = time()
+    values = input_matrix.values
+    index = np.array([str(x) for x in input_matrix.index.values], dtype=object)
+    columns = [str(x) for x in input_matrix.columns.values]
+    means, stds = calc_sparse_row_moments(values)
+
+    keep = stds > 0
+    n_zero_var = (~keep).sum()
+    if n_zero_var > 0 and verbose:
+        print("\tZero variance rows will be dropped: %s" % n_zero_var, file=sys.stdout)
+    n_nonzero = np.bincount(
+        np.repeat(np.arange(values.shape[0]), np.diff(values.indptr)),
+        weights=values.data != 0,
+        minlength=values.shape[0],
+    )
+    too_few = keep & (n_nonzero < min_n_samples)
+    if too_few.sum() > 0:
+        if verbose:
+            print(
+                "\tFeatures with too few non-zero values (<%s) dropped: %s"
+                % (min_n_samples, too_few.sum()),
+                file=sys.stdout,
+            )
+        keep = keep & ~too_few
+    if keep.sum() <= 2:
+        print(
+            "After excluding constant features (rows) , less than 3 features (rows) remain in the input matrix.",
+            file=sys.stderr,
+        )
+    if len(set(index[keep])) < keep.sum():
+        print("\tRow names are not unique.", file=sys.stderr)
+
+    mean_passed = np.all(np.abs(means[keep]) < tol)
+    std_passed = np.all(np.abs(stds[keep] - 1) < tol)
+    zscore = standradize and not (mean_passed and std_passed)
+    if verbose and not (mean_passed and std_passed):
+        print("\tInput is not standardized.", file=sys.stdout)
+        if standradize:
+            print("\tZ-scores will be computed for densified rows only", file=sys.stdout)
+    if not standradize:
+        ceiling = 0
+    if ceiling > 0 and verbose:
+        print(
+            "\tStandardized expressions will be limited to [-%s,%s]:"
+            % (ceiling, ceiling),
+            file=sys.stdout,
+        )
+    if verbose:
+        print(
+            "\tPrepared sparse input with %s features in {:.2f} s".format(time() - t0)
+            % keep.sum(),
+            file=sys.stdout,
+        )
+    return SparseExprs(
+        values[keep] if not keep.all() else values,
+        index=index[keep],
+        columns=columns,
+        means=means[keep] if zscore else None,
+        stds=stds[keep] if zscore else None,
+        ceiling=ceiling,
+        dtype=np.float64 if dtype is None else dtype,
+    )
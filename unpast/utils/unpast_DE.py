@@ -6,6 +6,7 @@ import os
 import logging
 import subprocess
 import numpy as np
+from unpast.utils.io import get_input_format, read_exprs
 
 # Add all logging levels
 logging.basicConfig(level=logging.INFO, format="%(levelname)s - %(message)s")
@@ -149,7 +150,10 @@ def read_dataframe_from_file(file_path: str) -> pd.DataFrame:
         logging.error("File is empty: %s", file_path)
         raise ValueError(f"File is empty: {file_path}")
 
-    df = pd.read_csv(file_path, delimiter=DELIMITER, comment='#', index_col=0)
+    if get_input_format(file_path) == "tsv":
+        df = pd.read_csv(file_path, delimiter=DELIMITER, comment='#', index_col=0)
+    else:
+        df = read_exprs(file_path)
 
     if df.empty:
         logging.error("UnPaSt output is empty: %s", file_path)